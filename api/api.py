@@ -1,3 +1,4 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
@@ -5,14 +6,34 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.routing import APIRoute
 from fastapi_pagination import add_pagination
 
+from api.utils.jobs import job_runner
+from api.utils.response_cache import ETagMiddleware
+from config import get_settings
 from core.broadcast import broadcast
+from core.profiling import QueryProfileMiddleware
+from core.session import get_async_engine, get_engine, maintain_database, run_optimize
+from core.workers import shutdown_process_pool
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await broadcast.connect()
+    settings = get_settings()
+    await job_runner.start(settings)
+    maintenance = None
+    if get_engine().dialect.name == "sqlite" and settings.SQLITE_OPTIMIZE_INTERVAL > 0:
+        maintenance = asyncio.create_task(maintain_database(settings.SQLITE_OPTIMIZE_INTERVAL))
     yield
+    await job_runner.stop()
     await broadcast.disconnect()
+    if maintenance is not None:
+        maintenance.cancel()
+        await asyncio.gather(maintenance, return_exceptions=True)
+        # SQLite suggests PRAGMA optimize as the last thing before closing a long-lived connection
+        await run_optimize()
+    if settings.ASYNC_DATABASE:
+        await get_async_engine().dispose()
+    shutdown_process_pool()
 
 
 def create_app() -> FastAPI:
@@ -24,6 +45,8 @@ def create_app() -> FastAPI:
         lifespan=lifespan,
     )
 
+    # Inside CORS, so a 304 still has its headers
+    app.add_middleware(ETagMiddleware)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -31,6 +54,8 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    if get_settings().PROFILE_QUERIES:
+        app.add_middleware(QueryProfileMiddleware)
 
     # @app.get("/health", tags=["main"])
     # async def health() -> str:
@@ -51,8 +76,10 @@ def create_app() -> FastAPI:
     from api.routers import (
         collection,
         combat,
+        debug,
         entity,
         image,
+        job,
         message,
         participant,
         rolltable,
@@ -85,6 +112,8 @@ def create_app() -> FastAPI:
     app.include_router(tag.router)
     app.include_router(collection.router)
     app.include_router(ws.router)
+    app.include_router(debug.router)
+    app.include_router(job.router)
 
     add_pagination(app)
 
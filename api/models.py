@@ -1,19 +1,21 @@
 import enum
 import json
 import pathlib
-import random
+import time
 from typing import Optional
 
 import httpx
 from fastapi import HTTPException
 from PIL import Image as PImage
 from PIL import UnidentifiedImageError
-from sqlalchemy import Column, ForeignKey, String, Table
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import Column, ForeignKey, String, Table, event
+from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
 from sqlalchemy.types import BLOB
 
-from core.colour import extract_pallete
+from api.utils.search import create_search_table
+from core.colour import extract_pallete, pack_palette
 from core.db import Base, str64, str64_i, str100
+from core.phash import dhash
 from core.utils import extract_AC, extract_CR, make_seq, rgb_to_hex, roll
 
 image_tags = Table(
@@ -37,6 +39,9 @@ image_collections = Table(
     Column("collection_id", ForeignKey("collections.id"), primary_key=True),
 )
 
+# The image full text search table is SQLite DDL rather than a model, see api.utils.search
+event.listen(Base.metadata, "after_create", create_search_table)
+
 
 class ImageType(enum.Enum):
     backdrop = "backdrop"
@@ -51,9 +56,8 @@ class ImageFileMode(enum.Enum):
     hosted = "hosted"
 
 
-def hash_fn(f):
-    e = "1253467890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
-    return "".join(random.choices(e, k=20))
+def hash_fn(f: PImage.Image) -> str:
+    return dhash(f)
 
 
 class Image(Base):
@@ -63,12 +67,13 @@ class Image(Base):
     name: Mapped[str] = mapped_column(String(100), index=True)
     focus_x: Mapped[int] = mapped_column(nullable=True, default=-1)
     focus_y: Mapped[int] = mapped_column(nullable=True, default=-1)
-    hash: Mapped[str] = mapped_column(String(20), index=True)
+    hash: Mapped[Optional[str]] = mapped_column(String(20), index=True, nullable=True)
     dimension_x: Mapped[int]
     dimension_y: Mapped[int]
     tags: Mapped[list["Tag"]] = relationship(back_populates="images", secondary=image_tags)
     type: Mapped[ImageType] = mapped_column(default=ImageType.backdrop)
     palette: Mapped[str] = mapped_column(String(50), nullable=True)
+    palette_lab: Mapped[Optional[bytes]] = mapped_column(BLOB, nullable=True)  # See pack_lab
 
     collections: Mapped[list["Collection"]] = relationship(
         back_populates="images", secondary=image_collections
@@ -79,6 +84,7 @@ class Image(Base):
     )  # secondary=image_entities for N:N
 
     seq: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)
+    mime_type: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
 
     # mode: Mapped[ImageFileMode] = mapped_column(default=ImageFileMode.local)
     # attribution: Mapped[str] = mapped_column(String(50))
@@ -89,6 +95,7 @@ class Image(Base):
     ) -> "Image":
         with PImage.open(path) as f:
             (x, y) = f.size
+            mime_type = PImage.MIME.get(f.format or "")
             imhash = hash_fn(f)
         name = kwargs.pop("name", path.stem)
         i = cls(
@@ -98,6 +105,7 @@ class Image(Base):
             dimension_x=x,
             dimension_y=y,
             hash=imhash,
+            mime_type=mime_type,
         )
         if calculate_palette:
             i.palette = ",".join(map(rgb_to_hex, extract_pallete(path)))
@@ -117,6 +125,12 @@ class Image(Base):
         except UnidentifiedImageError:
             raise HTTPException(status_code=404, detail=f"Image at {uri} not found")
 
+    @validates("palette")
+    def _pack_palette(self, key, palette: Optional[str]) -> Optional[str]:
+        "Keep the searchable form of the palette in step with the displayed one"
+        self.palette_lab = pack_palette(palette)
+        return palette
+
     # def inject_urls(self, router: APIRouter, **context):
     #     self.url = router.url_path_for("get_full_image", image_id=self.id)
     #     self.thumbnail_url = router.url_path_for("get_image_thumbnail", image_id=self.id, **context)
@@ -155,6 +169,34 @@ class Message(Base):
     message: Mapped[str] = mapped_column(String(400))
 
 
+class JobType(enum.Enum):
+    hash = "hash"
+    palette = "palette"
+    thumbnail = "thumbnail"
+
+
+class JobStatus(enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    dead = "dead"  # Failed too many times, needs a manual retry
+
+
+class Job(Base):
+    # __tablename__ = "jobs"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    type: Mapped[JobType]
+    status: Mapped[JobStatus] = mapped_column(default=JobStatus.queued, index=True)
+    image_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("images.id", ondelete="CASCADE"), nullable=True, index=True
+    )
+    attempts: Mapped[int] = mapped_column(default=0)
+    # Unix timestamps
+    run_after: Mapped[float] = mapped_column(default=time.time, index=True)
+    leased_until: Mapped[Optional[float]] = mapped_column(nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(String(400), nullable=True)
+
+
 # class Session(Base):
 #     # __tablename__ = "sessions"
 #     id: Mapped[int] = mapped_column(primary_key=True)
@@ -236,7 +278,9 @@ class Entity(Base):
     name: Mapped[str] = mapped_column(String(100), insert_default="")
     is_PC: Mapped[bool] = mapped_column(default=False)
 
-    image_id: Mapped[Optional[int]] = mapped_column(ForeignKey("images.id"), nullable=True)
+    image_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("images.id"), nullable=True, index=True
+    )
     image: Mapped[Optional[Image]] = relationship("Image")
 
     cr: Mapped[float] = mapped_column(nullable=True)
@@ -245,28 +289,33 @@ class Entity(Base):
     initiative_modifier: Mapped[int] = mapped_column(default=0)
 
     data: Mapped[bytes] = mapped_column(BLOB, nullable=True)
+    data_hash: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)
     source: Mapped[Optional[str]] = mapped_column(String(10), nullable=True)
     source_page: Mapped[Optional[int]] = mapped_column(nullable=True)
 
     seq: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)
 
     @staticmethod
-    def from_jsondata(json_dict: dict, seq: Optional[str] = None):
+    def columns_from_jsondata(json_dict: dict, seq: Optional[str] = None) -> dict:
+        "The column values for a 5e.tools monster, as a dict for a Core insert or update"
         if seq is None:
             seq = make_seq()
-        e = Entity(
-            name=json_dict.get("name"),
-            is_PC=False,
-            cr=extract_CR(json_dict),
-            ac=extract_AC(json_dict),
-            hit_dice=json_dict.get("hp", dict()).get("formula", ""),
-            initiative_modifier=json_dict.get("dex", 10),
-            source=json_dict.get("source"),
-            source_page=json_dict.get("page"),
-            data=json.dumps(json_dict).encode(),
-            seq=seq,
-        )
-        return e
+        return {
+            "name": json_dict.get("name"),
+            "is_PC": False,
+            "cr": extract_CR(json_dict),
+            "ac": extract_AC(json_dict) or 10,
+            "hit_dice": json_dict.get("hp", dict()).get("formula", ""),
+            "initiative_modifier": (json_dict.get("dex", 10) - 10) // 2,
+            "source": json_dict.get("source"),
+            "source_page": json_dict.get("page"),
+            "data": json.dumps(json_dict).encode(),
+            "seq": seq,
+        }
+
+    @staticmethod
+    def from_jsondata(json_dict: dict, seq: Optional[str] = None):
+        return Entity(**Entity.columns_from_jsondata(json_dict, seq))
 
 
 class Collection(Base):
@@ -1,7 +1,7 @@
 from typing import Any, Optional, Sequence
 
 from fastapi import APIRouter, Depends, Response
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from typing_extensions import Annotated
 
 import api.models as models
@@ -10,16 +10,23 @@ from api.schemas import (
     CollectionCreate,
     CollectionFilter,
     CollectionUpdate,
+    SortBy,
 )
 
 # from api.db.schemas.filters import CollectionFilter, generate_filter_query
 # from api.deps import CurrentActiveUser
 from api.services import CollectionService, get_collection_service
-from api.utils.filters import generate_filter_query
+from api.utils.filters import generate_filter_query, loaded_tables
+from api.utils.pagination import Page
+from api.utils.response_cache import cache_responses
 from core.db import foreign_key
 
 router = APIRouter(prefix="/collection")
 
+LIST_LOAD = ("images.tags", "images.entities", "images.collections:raise")
+# Polled by clients and rarely changed, see api.utils.response_cache
+cache_responses(router, loaded_tables(models.Collection, LIST_LOAD))
+
 
 @router.get("/", response_model=Page[Collection], tags=["collections"])
 async def list_collections(
@@ -28,15 +35,26 @@ async def list_collections(
     # current_user: CurrentActiveUser,
 ) -> Page[models.Collection]:
     "Get all collections"
-    q = generate_filter_query(models.Collection, collection_filter)
-    return collection_service.get_some(q)  # , transformer=build_transformer(router))
+    q = generate_filter_query(models.Collection, collection_filter, LIST_LOAD)
+    return await collection_service.aget_some(q)  # , transformer=build_transformer(router))
+
+
+@router.get("/cursor", response_model=CursorPage[Collection], tags=["collections"])
+async def list_collections_by_cursor(
+    collection_service: Annotated[CollectionService, Depends(get_collection_service)],
+    collection_filter: Annotated[CollectionFilter, Depends()],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.Collection]:
+    "Get all collections, a page at a time: pass next_page as the cursor for the page after"
+    q = generate_filter_query(models.Collection, collection_filter, LIST_LOAD)
+    return await collection_service.aget_some_by_cursor(q, SortBy(), params)
 
 
 @router.get("/orphans", tags=["collections"])
 async def get_empty_collections(
     collection_service: Annotated[CollectionService, Depends(get_collection_service)]
 ) -> Sequence[Collection]:
-    return collection_service.get_empty_collections()  # type: ignore
+    return await collection_service.run_sync(collection_service.get_empty_collections)  # type: ignore
 
 
 @router.get(
@@ -51,7 +69,7 @@ async def get_collection(
     # current_user: CurrentActiveUser,
 ) -> models.Collection:
     "Get a single collection by id"
-    return collection_service.get(collection_id)
+    return await collection_service.aget(collection_id)
 
 
 @router.post(
@@ -67,7 +85,7 @@ async def create_collection(
     # current_user: CurrentActiveUser,
 ) -> models.Collection:
     "Create a new collection"
-    return collection_service.create(collection)
+    return await collection_service.acreate(collection)
 
 
 @router.patch("/{collection_id}", response_model=Collection, tags=["collections"])
@@ -77,7 +95,7 @@ async def update_collection(
     collection_service: Annotated[CollectionService, Depends(get_collection_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Collection]:
-    return collection_service.update(collection_id, collection)
+    return await collection_service.aupdate(collection_id, collection)
 
 
 @router.delete("/{collection_id}", tags=["collections"])  # , status_code=204)
@@ -86,5 +104,5 @@ async def delete_collection(
     collection_service: Annotated[CollectionService, Depends(get_collection_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    collection_service.delete(collection_id)
+    await collection_service.adelete(collection_id)
     return Response(status_code=204)
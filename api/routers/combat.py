@@ -1,7 +1,7 @@
 from typing import Any, Optional
 
 from fastapi import APIRouter, Depends, Response
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from typing_extensions import Annotated
 
 import api.models as models
@@ -18,11 +18,15 @@ from api.schemas import (
 # from api.deps import CurrentActiveUser
 from api.services import CombatService, get_combat_service
 from api.utils.filters import generate_filter_query, generate_sort_query
+from api.utils.pagination import Page
 from core.db import foreign_key
 
 # router = HandleTrailingSlashRouter(prefix="/combat")
 router = APIRouter(prefix="/combat")
 
+# Participants are sent with their entity_id and image_id, but not the rows themselves
+LIST_LOAD = ("participants", "participants.entity:raise", "participants.image:raise")
+
 
 @router.get("/", response_model=Page[Combat], tags=["combats"])
 async def list_combats(
@@ -33,10 +37,23 @@ async def list_combats(
 ) -> Page[models.Combat]:
     "Get all combats"
 
-    q = generate_filter_query(models.Combat, combat_filter)  # .order_by(models.Combat.id.desc())
+    # .order_by(models.Combat.id.desc())
+    q = generate_filter_query(models.Combat, combat_filter, LIST_LOAD)
     q = generate_sort_query(q, models.Combat, sort_by)
     # print(combat_filter)
-    return combat_service.get_some(q)
+    return await combat_service.aget_some(q)
+
+
+@router.get("/cursor", response_model=CursorPage[Combat], tags=["combats"])
+async def list_combats_by_cursor(
+    combat_service: Annotated[CombatService, Depends(get_combat_service)],
+    combat_filter: Annotated[CombatFilter, Depends()],
+    sort_by: Annotated[CombatSortBy, Depends()],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.Combat]:
+    "Get all combats, a page at a time: pass next_page as the cursor for the page after"
+    q = generate_filter_query(models.Combat, combat_filter, LIST_LOAD)
+    return await combat_service.aget_some_by_cursor(q, sort_by, params)
 
 
 @router.get(
@@ -51,7 +68,7 @@ async def get_combat(
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Combat]:
     "Get a single combat by id"
-    return combat_service.get(combat_id)
+    return await combat_service.aget(combat_id)
 
 
 @router.post(
@@ -67,7 +84,7 @@ async def create_combat(
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Combat]:
     "Create a new combat"
-    return combat_service.create(combat)
+    return await combat_service.acreate(combat)
 
 
 @router.patch("/{combat_id}", response_model=Combat, tags=["combats"])
@@ -77,7 +94,7 @@ async def update_combat(
     combat_service: Annotated[CombatService, Depends(get_combat_service)],
     # current_user: CurrentActiveUser,
 ) -> models.Combat:
-    return combat_service.update(combat_id, combat)
+    return await combat_service.aupdate(combat_id, combat)
 
 
 @router.delete("/{combat_id}", tags=["combats"])  # , status_code=204)
@@ -86,7 +103,7 @@ async def delete_combat(
     combat_service: Annotated[CombatService, Depends(get_combat_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    combat_service.delete(combat_id)
+    await combat_service.adelete(combat_id)
     return Response(status_code=204)
 
 
@@ -97,7 +114,9 @@ async def add_participant_to_combat(
     combat_service: Annotated[CombatService, Depends(get_combat_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Combat]:
-    return combat_service.add_participant_to_combat(combat_id, participants)
+    return await combat_service.run_sync(
+        combat_service.add_participant_to_combat, combat_id, participants
+    )
 
 
 @router.delete("/{combat_id}/remove", tags=["combats"], response_model=Combat)
@@ -107,4 +126,6 @@ async def remove_participant_from_combat(
     combat_service: Annotated[CombatService, Depends(get_combat_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Combat]:
-    return combat_service.remove_participant_from_combat(combat_id, participant_id)
+    return await combat_service.run_sync(
+        combat_service.remove_participant_from_combat, combat_id, participant_id
+    )
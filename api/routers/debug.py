@@ -0,0 +1,50 @@
+from typing import Any
+
+from fastapi.routing import APIRouter
+
+from api.utils.delivery import delivery_stats
+from api.utils.derivative_cache import get_derivative_cache
+from api.utils.object_cache import object_cache_stats
+from api.utils.pagination import get_count_cache
+from api.utils.response_cache import get_response_cache
+from core.profiling import query_stats
+
+router = APIRouter(prefix="/debug")
+
+
+@router.get("/thumbnails", tags=["debug"])
+async def get_thumbnail_cache_stats() -> dict[str, int]:
+    "Hit, miss and eviction counters for the thumbnail cache"
+    return get_derivative_cache().stats()
+
+
+@router.get("/delivery", tags=["debug"])
+async def get_delivery_stats() -> dict[str, dict[str, int]]:
+    "Bytes of image files served per route, and how many responses used each send method"
+    return delivery_stats.stats()
+
+
+@router.get("/queries", tags=["debug"])
+async def get_query_stats() -> dict[str, Any]:
+    """Queries per request and database time for each route, with histograms over recent requests,
+    the slowest statements, statements repeated within a request and the slow query log. Empty
+    unless PROFILE_QUERIES is set"""
+    return query_stats.stats()
+
+
+@router.get("/counts", tags=["debug"])
+async def get_count_cache_stats() -> dict[str, int]:
+    "Entries in the cache of paginated list totals, and how often a total came from it"
+    return get_count_cache().stats()
+
+
+@router.get("/objects", tags=["debug"])
+async def get_object_cache_stats() -> dict[str, dict[str, int]]:
+    "Entries, hits, misses and invalidations of each model's lookup cache"
+    return object_cache_stats()
+
+
+@router.get("/responses", tags=["debug"])
+async def get_response_cache_stats() -> dict[str, int]:
+    "Stored response bodies, how often one was served, and how many 304s were sent"
+    return get_response_cache().stats()
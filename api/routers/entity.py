@@ -1,7 +1,9 @@
 from typing import Any, Optional, Sequence
 
 from fastapi import APIRouter, Depends, Response, UploadFile
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
 # from fastapi_pagination.links import Page
 from typing_extensions import Annotated
@@ -13,16 +15,23 @@ from api.schemas import (
     EntityFilter,
     EntitySortBy,
     EntityUpdate,
+    EntityUpdateID,
 )
 
 # from api.db.schemas.filters import EntityFilter, generate_filter_query
 # from api.deps import CurrentActiveUser
 from api.services import EntityService, get_entity_service
-from api.utils.filters import generate_filter_query, generate_sort_query
+from api.utils.filters import generate_filter_query, generate_sort_query, loaded_tables
+from api.utils.pagination import Page
+from api.utils.response_cache import cache_responses
 from core.db import foreign_key
 
 router = APIRouter(prefix="/entity")
 
+LIST_LOAD = ("image:raise",)
+# Polled by clients and rarely changed, see api.utils.response_cache
+cache_responses(router, loaded_tables(models.Entity, ()), paths=["/sources"], store=True)
+
 
 @router.get("/", response_model=Page[Entity], tags=["entities"])
 async def list_entities(
@@ -30,18 +39,76 @@ async def list_entities(
     entity_filter: Annotated[EntityFilter, Depends()],
     sort_by: Annotated[EntitySortBy, Depends()],
     # current_user: CurrentActiveUser,
-) -> Page[models.Entity]:
+) -> Response:
     "Get all entities"
     q = generate_filter_query(models.Entity, entity_filter)
     q = generate_sort_query(q, models.Entity, sort_by)
-    return entity_service.get_some(q)
+    return await entity_service.aget_some_json(q, Entity)
+
+
+@router.get("/cursor", response_model=CursorPage[Entity], tags=["entities"])
+async def list_entities_by_cursor(
+    entity_service: Annotated[EntityService, Depends(get_entity_service)],
+    entity_filter: Annotated[EntityFilter, Depends()],
+    sort_by: Annotated[EntitySortBy, Depends()],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.Entity]:
+    "Get all entities, a page at a time: pass next_page as the cursor for the page after"
+    q = generate_filter_query(models.Entity, entity_filter, LIST_LOAD)
+    return await entity_service.aget_some_by_cursor(q, sort_by, params)
 
 
 @router.get("/sources", tags=["entities"])
 async def get_entity_sources(
     entity_service: Annotated[EntityService, Depends(get_entity_service)],
 ) -> Sequence[str | None]:
-    return entity_service.get_sources()
+    return await entity_service.run_sync(entity_service.get_sources)
+
+
+@router.post(
+    "/bulk",
+    response_model=list[foreign_key],
+    status_code=201,
+    responses={409: {"description": "Conflict Error, for each item that caused one"}},
+    tags=["entities"],
+)
+async def create_entities(
+    entities: list[EntityCreate],
+    entity_service: Annotated[EntityService, Depends(get_entity_service)],
+) -> list[int]:
+    "Create many entities at once, all or none of them. Returns their ids in order"
+    return await entity_service.acreate_many(entities)
+
+
+@router.patch(
+    "/bulk",
+    response_model=list[foreign_key],
+    responses={
+        404: {"description": "Entity not found, for each missing id"},
+        409: {"description": "Conflict Error, for each item that caused one"},
+    },
+    tags=["entities"],
+)
+async def update_entities(
+    entities: list[EntityUpdateID],
+    entity_service: Annotated[EntityService, Depends(get_entity_service)],
+) -> list[int]:
+    "Update many entities at once, all or none of them"
+    return await entity_service.aupdate_many(entities)
+
+
+@router.delete(
+    "/bulk",
+    responses={404: {"description": "Entity not found, for each missing id"}},
+    tags=["entities"],
+)
+async def delete_entities(
+    entity_ids: list[foreign_key],
+    entity_service: Annotated[EntityService, Depends(get_entity_service)],
+) -> Any:
+    "Delete many entities at once, all or none of them"
+    await entity_service.adelete_many(entity_ids)
+    return Response(status_code=204)
 
 
 @router.get(
@@ -56,7 +123,7 @@ async def get_entity(
     # current_user: CurrentActiveUser,
 ) -> models.Entity:
     "Get a single entity by id"
-    return entity_service.get(entity_id)
+    return await entity_service.aget(entity_id)
 
 
 @router.post(
@@ -72,7 +139,7 @@ async def create_entity(
     # current_user: CurrentActiveUser,
 ) -> models.Entity:
     "Create a new entity"
-    return entity_service.create(entity)
+    return await entity_service.acreate(entity)
 
 
 @router.post(
@@ -87,9 +154,13 @@ async def create_entity_from_json(
     entity_service: Annotated[EntityService, Depends(get_entity_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    "Create a new entity"
-    e = await entity_service.create_from_json(entity_file)
-    return e
+    """Create or update entities from a 5e.tools bestiary file. Returns how many were added, updated
+    and unchanged, and how long it took"""
+    if isinstance(entity_service.db_session, AsyncSession):
+        return await entity_service.run_sync(entity_service.create_from_json, entity_file)
+    # A whole bestiary takes a while to decode, hash and insert, so with a Session it runs in the
+    # threadpool as a def route would, rather than holding up the event loop
+    return await run_in_threadpool(entity_service.create_from_json, entity_file)
 
 
 @router.patch("/{entity_id}", response_model=Entity, tags=["entities"])
@@ -99,7 +170,7 @@ async def update_entity(
     entity_service: Annotated[EntityService, Depends(get_entity_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Entity]:
-    return entity_service.update(entity_id, entity)
+    return await entity_service.aupdate(entity_id, entity)
 
 
 @router.delete("/{entity_id}", tags=["entities"])  # , status_code=204)
@@ -108,5 +179,5 @@ async def delete_entity(
     entity_service: Annotated[EntityService, Depends(get_entity_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    entity_service.delete(entity_id)
+    await entity_service.adelete(entity_id)
     return Response(status_code=204)
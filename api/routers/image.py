@@ -1,9 +1,9 @@
 from typing import Any, Optional
 
-from fastapi import Depends, Query, Response, UploadFile
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import Depends, Query, Request, Response, UploadFile
+from fastapi.responses import FileResponse
 from fastapi.routing import APIRouter
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from typing_extensions import Annotated
 
 import api.models as models
@@ -19,13 +19,18 @@ from api.schemas import (
 )
 from api.services import ImageService, get_image_service
 from api.utils.filters import generate_filter_query, generate_sort_query
+from api.utils.pagination import Page
 from config import Settings, get_settings
 
 # from core.colour import put_pallete_into_db
 from core.db import foreign_key
+from core.phash import HASH_BITS
 
 router = APIRouter(prefix="/image")
 
+# ImageURL reads tags and entities, never collections
+LIST_LOAD = ("tags", "entities", "collections:raise")
+
 
 # def build_transformer(router: APIRouter, **context):
 #     return lambda x: list(map(partial(inject_urls, router=router, **context), x))  # type: ignore
@@ -49,33 +54,63 @@ async def list_images(
     image_filter: Annotated[ImageFilter, Depends()],
     sort_by: Annotated[SortBy, Depends()],
     # current_user: CurrentActiveUser,
-) -> Page[models.Image]:
+) -> Response:
     "Get all images"
     q = generate_filter_query(models.Image, image_filter)
     q = generate_sort_query(q, models.Image, sort_by)
-    return image_service.get_some(q)  # , transformer=build_transformer(router))
+    return await image_service.aget_some_json(q, ImageURL)
+
+
+@router.get("/cursor", response_model=CursorPage[ImageURL], tags=["images"])
+async def list_images_by_cursor(
+    image_service: Annotated[ImageService, Depends(get_image_service)],
+    image_filter: Annotated[ImageFilter, Depends()],
+    sort_by: Annotated[SortBy, Depends()],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.Image]:
+    "Get all images, a page at a time: pass next_page as the cursor for the page after"
+    q = generate_filter_query(models.Image, image_filter, LIST_LOAD)
+    return await image_service.aget_some_by_cursor(q, sort_by, params)
 
 
 @router.get("/tag", tags=["images"])
 async def get_image_tag_matches(
-    taglist: Annotated[list[int], Query()],
     image_filter: Annotated[ImageFilter, Depends()],
     image_service: Annotated[ImageService, Depends(get_image_service)],
+    taglist: Annotated[Optional[list[foreign_key]], Query()] = None,
+    all_tags: Annotated[Optional[list[foreign_key]], Query()] = None,
+    exclude_tags: Annotated[Optional[list[foreign_key]], Query()] = None,
 ) -> Page[ImageURL]:  # ImageMatchResult:
+    """Images with any of taglist, most matching tags first, that also have all of all_tags and
+    none of exclude_tags"""
     # def transformer(i):
     # return inject_urls(i, router)
 
     q = generate_filter_query(models.Image, image_filter)
-    return image_service.get_images(q, taglist)  # , transformer=build_transformer(router))
+    return await image_service.run_sync(
+        image_service.get_images, q, taglist, all_tags, exclude_tags
+    )
     # return image_service.get_images_by_tag_match(taglist, transformer=transformer)
 
 
-# @router.get("/search", tags=["images"])
-# async def smart_search(
-#     q: str,
-#     image_service: Annotated[ImageService, Depends(get_image_service)],
-# ) -> Page[ImageURL]:
-#     return image_service.smart_search(query=q)
+@router.get("/search/colour", response_model=list[ImageURL], tags=["images"])
+async def search_images_by_colour(
+    hex: Annotated[str, Query(pattern="^#?[0-9a-fA-F]{6}$", description="e.g. #1a2b3c")],
+    image_service: Annotated[ImageService, Depends(get_image_service)],
+    type: Optional[models.ImageType] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+) -> Any:
+    "Images whose palette has a colour closest to hex (perceptually, in Lab space), closest first"
+    return await image_service.run_sync(image_service.search_by_colour, hex, type, limit)
+
+
+@router.get("/search", tags=["images"])
+async def smart_search(
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    image_service: Annotated[ImageService, Depends(get_image_service)],
+) -> Page[ImageURL]:
+    "Search images by name, and by the names of their tags, collections and entities"
+    return await image_service.run_sync(image_service.smart_search, query=q)
 
 
 @router.get(
@@ -87,10 +122,12 @@ async def get_image_tag_matches(
 async def get_random_image(
     image_type: models.ImageType,
     image_service: Annotated[ImageService, Depends(get_image_service)],
+    tags: Annotated[Optional[list[foreign_key]], Query()] = None,
+    collection_id: Optional[foreign_key] = None,
     # current_user: CurrentActiveUser,
 ) -> models.Image:
-    "Get a single random image"
-    return image_service.get_random(models.Image.type == image_type)
+    "Get a single random image, optionally one with all of the given tags and/or in a collection"
+    return await image_service.run_sync(image_service.get_random, image_type, tags, collection_id)
     # return inject_urls(image_service.get_random(models.Image.type == image_type), router)
 
 
@@ -106,7 +143,7 @@ async def get_image(
     # current_user: CurrentActiveUser,
 ) -> models.Image:
     "Get a single image by id"
-    return image_service.get(image_id)
+    return await image_service.aget(image_id)
     # return inject_urls(image_service.get(image_id), router)
 
 
@@ -123,7 +160,7 @@ async def create_image(
     # current_user: CurrentActiveUser,
 ) -> models.Image:
     "Create a new image"
-    return image_service.create(image)
+    return await image_service.acreate(image)
 
 
 @router.patch("/{image_id}", response_model=Image, tags=["images"])
@@ -133,7 +170,7 @@ async def update_image(
     image_service: Annotated[ImageService, Depends(get_image_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Image]:
-    return image_service.update(image_id, image)
+    return await image_service.aupdate(image_id, image)
 
 
 # @router.post("/{image_id}/favourite", response_model=Image, tags=["images"])
@@ -177,7 +214,7 @@ async def apply_tag(
     image_service: Annotated[ImageService, Depends(get_image_service)],
     # current_user: CurrentActiveUser,
 ) -> models.Image:
-    return image_service.apply_tag(image_id, tag_id)
+    return await image_service.run_sync(image_service.apply_tag, image_id, tag_id)
 
 
 @router.delete("/{image_id}/tag", response_model=Image, tags=["images"])
@@ -187,7 +224,7 @@ async def remove_tag(
     image_service: Annotated[ImageService, Depends(get_image_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Image]:
-    return image_service.remove_tag(image_id, tag_id)
+    return await image_service.run_sync(image_service.remove_tag, image_id, tag_id)
 
 
 @router.put("/{image_id}/tag", response_model=Image, tags=["images"])
@@ -197,7 +234,7 @@ async def set_tags(
     image_service: Annotated[ImageService, Depends(get_image_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Image]:
-    return image_service.set_tags(image_id, tags)
+    return await image_service.run_sync(image_service.set_tags, image_id, tags)
 
 
 @router.delete("/{image_id}", tags=["images"])  # , status_code=204)
@@ -206,35 +243,65 @@ async def delete_image(
     image_service: Annotated[ImageService, Depends(get_image_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    image_service.delete(image_id)
+    await image_service.adelete(image_id)
     return Response(status_code=204)
 
 
 @router.get(
     "/{image_id}/full",
-    responses={404: {"description": "Image not found"}},
+    responses={
+        206: {"description": "Partial content"},
+        304: {"description": "Not modified"},
+        404: {"description": "Image not found"},
+        416: {"description": "Range not satisfiable"},
+    },
     response_class=FileResponse,
     tags=["images"],
 )
 async def get_full_image(
-    image_id: foreign_key, image_service: Annotated[ImageService, Depends(get_image_service)]
+    image_id: foreign_key,
+    request: Request,
+    image_service: Annotated[ImageService, Depends(get_image_service)],
+    settings: Annotated[Settings, Depends(get_settings)],
 ) -> Any:
-    return image_service.get_full_image(image_id)
+    return await image_service.run_sync(image_service.get_full_image, image_id, request, settings)
 
 
 @router.get(
     "/{image_id}/thumb",
-    responses={404: {"description": "Image not found"}},
-    response_class=StreamingResponse,
+    responses={304: {"description": "Not modified"}, 404: {"description": "Image not found"}},
+    response_class=FileResponse,
     tags=["images"],
 )
 async def get_image_thumbnail(
     image_id: foreign_key,
+    request: Request,
     scale: Annotated[ImageScale, Depends()],
     image_service: Annotated[ImageService, Depends(get_image_service)],
+    settings: Annotated[Settings, Depends(get_settings)],
     # responses={401: {}}
 ) -> Any:
-    return image_service.get_thumbnail(image_id, scale)
+    return await image_service.run_sync(
+        image_service.get_thumbnail, image_id, scale, request, settings
+    )
+
+
+@router.get(
+    "/{image_id}/similar",
+    responses={
+        400: {"description": "Image has no perceptual hash"},
+        404: {"description": "Image not found"},
+    },
+    response_model=list[ImageURL],
+    tags=["images"],
+)
+async def get_similar_images(
+    image_id: foreign_key,
+    image_service: Annotated[ImageService, Depends(get_image_service)],
+    max_distance: Annotated[int, Query(ge=0, le=HASH_BITS)] = 10,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+) -> Any:
+    return await image_service.run_sync(image_service.get_similar, image_id, max_distance, limit)
 
 
 @router.get(
@@ -247,8 +314,8 @@ async def get_image_as_base64(
     image_id: foreign_key,
     image_service: Annotated[ImageService, Depends(get_image_service)],
 ) -> Any:
-    return image_service.get_as_base64(image_id)
-    return image_service.get_as_base64(image_id)
+    return await image_service.run_sync(image_service.get_as_base64, image_id)
+    return await image_service.run_sync(image_service.get_as_base64, image_id)
 
 
 @router.patch("/{image_id}/collection", response_model=Image, tags=["images"])
@@ -258,7 +325,7 @@ async def add_to_collection(
     image_service: Annotated[ImageService, Depends(get_image_service)],
     # current_user: CurrentActiveUser,
 ) -> models.Image:
-    return image_service.add_to_collection(image_id, collection_id)
+    return await image_service.run_sync(image_service.add_to_collection, image_id, collection_id)
 
 
 @router.delete("/{image_id}/collection", response_model=Image, tags=["images"])
@@ -268,4 +335,6 @@ async def remove_from_collection(
     image_service: Annotated[ImageService, Depends(get_image_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Image]:
-    return image_service.remove_from_collection(image_id, collection_id)
+    return await image_service.run_sync(
+        image_service.remove_from_collection, image_id, collection_id
+    )
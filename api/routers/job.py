@@ -0,0 +1,70 @@
+from typing import Any, Optional
+
+from fastapi import Depends
+from fastapi.routing import APIRouter
+from fastapi_pagination.cursor import CursorPage, CursorParams
+from typing_extensions import Annotated
+
+import api.models as models
+from api.schemas import Job, JobStats
+from api.services import JobService, get_job_service
+from api.utils.pagination import Page
+from core.db import foreign_key
+
+router = APIRouter(prefix="/job")
+
+
+@router.get("/", response_model=Page[Job], tags=["jobs"])
+async def list_jobs(
+    job_service: Annotated[JobService, Depends(get_job_service)],
+    status: Optional[models.JobStatus] = None,
+    image_id: Optional[foreign_key] = None,
+) -> Any:
+    "Most recent first"
+    return await job_service.run_sync(job_service.get_jobs, status, image_id)
+
+
+@router.get("/cursor", response_model=CursorPage[Job], tags=["jobs"])
+async def list_jobs_by_cursor(
+    job_service: Annotated[JobService, Depends(get_job_service)],
+    params: Annotated[CursorParams, Depends()],
+    status: Optional[models.JobStatus] = None,
+    image_id: Optional[foreign_key] = None,
+) -> Any:
+    "Most recent first, a page at a time: pass next_page as the cursor for the page after"
+    return await job_service.run_sync(job_service.get_jobs_by_cursor, params, status, image_id)
+
+
+@router.get("/stats", response_model=JobStats, tags=["jobs"])
+async def get_job_stats(
+    job_service: Annotated[JobService, Depends(get_job_service)],
+) -> JobStats:
+    "Number of jobs in each state"
+    return await job_service.run_sync(job_service.stats)
+
+
+@router.get(
+    "/{job_id}",
+    response_model=Job,
+    responses={404: {"description": "Job not found"}},
+    tags=["jobs"],
+)
+async def get_job(
+    job_id: foreign_key,
+    job_service: Annotated[JobService, Depends(get_job_service)],
+) -> models.Job:
+    return await job_service.aget(job_id)
+
+
+@router.post(
+    "/{job_id}/retry",
+    response_model=Job,
+    responses={404: {"description": "Job not found"}, 409: {"description": "Job is not dead"}},
+    tags=["jobs"],
+)
+async def retry_job(
+    job_id: foreign_key,
+    job_service: Annotated[JobService, Depends(get_job_service)],
+) -> models.Job:
+    "Put a dead-lettered job back on the queue"
+    return await job_service.run_sync(job_service.retry, job_id)
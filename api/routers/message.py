@@ -2,16 +2,24 @@ from typing import Any, Optional
 
 from fastapi import Depends, Response
 from fastapi.routing import APIRouter
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from typing_extensions import Annotated
 
 import api.models as models
-from api.schemas import Message, MessageCreate, MessageFilter, MessageSortBy, MessageUpdate
+from api.schemas import (
+    Message,
+    MessageCreate,
+    MessageFilter,
+    MessageSortBy,
+    MessageUpdate,
+    MessageUpdateID,
+)
 
 # from api.db.schemas.filters import MessageFilter, generate_filter_query
 # from api.deps import CurrentActiveUser
 from api.services import MessageService, get_message_service
 from api.utils.filters import generate_filter_query, generate_sort_query
+from api.utils.pagination import Page
 from core.db import foreign_key
 
 router = APIRouter(prefix="/message")
@@ -27,7 +35,19 @@ async def list_messages(
     "Get all messages"
     q = generate_filter_query(models.Message, message_filter)
     q = generate_sort_query(q, models.Message, sort_by)
-    return message_service.get_some(q)
+    return await message_service.aget_some(q)
+
+
+@router.get("/cursor", response_model=CursorPage[Message], tags=["messages"])
+async def list_messages_by_cursor(
+    message_service: Annotated[MessageService, Depends(get_message_service)],
+    message_filter: Annotated[MessageFilter, Depends()],
+    sort_by: Annotated[MessageSortBy, Depends()],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.Message]:
+    "Get all messages, a page at a time: pass next_page as the cursor for the page after"
+    q = generate_filter_query(models.Message, message_filter)
+    return await message_service.aget_some_by_cursor(q, sort_by, params)
 
 
 @router.get("/random/", response_model=Message, tags=["messages"])
@@ -35,7 +55,53 @@ async def get_random_messages(
     message_service: Annotated[MessageService, Depends(get_message_service)],
 ) -> models.Message:
     "Get all messages"
-    return message_service.get_random()
+    return await message_service.run_sync(message_service.get_random)
+
+
+@router.post(
+    "/bulk",
+    response_model=list[foreign_key],
+    status_code=201,
+    responses={409: {"description": "Conflict Error, for each item that caused one"}},
+    tags=["messages"],
+)
+async def create_messages(
+    messages: list[MessageCreate],
+    message_service: Annotated[MessageService, Depends(get_message_service)],
+) -> list[int]:
+    "Create many messages at once, all or none of them. Returns their ids in order"
+    return await message_service.acreate_many(messages)
+
+
+@router.patch(
+    "/bulk",
+    response_model=list[foreign_key],
+    responses={
+        404: {"description": "Message not found, for each missing id"},
+        409: {"description": "Conflict Error, for each item that caused one"},
+    },
+    tags=["messages"],
+)
+async def update_messages(
+    messages: list[MessageUpdateID],
+    message_service: Annotated[MessageService, Depends(get_message_service)],
+) -> list[int]:
+    "Update many messages at once, all or none of them"
+    return await message_service.aupdate_many(messages)
+
+
+@router.delete(
+    "/bulk",
+    responses={404: {"description": "Message not found, for each missing id"}},
+    tags=["messages"],
+)
+async def delete_messages(
+    message_ids: list[foreign_key],
+    message_service: Annotated[MessageService, Depends(get_message_service)],
+) -> Any:
+    "Delete many messages at once, all or none of them"
+    await message_service.adelete_many(message_ids)
+    return Response(status_code=204)
 
 
 @router.get(
@@ -50,7 +116,7 @@ async def get_message(
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Message]:
     "Get a single message by id"
-    return message_service.get(message_id)
+    return await message_service.aget(message_id)
 
 
 @router.post(
@@ -66,7 +132,7 @@ async def create_message(
     # current_user: CurrentActiveUser,
 ) -> models.Message:
     "Create a new message"
-    return message_service.create(message)
+    return await message_service.acreate(message)
 
 
 @router.patch("/{message_id}", response_model=Message, tags=["messages"])
@@ -76,7 +142,7 @@ async def update_message(
     message_service: Annotated[MessageService, Depends(get_message_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Message]:
-    return message_service.update(message_id, message)
+    return await message_service.aupdate(message_id, message)
 
 
 @router.delete("/{message_id}", tags=["messages"])  # , status_code=204)
@@ -85,5 +151,5 @@ async def delete_message(
     message_service: Annotated[MessageService, Depends(get_message_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    message_service.delete(message_id)
+    await message_service.adelete(message_id)
     return Response(status_code=204)
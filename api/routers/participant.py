@@ -2,7 +2,7 @@ from typing import Any, Optional
 
 from fastapi import Depends, Response
 from fastapi.routing import APIRouter
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from typing_extensions import Annotated
 
 import api.models as models
@@ -10,19 +10,64 @@ from api.schemas import (
     Participant,
     ParticipantCreate,
     ParticipantUpdate,
+    ParticipantUpdateID,
+    SortBy,
 )
 from api.services import ParticipantService, get_participant_service
+from api.utils.pagination import Page
 from core.db import foreign_key
 
 router = APIRouter(prefix="/participant")
 
+LIST_LOAD = ("combat:raise", "entity:raise", "image:raise")
+
 
 @router.get("/", response_model=Page[Participant], tags=["participants"])
 async def list_participants(
     participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
 ) -> Page[models.Participant]:
     "Get all participants"
-    return participant_service.get_all()
+    return await participant_service.aget_all(load=LIST_LOAD)
+
+
+@router.get("/cursor", response_model=CursorPage[Participant], tags=["participants"])
+async def list_participants_by_cursor(
+    participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.Participant]:
+    "Get all participants, a page at a time: pass next_page as the cursor for the page after"
+    return await participant_service.aget_some_by_cursor(None, SortBy(), params, LIST_LOAD)
+
+
+@router.patch(
+    "/bulk",
+    response_model=list[foreign_key],
+    responses={
+        404: {"description": "Participant not found, for each missing id"},
+        409: {"description": "Conflict Error, for each item that caused one"},
+    },
+    tags=["participants"],
+)
+async def update_participants(
+    participants: list[ParticipantUpdateID],
+    participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
+) -> list[int]:
+    "Update many participants at once, all or none of them"
+    return await participant_service.aupdate_many(participants)
+
+
+@router.delete(
+    "/bulk",
+    responses={404: {"description": "Participant not found, for each missing id"}},
+    tags=["participants"],
+)
+async def delete_participants(
+    participant_ids: list[foreign_key],
+    participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
+) -> Any:
+    "Delete many participants at once, all or none of them"
+    await participant_service.adelete_many(participant_ids)
+    return Response(status_code=204)
 
 
 @router.get(
@@ -36,7 +81,7 @@ async def get_participant(
     participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
 ) -> Optional[models.Participant]:
     "Get a single participant by id"
-    return participant_service.get(participant_id)
+    return await participant_service.aget(participant_id)
 
 
 @router.post(
@@ -51,7 +96,7 @@ async def create_participant(
     participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
 ) -> models.Participant:
     "Create a new participant"
-    return participant_service.create(participant)
+    return await participant_service.acreate(participant)
 
 
 @router.patch("/{participant_id}", response_model=Participant, tags=["participants"])
@@ -60,7 +105,7 @@ async def update_participant(
     participant: ParticipantUpdate,
     participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
 ) -> models.Participant:
-    return participant_service.update(participant_id, participant)
+    return await participant_service.aupdate(participant_id, participant)
 
 
 @router.delete("/{participant_id}", tags=["participants"])
@@ -68,5 +113,5 @@ async def delete_participant(
     participant_id: foreign_key,
     participant_service: Annotated[ParticipantService, Depends(get_participant_service)],
 ) -> Any:
-    participant_service.delete(participant_id)
+    await participant_service.adelete(participant_id)
     return Response(status_code=204)
@@ -1,19 +1,30 @@
 from typing import Any, Optional
 
 from fastapi import APIRouter, Depends, Response
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from sqlalchemy import select
 from typing_extensions import Annotated
 
 import api.models as models
-from api.schemas import RollTableCreate, RollTableDB, RollTableRowCreateInTable, RollTableUpdate
+from api.schemas import (
+    RollTableCreate,
+    RollTableDB,
+    RollTableRowCreateInTable,
+    RollTableUpdate,
+    SortBy,
+)
 
 # from api.db.schemas.filters import RollTableFilter, generate_filter_query
 # from api.deps import CurrentActiveUser
 from api.services import RollTableService, get_rolltable_service
+from api.utils.filters import loaded_tables
+from api.utils.pagination import Page
+from api.utils.response_cache import cache_responses
 from core.db import foreign_key
 
 router = APIRouter(prefix="/rolltable")
+# Polled by clients and rarely changed, see api.utils.response_cache
+cache_responses(router, loaded_tables(models.RollTable, RollTableService.eager_load), store=True)
 
 
 @router.get("/", response_model=Page[RollTableDB], tags=["rolltables"])
@@ -25,7 +36,16 @@ async def list_rolltables(
     "Get all rolltables"
     # q = generate_filter_query(models.RollTable, rolltable_filter)
     q = select(models.RollTable)
-    return rolltable_service.get_some(q)  # , transformer=build_transformer(router))
+    return await rolltable_service.aget_some(q)  # , transformer=build_transformer(router))
+
+
+@router.get("/cursor", response_model=CursorPage[RollTableDB], tags=["rolltables"])
+async def list_rolltables_by_cursor(
+    rolltable_service: Annotated[RollTableService, Depends(get_rolltable_service)],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.RollTable]:
+    "Get all rolltables, a page at a time: pass next_page as the cursor for the page after"
+    return await rolltable_service.aget_some_by_cursor(None, SortBy(), params)
 
 
 # @router.get("/orphans", tags=["rolltables"])
@@ -47,7 +67,7 @@ async def get_rolltable(
     # current_user: CurrentActiveUser,
 ) -> models.RollTable:
     "Get a single rolltable by id"
-    return rolltable_service.get(rolltable_id)
+    return await rolltable_service.aget(rolltable_id)
 
 
 @router.post(
@@ -63,7 +83,7 @@ async def create_rolltable(
     # current_user: CurrentActiveUser,
 ) -> models.RollTable:
     "Create a new rolltable"
-    return rolltable_service.create(rolltable)
+    return await rolltable_service.acreate(rolltable)
 
 
 @router.delete("/{rolltable_id}", tags=["rolltables"])  # , status_code=204)
@@ -72,7 +92,7 @@ async def delete_rolltable(
     rolltable_service: Annotated[RollTableService, Depends(get_rolltable_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    rolltable_service.delete(rolltable_id)
+    await rolltable_service.adelete(rolltable_id)
     return Response(status_code=204)
 
 
@@ -83,7 +103,7 @@ async def update_rolltable(
     rolltable_service: Annotated[RollTableService, Depends(get_rolltable_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.RollTable]:
-    return rolltable_service.update(rolltable_id, rolltable)
+    return await rolltable_service.aupdate(rolltable_id, rolltable)
 
 
 @router.post("/{rolltable_id}/row/add", response_model=RollTableDB, tags=["rolltables"])
@@ -92,7 +112,9 @@ async def create_row_on_rolltable(
     rolltable_row: RollTableRowCreateInTable,
     rolltable_service: Annotated[RollTableService, Depends(get_rolltable_service)],
 ) -> models.RollTable:
-    return rolltable_service.add_row_to_table(rolltable_id, rolltable_row)
+    return await rolltable_service.run_sync(
+        rolltable_service.add_row_to_table, rolltable_id, rolltable_row
+    )
 
 
 @router.delete("/row/{rolltable_row_id}/remove", response_model=RollTableDB, tags=["rolltables"])
@@ -100,5 +122,5 @@ async def delete_row_from_rolltable(
     rolltable_row_id: foreign_key,
     rolltable_service: Annotated[RollTableService, Depends(get_rolltable_service)],
 ):
-    rolltable_service.delete(rolltable_row_id)
+    await rolltable_service.adelete(rolltable_row_id)
     return Response(status_code=204)
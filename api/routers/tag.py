@@ -1,24 +1,30 @@
 from typing import Any, Optional, Sequence
 
 from fastapi import APIRouter, Depends, Response
-from fastapi_pagination import Page
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from typing_extensions import Annotated
 
 import api.models as models
 from api.schemas import (
+    SortBy,
     Tag,
     TagCreate,
     TagFilter,
     TagUpdate,
+    TagUpdateID,
 )
 
 # from api.db.schemas.filters import TagFilter, generate_filter_query
 # from api.deps import CurrentActiveUser
 from api.services import TagService, get_tag_service
-from api.utils.filters import generate_filter_query
+from api.utils.filters import generate_filter_query, loaded_tables
+from api.utils.pagination import Page
+from api.utils.response_cache import cache_responses
 from core.db import foreign_key
 
 router = APIRouter(prefix="/tag")
+# Polled by clients and rarely changed, see api.utils.response_cache. /orphans reads image_tags
+cache_responses(router, loaded_tables(models.Tag, ()) | {models.image_tags.name}, store=True)
 
 
 @router.get("/", response_model=Page[Tag], tags=["tags"])
@@ -29,14 +35,71 @@ async def list_tags(
 ) -> Page[models.Tag]:
     "Get all tags"
     q = generate_filter_query(models.Tag, tag_filter)
-    return tag_service.get_some(q)
+    return await tag_service.aget_some(q)
+
+
+@router.get("/cursor", response_model=CursorPage[Tag], tags=["tags"])
+async def list_tags_by_cursor(
+    tag_service: Annotated[TagService, Depends(get_tag_service)],
+    tag_filter: Annotated[TagFilter, Depends()],
+    params: Annotated[CursorParams, Depends()],
+) -> CursorPage[models.Tag]:
+    "Get all tags, a page at a time: pass next_page as the cursor for the page after"
+    q = generate_filter_query(models.Tag, tag_filter)
+    return await tag_service.aget_some_by_cursor(q, SortBy(), params)
 
 
 @router.get("/orphans", tags=["tags"])
 async def get_orphan_tags(
     tag_service: Annotated[TagService, Depends(get_tag_service)]
 ) -> Sequence[Tag]:
-    return tag_service.get_orphan_tags()  # type: ignore
+    return await tag_service.run_sync(tag_service.get_orphan_tags)  # type: ignore
+
+
+@router.post(
+    "/bulk",
+    response_model=list[foreign_key],
+    status_code=201,
+    responses={409: {"description": "Conflict Error, for each item that caused one"}},
+    tags=["tags"],
+)
+async def create_tags(
+    tags: list[TagCreate],
+    tag_service: Annotated[TagService, Depends(get_tag_service)],
+) -> list[int]:
+    "Create many tags at once, all or none of them. Returns their ids in order"
+    return await tag_service.acreate_many(tags)
+
+
+@router.patch(
+    "/bulk",
+    response_model=list[foreign_key],
+    responses={
+        404: {"description": "Tag not found, for each missing id"},
+        409: {"description": "Conflict Error, for each item that caused one"},
+    },
+    tags=["tags"],
+)
+async def update_tags(
+    tags: list[TagUpdateID],
+    tag_service: Annotated[TagService, Depends(get_tag_service)],
+) -> list[int]:
+    "Update many tags at once, all or none of them"
+    return await tag_service.aupdate_many(tags)
+
+
+@router.delete(
+    "/bulk",
+    responses={404: {"description": "Tag not found, for each missing id"}},
+    tags=["tags"],
+)
+async def delete_tags(
+    tag_ids: list[foreign_key],
+    tag_service: Annotated[TagService, Depends(get_tag_service)],
+) -> Any:
+    "Delete many tags at once, all or none of them"
+    await tag_service.adelete_many(tag_ids)
+    return Response(status_code=204)
 
 
 @router.get(
@@ -51,7 +114,7 @@ async def get_tag(
     # current_user: CurrentActiveUser,
 ) -> models.Tag:
     "Get a single tag by id"
-    return tag_service.get(tag_id)
+    return await tag_service.aget(tag_id)
 
 
 @router.post(
@@ -67,7 +130,7 @@ async def create_tag(
     # current_user: CurrentActiveUser,
 ) -> models.Tag:
     "Create a new tag"
-    return tag_service.create(tag)
+    return await tag_service.acreate(tag)
 
 
 @router.patch("/{tag_id}", response_model=Tag, tags=["tags"])
@@ -77,7 +140,7 @@ async def update_tag(
     tag_service: Annotated[TagService, Depends(get_tag_service)],
     # current_user: CurrentActiveUser,
 ) -> Optional[models.Tag]:
-    return tag_service.update(tag_id, tag)
+    return await tag_service.aupdate(tag_id, tag)
 
 
 @router.delete("/{tag_id}", tags=["tags"])  # , status_code=204)
@@ -86,7 +149,7 @@ async def delete_tag(
     tag_service: Annotated[TagService, Depends(get_tag_service)],
     # current_user: CurrentActiveUser,
 ) -> Any:
-    tag_service.delete(tag_id)
+    await tag_service.adelete(tag_id)
     return Response(status_code=204)
 
 
@@ -96,5 +159,5 @@ async def merge_tags(
     tag2_id: foreign_key,
     tag_service: Annotated[TagService, Depends(get_tag_service)],
 ):
-    tag_service.merge(tag_id, tag2_id)
+    await tag_service.run_sync(tag_service.merge, tag_id, tag2_id)
     return Response(status_code=204)
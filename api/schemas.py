@@ -4,7 +4,8 @@ from typing import Annotated, Literal, Optional
 from pydantic import BaseModel, ConfigDict, StringConstraints, ValidationError, model_validator
 from typing_extensions import Self
 
-from api.models import ImageType
+from api.models import ImageType, JobStatus, JobType
+from api.utils.image_helper import DEFAULT_THUMBNAIL_WIDTH
 from core.db import foreign_key
 
 
@@ -195,6 +196,12 @@ class TagUpdate(TagBase):
     ...
 
 
+class TagUpdateID(TagUpdate):
+    """Properties to receive on a bulk update, which does need the id"""
+
+    id: foreign_key
+
+
 class TagInDB(TagBase):
     """Properties shared by models stored in DB - !exposed in create/update."""
 
@@ -280,6 +287,10 @@ class EntityUpdate(EntityBase):
     source_page: Optional[int] = None
 
 
+class EntityUpdateID(EntityUpdate):
+    id: foreign_key
+
+
 class EntityCreate(EntityBase):
     ...
 
@@ -357,6 +368,7 @@ class Image(ImageCreate):
     palette: Optional[str] = ""
     entities: list["EntityByID"] = []
     seq: Optional[str] = None
+    mime_type: Optional[str] = None
 
     model_config = ConfigDict(
         from_attributes=True, alias_generator=image_alias, populate_by_name=True
@@ -428,7 +440,7 @@ class ImageScale(BaseModel):
         if (self.width or self.height) and self.scale:  # Given width/height and scale
             raise ValidationError
         if not (self.width and self.height and self.scale):
-            self.width = 400
+            self.width = DEFAULT_THUMBNAIL_WIDTH
         return self
 
 
@@ -467,6 +479,10 @@ class MessageUpdate(MessageBase):
     ...
 
 
+class MessageUpdateID(MessageUpdate):
+    id: foreign_key
+
+
 class MessageCreate(MessageBase):
     ...
 
@@ -479,6 +495,43 @@ class Message(MessageBase):
     )
 
 
+########################## Jobs
+job_alias = camel_alias_generator("job")
+
+
+class JobBase(BaseModel):
+    type: JobType
+    image_id: Optional[foreign_key] = None
+    model_config = ConfigDict(alias_generator=job_alias, populate_by_name=True)
+
+
+class JobCreate(JobBase):
+    ...
+
+
+class JobUpdate(BaseModel):
+    ...
+
+
+class Job(JobBase):
+    id: foreign_key
+    status: JobStatus
+    attempts: int
+    run_after: float
+    leased_until: Optional[float] = None
+    error: Optional[str] = None
+    model_config = ConfigDict(
+        from_attributes=True, alias_generator=job_alias, populate_by_name=True
+    )
+
+
+class JobStats(BaseModel):
+    queued: int = 0
+    running: int = 0
+    done: int = 0
+    dead: int = 0
+
+
 ########################## Participant
 participant_alias = camel_alias_generator("participant")
 
@@ -9,6 +9,7 @@ from .collection import CollectionService
 from .combat import CombatService
 from .entity import EntityService
 from .image import ImageService
+from .job import JobService
 from .message import MessageService
 from .participant import ParticipantService
 from .rolltable import RollTableRowService, RollTableService
@@ -25,6 +26,10 @@ def get_image_service(db_session: Annotated[Session, Depends(get_session)]) -> I
     return ImageService(db_session)
 
 
+def get_job_service(db_session: Annotated[Session, Depends(get_session)]) -> JobService:
+    return JobService(db_session)
+
+
 def get_message_service(db_session: Annotated[Session, Depends(get_session)]) -> MessageService:
     return MessageService(db_session)
 
@@ -1,49 +1,231 @@
-from typing import Any, Generic, Optional, Type, TypeVar
+import pickle
+from contextlib import nullcontext
+from copy import copy
+from typing import Any, Callable, Generic, Hashable, Optional, Sequence, Type, TypeVar
 
-from fastapi import HTTPException
-from fastapi_pagination import Page
-from fastapi_pagination.ext.sqlalchemy import paginate
+from fastapi import HTTPException, Response
+from fastapi_pagination.bases import AbstractPage
+from fastapi_pagination.cursor import CursorPage, CursorParams
 from pydantic import BaseModel
-from sqlalchemy import Select, delete, func, select
+from sqlalchemy import Select, delete, func, insert, inspect, select, update
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
+from api.schemas import SortBy
+from api.utils.filters import (
+    Load,
+    generate_keyset_query,
+    has_loader_options,
+    loaded_relationships,
+    loader_options,
+    make_cursor,
+    read_cursor,
+)
+from api.utils.object_cache import MISSING, get_object_cache
+from api.utils.pagination import Page, paginate, paginate_rows
+from api.utils.rows import row_serializer
+from api.utils.sampler import RandomSampler, get_sampler
+from config import get_settings
 from core.db import Base
+from core.events import uncommitted_tables
 
 ModelType = TypeVar("ModelType", bound=Base)
 CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 UpdateSchemaType = TypeVar("UpdateSchemaType", bound=BaseModel)
+T = TypeVar("T")
 
 
 class BaseService(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
-    def __init__(self, model: Type[ModelType], db_session: Session):
+    # Relationships that the response schemas read, as paths like "images.tags" (see
+    # loader_options). They're loaded with the rows, as an AsyncSession can't lazy load while a
+    # response is being serialized. Routes that read something else pass their own load.
+    eager_load: Load = ()
+
+    def __init__(self, model: Type[ModelType], db_session: Session | AsyncSession):
         self.model = model
         self.db_session = db_session
 
+    async def run_sync(self, method: Callable[..., T], *args, **kwargs) -> T:
+        """Call one of this service's methods, e.g. await service.run_sync(service.get, id). With
+        an AsyncSession the method runs against its Session in a greenlet, so every query it makes
+        is awaited rather than blocking the event loop. With a Session it's just called."""
+        if not isinstance(self.db_session, AsyncSession):
+            return method(*args, **kwargs)
+
+        def call(sync_session: Session) -> T:
+            service = copy(self)
+            service.db_session = sync_session
+            result = method.__func__(service, *args, **kwargs)  # type: ignore
+            service.load_eager(result)
+            return result
+
+        return await self.db_session.run_sync(call)
+
+    def load_eager(self, result: Any) -> None:
+        """Load eager_load for the instances of the model in result that didn't come from eager(),
+        e.g. objects that have just been created"""
+        if isinstance(result, AbstractPage):
+            result = result.items
+        objs = result if isinstance(result, (list, tuple)) else [result]
+        names = loaded_relationships(self.eager_load)
+        ids = [
+            obj.id for obj in objs if isinstance(obj, self.model) and names & inspect(obj).unloaded
+        ]
+        if ids:
+            q = self.eager(select(self.model).where(self.model.id.in_(ids)))
+            self.db_session.scalars(q).all()
+
+    async def aget(self, id: Any) -> ModelType:
+        return await self.run_sync(self.get, id)
+
+    async def aget_all(self, load: Optional[Load] = None) -> Page[ModelType]:
+        return await self.run_sync(self.get_all, load)
+
+    async def aget_some(
+        self, q: Optional[Select] = None, transformer=None, load: Optional[Load] = None
+    ) -> Page[ModelType]:
+        return await self.run_sync(self.get_some, q, transformer, load)
+
+    async def aget_some_json(self, q: Optional[Select], schema: Type[BaseModel]) -> Response:
+        return await self.run_sync(self.get_some_json, q, schema)
+
+    async def aget_some_by_cursor(
+        self,
+        q: Optional[Select],
+        order: SortBy,
+        params: CursorParams,
+        load: Optional[Load] = None,
+    ) -> CursorPage[ModelType]:
+        return await self.run_sync(self.get_some_by_cursor, q, order, params, load)
+
+    async def acreate(self, obj: CreateSchemaType) -> ModelType:
+        return await self.run_sync(self.create, obj)
+
+    async def aupdate(self, id: Any, obj: UpdateSchemaType) -> ModelType:
+        return await self.run_sync(self.update, id, obj)
+
+    async def adelete(self, id: Any) -> None:
+        return await self.run_sync(self.delete, id)
+
+    async def acreate_many(self, objs: Sequence[CreateSchemaType]) -> list[Any]:
+        return await self.run_sync(self.create_many, objs)
+
+    async def aupdate_many(self, objs: Sequence[UpdateSchemaType]) -> list[Any]:
+        return await self.run_sync(self.update_many, objs)
+
+    async def adelete_many(self, ids: Sequence[Any]) -> None:
+        return await self.run_sync(self.delete_many, ids)
+
+    def eager(self, q: Select, load: Optional[Load] = None) -> Select:
+        "q, loading load (by default eager_load) with the rows"
+        return q.options(*loader_options(self.model, self.eager_load if load is None else load))
+
+    def cached(self, key: Hashable, load: Callable[[], T]) -> T:
+        """load(), or what it returned for key before if nothing it read has changed since (see
+        api.utils.object_cache). An instance of the model is cached detached, and merged into this
+        session without a query when it's read back. Any other value must not be modified."""
+        cache = get_object_cache(self.model, self.eager_load)
+        session = self.db_session
+        if (
+            cache is None
+            or session.new
+            or session.dirty
+            or session.deleted
+            or uncommitted_tables(session) & cache.tables  # type: ignore
+        ):
+            return load()  # Only this session can see its own changes, or they'd be merged over
+        value = cache.get(key)
+        if value is MISSING:
+            value = load()
+            if isinstance(value, self.model):
+                cache.put(key, pickle.loads(pickle.dumps(value)), value.id)  # A detached copy
+            else:
+                cache.put(key, value)
+            return value
+        if isinstance(value, self.model):
+            if inspect(value).key in session.identity_map:
+                return load()  # Already loaded here, perhaps without eager_load
+            return session.merge(value, load=False)
+        return value
+
     def get(self, id: Any) -> ModelType:
-        query = select(self.model).where(self.model.id == id)
+        return self.cached(("id", id), lambda: self.get_uncached(id))
+
+    def get_uncached(self, id: Any) -> ModelType:
+        query = self.eager(select(self.model).where(self.model.id == id))
         obj: Optional[ModelType] = self.db_session.scalar(query)
         if obj is None:
             raise HTTPException(status_code=404, detail=f"{self.model.__name__} Not Found")
         return obj
 
-    def get_all(self) -> Page[ModelType]:
+    def get_all(self, load: Optional[Load] = None) -> Page[ModelType]:
         query = select(self.model)  # .order_by(self.model.id.desc())
-        return paginate(self.db_session, query)
+        return paginate(self.db_session, self.eager(query, load))
 
-    def get_some(self, q: Optional[Select] = None, transformer=None) -> Page[ModelType]:
+    def get_some(
+        self, q: Optional[Select] = None, transformer=None, load: Optional[Load] = None
+    ) -> Page[ModelType]:
+        "A page of q. Loads eager_load unless the route gave its own load, here or to q already"
         if q is None:
             q = select(self.model)
+        if load is not None or not has_loader_options(q):
+            q = self.eager(q, load)
         return paginate(self.db_session, q, transformer=transformer)
 
+    def get_some_json(self, q: Optional[Select], schema: Type[BaseModel]) -> Response:
+        """The same page as get_some, already serialized as schema. Read only, as it selects the
+        schema's columns (see api.utils.rows) rather than loading instances of the model, which
+        makes it several times faster for a full page. Any loader options on q are ignored."""
+        if q is None:
+            q = select(self.model)
+        return paginate_rows(self.db_session, q, row_serializer(self.model, schema))
+
+    def get_some_by_cursor(
+        self,
+        q: Optional[Select],
+        order: SortBy,
+        params: CursorParams,
+        load: Optional[Load] = None,
+    ) -> CursorPage[ModelType]:
+        """A page of q in the given order, starting after params.cursor. Unlike get_some, it costs
+        the same however deep the page is, as there's no OFFSET to count through and no total"""
+        if q is None:
+            q = select(self.model)
+        if load is not None or not has_loader_options(q):
+            q = self.eager(q, load)
+        after = read_cursor(params.cursor, order)
+        q = generate_keyset_query(q, self.model, order, after).limit(params.size + 1)
+        rows = self.db_session.execute(q).all()
+        next_ = None
+        if len(rows) > params.size:
+            rows = rows[: params.size]
+            next_ = make_cursor(order, rows[-1].sort_key, rows[-1][0].id)
+        return CursorPage.create([row[0] for row in rows], params, next_=next_)
+
     def get_random(self) -> ModelType:
         # return self.db_session.scalar(select(Image).where(*conditions).order_by(func.random()))
-        q = select(self.model).order_by(func.random())
-        obj: Optional[ModelType] = self.db_session.scalar(q)
+        obj = self.get_random_from(get_sampler(self.model))
         if obj is None:
-            raise HTTPException(status_code=404, detail=f"{ModelType.__name__} Not Found")
+            raise HTTPException(status_code=404, detail=f"{self.model.__name__} Not Found")
         return obj
 
+    def get_random_from(
+        self, sampler: RandomSampler, key: Hashable = None, attempts: int = 3
+    ) -> Optional[ModelType]:
+        "Pick a random row from a sampler's pool, skipping ids deleted behind the sampler's back"
+        for _ in range(attempts):
+            id = sampler.choice(self.db_session, key)
+            if id is None:
+                return None
+            if (obj := self.db_session.get(self.model, id)) is not None:
+                return obj
+            sampler.discard(id)
+        q = select(self.model).order_by(func.random())  # The pool is badly out of date
+        if sampler.partition_by is not None:
+            q = q.where(getattr(self.model, sampler.partition_by) == key)
+        return self.db_session.scalar(q)
+
     def create(self, obj: CreateSchemaType) -> ModelType:
         db_obj: ModelType = self.model(**obj.model_dump())
         self.db_session.add(db_obj)
@@ -93,3 +275,76 @@ class BaseService(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             self.db_session.commit()
         except IntegrityError:
             self.db_session.rollback()
+
+    def create_many(self, objs: Sequence[CreateSchemaType]) -> list[Any]:
+        """Create every one of objs in one transaction, with an executemany INSERT rather than a
+        flush and commit each. Returns their ids, in the same order. If any of them can't be
+        created none of them are, and the 409 lists which (see run_bulk)."""
+        self.check_bulk_size(objs)
+        rows = [obj.model_dump() for obj in objs]
+        q = insert(self.model).returning(self.model.id, sort_by_parameter_order=True)
+        return self.run_bulk(lambda rows: self.db_session.scalars(q, rows).all(), rows)
+
+    def update_many(self, objs: Sequence[UpdateSchemaType]) -> list[Any]:
+        """Update each of objs, which have the id of the row they're for, in one transaction with
+        an executemany UPDATE. Only the fields that are set are written. Returns the ids."""
+        self.check_bulk_size(objs)
+        rows = [obj.model_dump(exclude_unset=True) | {"id": obj.id} for obj in objs]  # type: ignore
+        self.check_exist([row["id"] for row in rows])
+        rows = [row for row in rows if len(row) > 1]  # Nothing to set
+        if rows:
+            self.run_bulk(lambda rows: self.db_session.execute(update(self.model), rows), rows)
+        else:
+            self.db_session.commit()
+        return [obj.id for obj in objs]  # type: ignore
+
+    def delete_many(self, ids: Sequence[Any]) -> None:
+        "Delete the rows with ids in one transaction. Unlike delete, a missing id is a 404"
+        self.check_bulk_size(ids)
+        self.check_exist(ids)
+        self.run_bulk(
+            lambda ids: self.db_session.execute(delete(self.model).where(self.model.id.in_(ids))),
+            list(ids),
+        )
+
+    def check_bulk_size(self, items: Sequence[Any]) -> None:
+        limit = get_settings().BULK_MAX_ITEMS
+        if len(items) > limit:
+            raise HTTPException(status_code=413, detail=f"At most {limit} items at a time")
+
+    def check_exist(self, ids: Sequence[Any]) -> None:
+        "404, listing the index and id of each of ids with no row"
+        q = select(self.model.id).where(self.model.id.in_(set(ids)))
+        found = set(self.db_session.scalars(q))
+        missing = [
+            {"index": index, "id": id, "detail": f"{self.model.__name__} Not Found"}
+            for index, id in enumerate(ids)
+            if id not in found
+        ]
+        if missing:
+            self.db_session.rollback()
+            raise HTTPException(status_code=404, detail=missing)
+
+    def run_bulk(self, run: Callable[[list[Any]], T], items: list[Any]) -> T:
+        """run(items) and commit. If that breaks a constraint, nothing is committed: each item is
+        run on its own to find which ones did, and they're listed in a 409 with their index and
+        the database's error, e.g. two tags with the same name."""
+        try:
+            result = run(items)
+            self.db_session.commit()
+            return result
+        except IntegrityError:
+            self.db_session.rollback()
+
+        # SQLite only undoes the statement that failed, not the transaction, and pysqlite would
+        # commit an outermost SAVEPOINT when it's released, so savepoints are just for the others
+        sqlite = self.db_session.get_bind().dialect.name == "sqlite"
+        errors = []
+        for index, item in enumerate(items):
+            try:
+                with nullcontext() if sqlite else self.db_session.begin_nested():
+                    run([item])
+            except IntegrityError as e:
+                errors.append({"index": index, "detail": str(e.orig)})
+        self.db_session.rollback()
+        raise HTTPException(status_code=409, detail=errors or "Conflict Error")
@@ -12,6 +12,8 @@ from .base import BaseService
 
 
 class CollectionService(BaseService[Collection, CollectionCreate, CollectionUpdate]):
+    eager_load = ("images.tags", "images.entities")
+
     def __init__(self, db_session: Session):
         super(CollectionService, self).__init__(Collection, db_session)
 
@@ -12,6 +12,8 @@ from .base import BaseService
 
 
 class CombatService(BaseService[Combat, CombatCreate, CombatUpdate]):
+    eager_load = ("participants",)
+
     def __init__(self, db_session: Session):
         super(CombatService, self).__init__(Combat, db_session)
 
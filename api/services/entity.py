@@ -1,13 +1,14 @@
-import json
+import codecs
 from typing import Sequence
 
-from fastapi import HTTPException, Response, UploadFile, status
+from fastapi import HTTPException, UploadFile, status
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 
 from api.models import Entity
 from api.schemas import EntityCreate, EntityUpdate
-from core.utils import make_seq
+from api.utils.compendium import import_monsters, iter_json_array
 
 from .base import BaseService
 
@@ -16,21 +17,23 @@ class EntityService(BaseService[Entity, EntityCreate, EntityUpdate]):
     def __init__(self, db_session: Session):
         super(EntityService, self).__init__(Entity, db_session)
 
-    async def create_from_json(self, json_file: UploadFile):
-        data = await json_file.read()
-        creatures = json.loads(data).get("monster", [])
-        entities = []
-        seq = make_seq()
-        for creature in creatures:
-            entities.append(Entity.from_jsondata(creature, seq))
+    def create_from_json(self, json_file: UploadFile) -> dict:
+        "Import the monsters in a 5e.tools bestiary file, a batch at a time"
+        stream = codecs.getreader("utf-8")(json_file.file)
         try:
-            self.db_session.add_all(entities)
+            stats = import_monsters(self.db_session, iter_json_array(stream, "monster"))
             self.db_session.commit()
-        except Exception:
+        except (ValueError, UnicodeDecodeError):
             self.db_session.rollback()
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
-
-        return Response(status_code=200)
+        except IntegrityError:
+            self.db_session.rollback()
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Conflict Error")
+        except SQLAlchemyError:
+            self.db_session.rollback()  # Part of the file may have been written
+            raise
+        return stats.as_dict()
 
     def get_sources(self) -> Sequence[str | None]:
-        return self.db_session.scalars(select(self.model.source).distinct()).all()
+        q = select(self.model.source).distinct()
+        return list(self.cached("sources", lambda: tuple(self.db_session.scalars(q))))
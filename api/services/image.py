@@ -1,34 +1,109 @@
-from io import BytesIO
+import os
+import random
 from pathlib import Path
+from typing import Optional
 from uuid import uuid4
 
-from fastapi import HTTPException, UploadFile, status
-from fastapi.responses import FileResponse, StreamingResponse
-from fastapi_pagination import Page
-from fastapi_pagination.ext.sqlalchemy import paginate
-from PIL import Image as PImage
-from sqlalchemy import Select, delete, func, insert, select, text
-from sqlalchemy.exc import DBAPIError
+from fastapi import HTTPException, Request, Response, UploadFile, status
+from fastapi.responses import StreamingResponse
+from fastapi_pagination.api import apply_items_transformer, create_page, resolve_params
+from sqlalchemy import (
+    Connection,
+    Engine,
+    Select,
+    delete,
+    func,
+    insert,
+    literal_column,
+    select,
+    update,
+)
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
 from sqlalchemy.orm import Session
+from starlette.background import BackgroundTask
 
-from api.models import Image, Tag, image_collections, image_tags
+from api.models import Image, ImageType, JobType, Tag, image_collections, image_tags
 from api.schemas import ImageB64, ImageCreate, ImageMatchResult, ImageScale, ImageUpdate, ImageURL
-from api.utils.image_helper import calculate_thumbnail_size, get_image_as_base64
+from api.utils.delivery import file_response, sniff_mime_type
+from api.utils.derivative_cache import get_derivative_cache
+from api.utils.hash_index import hash_index
+from api.utils.image_helper import (
+    HEADER_BYTES,
+    base64_length,
+    calculate_thumbnail_size,
+    read_dimensions,
+    render_thumbnail,
+    sniff_image_header,
+    stream_base64_json,
+)
+from api.utils.pagination import Page
+from api.utils.palette_index import palette_index
+from api.utils.sampler import get_sampler
+from api.utils.search import SEARCH_TABLE, image_search, match_query, relevance
+from api.utils.tag_index import from_bitmap, page_of, tag_index, to_bitmap
+from api.utils.upload import UploadTooLarge, write_upload
 from config import Settings
+from core.colour import rgb_to_lab
+from core.phash import parse_hash
+from core.utils import hex_to_rgb
+from core.workers import run_in_process
 
 from .base import BaseService
+from .job import JobService
+
+
+def store_mime_type(bind: Engine | Connection, image_id: int, mime_type: str) -> None:
+    """Save a sniffed mime type in its own session. Best effort: if the database is busy it's
+    sniffed again the next time the image is served."""
+    with Session(bind) as db_session:
+        try:
+            q = update(Image).where(Image.id == image_id, Image.mime_type.is_(None))
+            db_session.execute(q.values(mime_type=mime_type))
+            db_session.commit()
+        except SQLAlchemyError:
+            db_session.rollback()
 
 
 class ImageService(BaseService[Image, ImageCreate, ImageUpdate]):
+    eager_load = ("tags", "entities")
+
     def __init__(self, db_session: Session):
         super(ImageService, self).__init__(Image, db_session)
 
-    def get_random(self, *conditions) -> Image:
-        model = self.db_session.scalar(select(Image).where(*conditions).order_by(func.random()))
+    def get_random(
+        self,
+        image_type: Optional[ImageType] = None,
+        tags: Optional[list[int]] = None,
+        collection_id: Optional[int] = None,
+    ) -> Image:
+        if not tags and collection_id is None:
+            if image_type is None:
+                model = self.get_random_from(get_sampler(Image))
+            else:
+                model = self.get_random_from(get_sampler(Image, "type"), image_type)
+        else:
+            candidates = self.get_ids_matching(tags, collection_id)
+            if image_type is not None:
+                pool = get_sampler(Image, "type").members(self.db_session, image_type)
+                candidates = [i for i in candidates if i in pool]
+            model = self.db_session.get(Image, random.choice(candidates)) if candidates else None
         if not model:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
         return model
 
+    def get_ids_matching(
+        self, tags: Optional[list[int]] = None, collection_id: Optional[int] = None
+    ) -> list[int]:
+        "Ids of the images with every one of tags, that are in the collection"
+        within = None
+        if collection_id is not None:
+            q = select(image_collections.c.image_id).where(
+                image_collections.c.collection_id == collection_id
+            )
+            within = to_bitmap(self.db_session.scalars(q))
+        (candidates,) = tag_index.query(self.db_session, all_of=tags or (), within=within)
+        return from_bitmap(candidates).tolist()
+
     def apply_tag(self, image_id, tag_id) -> Image:
         try:
             q = insert(image_tags).values(image_id=image_id, tag_id=tag_id)
@@ -118,84 +193,128 @@ class ImageService(BaseService[Image, ImageCreate, ImageUpdate]):
             def transformer(x):
                 return x
 
-        q = (
-            select(
-                Image,
-                image_tags.c.image_id.label("match_id"),
-                func.count(image_tags.c.image_id).label("match_count"),
-                func.aggregate_strings(image_tags.c.tag_id, ",").label("tags"),
-            )
-            .join(Image, Image.id == image_tags.c.image_id)
-            .where(image_tags.c.tag_id.in_(taglist))
-            .group_by(image_tags.c.image_id)
-            .order_by(text("match_count DESC"))
-            .limit(12)
-        )
-        results = self.db_session.execute(q).all()
-        return ImageMatchResult(
-            **{
-                "matches": [
-                    {
-                        "image": transformer(res[0]),
-                        "image_id": res[1],
-                        "match_count": res[2],
-                        "tags": res[3].split(","),
-                    }
-                    for res in results
-                ],
-                "tags": taglist,
-            }
-        )
+        layers = tag_index.query(self.db_session, any_of=taglist)
+        matches = []
+        for image in self.get_in_order(page_of(layers, 0, 12)):
+            tags = tag_index.tags_of(self.db_session, image.id, taglist)
+            matches.append(
+                {
+                    "image": transformer(image),
+                    "image_id": image.id,
+                    "match_count": len(tags),
+                    "tags": tags,
+                }
+            )
+        return ImageMatchResult(matches=matches, tags=taglist)
 
-    def get_images(self, q: Select, taglist: list[int], transformer=None) -> Page[ImageURL]:  # type: ignore
-        if q is None:
-            q = select(self.model)
-
-        s = (
-            select(Image.id, func.count(image_tags.c.image_id).label("match_count"))
-            .join(Image, Image.id == image_tags.c.image_id)
-            .where(image_tags.c.tag_id.in_(taglist))
-            .group_by(image_tags.c.image_id)
-            .order_by(text("match_count DESC"))
-            .subquery()
+    def get_images(
+        self,
+        q: Optional[Select],
+        taglist: Optional[list[int]] = None,
+        all_tags: Optional[list[int]] = None,
+        exclude_tags: Optional[list[int]] = None,
+        transformer=None,
+    ) -> Page[ImageURL]:  # type: ignore
+        """Images with at least one of taglist (those with the most first), all of all_tags and
+        none of exclude_tags. Answered from the tag index (see api.utils.tag_index), so only an
+        image filter in q, if there is one, goes to the database."""
+        within = None
+        if q is not None and q.whereclause is not None:
+            within = to_bitmap(self.db_session.scalars(q.with_only_columns(Image.id)))
+        layers = tag_index.query(
+            self.db_session, taglist or (), all_tags or (), exclude_tags or (), within
         )
+        params = resolve_params()
+        raw_params = params.to_raw_params().as_limit_offset()
+        images = self.get_in_order(page_of(layers, raw_params.offset, raw_params.limit))
+        total = sum(layer.bit_count() for layer in layers)
+        return create_page(apply_items_transformer(images, transformer), total=total, params=params)
 
-        q = q.join(s, s.c.id == Image.id)
-        return paginate(self.db_session, q, transformer=transformer)
+    def get_similar(self, image_id: int, max_distance: int, limit: int) -> list[Image]:
+        "Images whose perceptual hash is within max_distance bits of this one, nearest first"
+        image = self.get(image_id)
+        value = parse_hash(image.hash)
+        if value is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"<Image id={image_id}> has no perceptual hash. Run generate-hashes.",
+            )
+        matches = hash_index.get(self.db_session).search(value, max_distance)
+        return self.get_in_order([key for _, key in matches if key != image_id][:limit])
+
+    def search_by_colour(
+        self, hex: str, type: Optional[ImageType] = None, limit: int = 20
+    ) -> list[Image]:
+        "Images with a palette colour perceptually close to hex, closest first"
+        lab = rgb_to_lab(hex_to_rgb(hex))
+        matches = palette_index.search(self.db_session, lab, type, limit)
+        return self.get_in_order([image_id for _, image_id in matches])
 
-    def get_full_image(self, image_id: int) -> FileResponse:
+    def get_in_order(self, ids: list[int]) -> list[Image]:
+        q = self.eager(select(Image).where(Image.id.in_(ids)))
+        images = {i.id: i for i in self.db_session.scalars(q)}
+        return [images[i] for i in ids if i in images]
+
+    def get_full_image(self, image_id: int, request: Request, settings: Settings) -> Response:
         image = self.get(image_id)
+        mime_type = image.mime_type or sniff_mime_type(image.path)
         try:
-            # with open(image.path) as image_data:
-            return FileResponse(image.path, media_type="image/png")
+            response = file_response(
+                request,
+                image.path,
+                media_type=mime_type,
+                content_hash=image.hash,
+                cache_control=settings.IMAGE_CACHE_CONTROL,
+            )
         except FileNotFoundError:
             raise HTTPException(status_code=404, detail=f"<Image id={image_id}> path not found.")
         except Exception:
             raise HTTPException(status_code=500, detail="Server-side error.")
+        if image.mime_type is None and mime_type is not None:
+            # Rows from before the mime_type column are filled in once the response has been sent
+            bind = self.db_session.get_bind()
+            response.background = BackgroundTask(store_mime_type, bind, image_id, mime_type)
+        return response
 
-    def get_thumbnail(self, image_id: int, scale: ImageScale) -> StreamingResponse:
+    def get_thumbnail(
+        self, image_id: int, scale: ImageScale, request: Request, settings: Settings
+    ) -> Response:
         image = self.get(image_id)
         dimensions = calculate_thumbnail_size(
             (image.dimension_x, image.dimension_y), **scale.model_dump()
         )
+        cache = get_derivative_cache()
         try:
-            with PImage.open(image.path) as p_image:
-                p_image.thumbnail(dimensions)
-                image_io = BytesIO()
-                p_image.save(image_io, "png")
-                image_io.seek(0)
-                return StreamingResponse(image_io, media_type="image/png")
+            key = cache.make_key(image.id, image.path, dimensions, "png")
+            path = cache.get(key, "png")
+            if path is None:
+                path = cache.put(key, "png", render_thumbnail(image.path, dimensions, "png"))
+            return file_response(
+                request,
+                str(path),
+                media_type="image/png",
+                cache_control=settings.IMAGE_CACHE_CONTROL,
+            )
         except FileNotFoundError:
             raise HTTPException(status_code=404, detail=f"<Image id={image_id}> path not found.")
         except Exception:
             raise HTTPException(status_code=500, detail="Server-side error.")
 
-    def get_as_base64(self, image_id: int) -> ImageB64:
+    def get_as_base64(self, image_id: int) -> StreamingResponse:
         image = self.get(image_id)
         try:
-            setattr(image, "b64", get_image_as_base64(image.path))
-            output = ImageB64.model_validate(image)
-            return output
+            size = os.stat(image.path).st_size  # Fail now, rather than halfway through the response
+            setattr(image, "b64", None)
+            metadata = (
+                ImageB64.model_validate(image)
+                .model_dump_json(by_alias=True, exclude={"b64"})
+                .encode()
+            )
+            body = stream_base64_json(metadata, image.path)
+            length = len(metadata) + len(',"b64":""') + base64_length(size)
+            return StreamingResponse(
+                body, media_type="application/json", headers={"content-length": str(length)}
+            )
         except FileNotFoundError:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="File not found on the server."
@@ -206,24 +325,62 @@ class ImageService(BaseService[Image, ImageCreate, ImageUpdate]):
                 detail=f"An error occured. Perhaps the image path is invalid. {image.path}",
             )
 
-    async def upload_image(self, image_file: UploadFile, settings: Settings):
-        data = await image_file.read()
+    async def upload_image(self, image_file: UploadFile, settings: Settings) -> Image:
+        """Stream the upload to disk and create the row straight away. Jobs are queued to compute
+        the hash, palette and thumbnails, see api.utils.jobs"""
+        if image_file.size is not None and image_file.size > settings.MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        header = await image_file.read(HEADER_BYTES)
+        mime_type = sniff_image_header(header)
+        if mime_type is None:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail="Only PNG, JPEG, GIF, BMP and WebP images can be uploaded.",
+            )
         name = image_file.filename if image_file.filename is not None else str(uuid4())
         path = Path(settings.UPLOAD_DIR) / name
         if path.exists():
             path = path.with_stem(str(uuid4()))
-        with open(path, "wb") as f:
-            f.write(data)
-        i = Image.create_from_local_file(
-            path, calculate_palette=True, name=name
+        try:
+            await write_upload(image_file, path, header, settings.MAX_UPLOAD_SIZE)
+            (x, y) = await run_in_process(read_dimensions, path)
+        except UploadTooLarge:
+            path.unlink(missing_ok=True)
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except OSError:
+            path.unlink(missing_ok=True)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Unable to read the image."
+            )
+        try:
+            return await self.run_sync(
+                self.add_uploaded_image, path, name, (x, y), mime_type, settings
+            )
+        except Exception:
+            path.unlink(missing_ok=True)
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+
+    def add_uploaded_image(
+        self, path: Path, name: str, dimensions: tuple[int, int], mime_type: str, settings: Settings
+    ) -> Image:
+        "Create the row for an uploaded file, and queue its jobs in the same transaction"
+        (x, y) = dimensions
+        i = Image(
+            path=str(path), name=name, dimension_x=x, dimension_y=y, mime_type=mime_type
         )  # , type=ImageType.character)
         try:
             self.db_session.add(i)
+            self.db_session.flush()
+            jobs = JobService(self.db_session)
+            jobs.enqueue(JobType.hash, i.id, commit=False)
+            jobs.enqueue(JobType.palette, i.id, commit=False)
+            if settings.GENERATE_THUMBNAIL:
+                jobs.enqueue(JobType.thumbnail, i.id, commit=False)
             self.db_session.commit()
             self.db_session.refresh(i)
         except Exception:
             self.db_session.rollback()
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+            raise
         return i
 
     def favourite_image(self, image_id: int):
@@ -233,18 +390,26 @@ class ImageService(BaseService[Image, ImageCreate, ImageUpdate]):
         pass
 
     def smart_search(self, query: str) -> Page[ImageURL]:
-        raise NotImplementedError("This feature is current not implemented")
-        params = query.lower().split(" ")
-        q = select(self.model)
-        s = (
-            select(Image.id, func.count(image_tags.c.image_id).label("match_count"))
-            .join(Image, Image.id == image_tags.c.image_id)
-            .join(Tag, Tag.id == image_tags.c.tag_id)
+        """Images whose name, tags, collections or entities contain every word of query (as a
+        prefix, so "dra" finds "dragon"), best match first. See api.utils.search"""
+        match = match_query(query)
+        if match is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Nothing to search for."
+            )
+        # Count and rank within the FTS table alone, and only then load the page of images
+        matches = literal_column(SEARCH_TABLE).op("MATCH")(match)
+        total = self.db_session.scalar(
+            select(func.count()).select_from(image_search).where(matches)
         )
-        for param in params:
-            s = s.where(Tag.tag.ilike(param))
-
-            # image_tags.c.tag_id.in_(taglist))
-        s = s.group_by(image_tags.c.image_id).order_by(text("match_count DESC")).subquery()
-        q = q.join(s, s.c.id == Image.id)
-        return paginate(self.db_session, q)
+        params = resolve_params()
+        raw_params = params.to_raw_params().as_limit_offset()
+        q = (
+            select(image_search.c.rowid)
+            .where(matches)
+            .order_by(relevance(), image_search.c.rowid)
+            .limit(raw_params.limit)
+            .offset(raw_params.offset)
+        )
+        images = self.get_in_order(list(self.db_session.scalars(q)))
+        return create_page(images, total=total, params=params)
@@ -0,0 +1,114 @@
+import time
+from typing import Optional
+
+from fastapi import HTTPException, status
+from fastapi_pagination.cursor import CursorPage, CursorParams
+from sqlalchemy import Select, and_, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from api.models import Job, JobStatus, JobType
+from api.schemas import JobCreate, JobStats, JobUpdate, SortBy, SortOption
+from api.utils.pagination import Page
+
+from .base import BaseService
+
+
+class JobService(BaseService[Job, JobCreate, JobUpdate]):
+    def __init__(self, db_session: Session):
+        super(JobService, self).__init__(Job, db_session)
+
+    def enqueue(self, type: JobType, image_id: Optional[int] = None, commit: bool = True) -> Job:
+        "Add a job to the queue. Pass commit=False to enqueue it as part of a larger transaction"
+        job = Job(type=type, image_id=image_id, status=JobStatus.queued, run_after=time.time())
+        self.db_session.add(job)
+        if commit:
+            self.db_session.commit()
+        return job
+
+    def lease(self, lease_seconds: float) -> Optional[Job]:
+        """Claim the next job that is due. A running job whose lease has expired (the worker died,
+        or the server was restarted) is due again. The claim is a single UPDATE, so two workers
+        can never take the same job."""
+        now = time.time()
+        next_job = (
+            select(Job.id)
+            .where(
+                or_(
+                    and_(Job.status == JobStatus.queued, Job.run_after <= now),
+                    and_(Job.status == JobStatus.running, Job.leased_until < now),
+                )
+            )
+            .order_by(Job.run_after, Job.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        q = (
+            update(Job)
+            .where(Job.id == next_job)
+            .values(
+                status=JobStatus.running,
+                leased_until=now + lease_seconds,
+                attempts=Job.attempts + 1,
+            )
+            .returning(Job)
+        )
+        job = self.db_session.scalar(q, execution_options={"synchronize_session": False})
+        self.db_session.commit()
+        return job
+
+    def complete(self, job: Job) -> Job:
+        job.status = JobStatus.done
+        job.leased_until = None
+        job.error = None
+        self.db_session.commit()
+        return job
+
+    def fail(self, job: Job, error: str, max_attempts: int, backoff: float) -> Job:
+        "Requeue with exponential backoff, or dead-letter the job once it's out of attempts"
+        job.leased_until = None
+        job.error = error[:400]
+        if job.attempts >= max_attempts:
+            job.status = JobStatus.dead
+        else:
+            job.status = JobStatus.queued
+            job.run_after = time.time() + backoff * 2 ** (job.attempts - 1)
+        self.db_session.commit()
+        return job
+
+    def retry(self, job_id: int) -> Job:
+        job = self.get(job_id)
+        if job.status != JobStatus.dead:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT, detail="Only dead jobs can be retried."
+            )
+        job.status = JobStatus.queued
+        job.attempts = 0
+        job.run_after = time.time()
+        self.db_session.commit()
+        return job
+
+    def get_jobs(
+        self, status: Optional[JobStatus] = None, image_id: Optional[int] = None
+    ) -> Page[Job]:
+        return self.get_some(self.jobs_query(status, image_id).order_by(Job.id.desc()))
+
+    def get_jobs_by_cursor(
+        self,
+        params: CursorParams,
+        status: Optional[JobStatus] = None,
+        image_id: Optional[int] = None,
+    ) -> CursorPage[Job]:
+        newest_first = SortBy(sort_by="id", sort_dir=SortOption.desc)
+        return self.get_some_by_cursor(self.jobs_query(status, image_id), newest_first, params)
+
+    def jobs_query(self, status: Optional[JobStatus], image_id: Optional[int]) -> Select:
+        q = select(Job)
+        if status is not None:
+            q = q.where(Job.status == status)
+        if image_id is not None:
+            q = q.where(Job.image_id == image_id)
+        return q
+
+    def stats(self) -> JobStats:
+        counts = self.db_session.execute(select(Job.status, func.count()).group_by(Job.status))
+        return JobStats(**{status.value: count for status, count in counts})
@@ -19,6 +19,8 @@ from .base import BaseService
 
 
 class RollTableService(BaseService[RollTable, RollTableCreate, RollTableUpdate]):
+    eager_load = ("rows.extra_data",)
+
     def __init__(self, db_session: DBSession):
         super(RollTableService, self).__init__(RollTable, db_session)
 
@@ -16,6 +16,9 @@ class TagService(BaseService[Tag, TagCreate, TagUpdate]):
         super(TagService, self).__init__(Tag, db_session)
 
     def get_by_name(self, name: str) -> Optional[Tag]:
+        return self.cached(("name", name.lower()), lambda: self.get_by_name_uncached(name))
+
+    def get_by_name_uncached(self, name: str) -> Optional[Tag]:
         tag = self.db_session.scalar(
             select(self.model).where(func.lower(self.model.tag) == name.lower())
         )
@@ -0,0 +1,206 @@
+import hashlib
+import json
+from dataclasses import dataclass, field
+from itertools import islice
+from timeit import default_timer as timer
+from typing import Callable, Iterable, Iterator, Optional, TextIO
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+
+from api.models import Entity
+from core.utils import make_seq
+
+# Importing 5e.tools bestiary files ({"_meta": ..., "monster": [...]}) without holding the whole
+# file, or an ORM object per monster, in memory. Monsters are read one at a time from the stream
+# and written with Core statements in batches. Entities are matched on (name, source), and a hash of
+# the monster's json is kept alongside it, so re-importing a file only touches what changed.
+
+READ_SIZE = 64 * 1024  # characters
+BATCH_SIZE = 500
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    "A window onto a text stream, read in blocks and dropped once consumed"
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        "Read another block. False at the end of the stream"
+        if self.eof:
+            return False
+        block = self.stream.read(READ_SIZE)
+        if not block:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + block
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        "The next non-whitespace character, or '' at the end of the stream"
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            found = repr(char) if char else "end of file"
+            raise ValueError(f"Expected one of {chars!r}, found {found}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        "Decode the next json value, reading more of the stream until it is complete"
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next block
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(stream: TextIO, key: str) -> Iterator:
+    """Yield the items of the array stream[key] one at a time, where stream holds a json object.
+    Other keys are decoded and thrown away, so they should be small. Raises ValueError (or
+    json.JSONDecodeError, a subclass) for malformed json."""
+    reader = _Reader(stream)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() != "]":
+                while True:
+                    yield reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+            else:
+                reader.expect("]")
+        else:
+            reader.value()
+        if reader.expect(",}") == "}":
+            return
+
+
+def data_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+@dataclass
+class ImportStats:
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    skipped: int = 0  # Not a usable monster, e.g. no name
+    duplicates: int = 0  # The same (name, source) again, later in the file. The last one wins
+    seconds: float = 0.0
+    seq: str = field(default_factory=make_seq)
+
+    @property
+    def total(self) -> int:
+        return self.inserted + self.updated + self.unchanged + self.skipped + self.duplicates
+
+    @property
+    def rate(self) -> float:
+        "Monsters per second"
+        return self.total / self.seconds if self.seconds else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "skipped": self.skipped,
+            "duplicates": self.duplicates,
+            "seconds": round(self.seconds, 3),
+            "per_second": round(self.rate, 1),
+            "seq": self.seq,
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.inserted} entities added, {self.updated} updated, {self.unchanged} unchanged, "
+            f"{self.skipped} skipped, {self.duplicates} duplicates in {self.seconds:.1f} s "
+            f"({self.rate:.0f}/s) <Seq={self.seq}>"
+        )
+
+
+def import_monsters(
+    db_session: Session,
+    monsters: Iterable[dict],
+    batch_size: int = BATCH_SIZE,
+    image_for: Optional[Callable[[dict], Optional[int]]] = None,
+    seq: Optional[str] = None,
+) -> ImportStats:
+    """Insert or update an Entity for every monster, matched on (name, source). Monsters whose json
+    is unchanged since the last import are skipped. image_for, if given, is called for each new
+    entity and returns the id of its image (or None). Writes happen in batches of batch_size but
+    nothing is committed: that is up to the caller."""
+    stats = ImportStats(seq=seq or make_seq())
+    start = timer()
+    # Every existing entity's key, so that matching doesn't need a query per monster
+    existing: dict[tuple[str, Optional[str]], tuple[int, Optional[str]]] = {
+        (name, source): (entity_id, digest)
+        for entity_id, name, source, digest in db_session.execute(
+            select(Entity.id, Entity.name, Entity.source, Entity.data_hash)
+        )
+    }
+    seen: set[tuple[str, Optional[str]]] = set()
+    monsters = iter(monsters)
+    while batch := list(islice(monsters, batch_size)):
+        new_rows: dict[tuple[str, Optional[str]], dict] = {}
+        changed_rows: dict[int, dict] = {}
+        for monster in batch:
+            if not isinstance(monster, dict) or not monster.get("name"):
+                stats.skipped += 1
+                continue
+            row = Entity.columns_from_jsondata(monster, stats.seq)
+            row["data_hash"] = data_hash(row["data"])
+            key = (row["name"], row["source"])
+            if key in seen:  # Earlier in the file: the last one wins, but it's not an update
+                stats.duplicates += 1
+            if key in new_rows:  # Not inserted yet
+                new_rows[key] = {**row, "image_id": new_rows[key].get("image_id")}
+            elif key not in existing:
+                if image_for is not None:
+                    row["image_id"] = image_for(monster)
+                new_rows[key] = row
+                stats.inserted += 1
+            elif existing[key][1] == row["data_hash"]:
+                stats.unchanged += key not in seen
+            else:
+                entity_id = existing[key][0]
+                changed_rows[entity_id] = {"id": entity_id, **row}
+                existing[key] = (entity_id, row["data_hash"])
+                stats.updated += key not in seen
+            seen.add(key)
+        if new_rows:
+            q = insert(Entity).returning(Entity.id, Entity.name, Entity.source, Entity.data_hash)
+            # Every row needs the same keys for a single executemany
+            rows = [{"image_id": None, **row} for row in new_rows.values()]
+            for entity_id, name, source, digest in db_session.execute(q, rows):
+                existing[(name, source)] = (entity_id, digest)
+        if changed_rows:
+            db_session.execute(update(Entity), list(changed_rows.values()))
+    stats.seconds = timer() - start
+    return stats
@@ -0,0 +1,232 @@
+import mmap
+import os
+import re
+import threading
+from collections import defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Optional
+
+import anyio
+from fastapi import Request, Response
+from PIL import Image as PImage
+from starlette.background import BackgroundTask
+from starlette.types import Receive, Scope, Send
+
+CHUNK_SIZE = 256 * 1024
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+PATHSEND = "http.response.pathsend"
+ZEROCOPYSEND = "http.response.zerocopysend"
+
+
+def sniff_mime_type(path: str) -> Optional[str]:
+    "Identify an image from its header bytes, rather than trusting the file extension"
+    try:
+        with PImage.open(path) as im:
+            return PImage.MIME.get(im.format or "")
+    except (OSError, PImage.UnidentifiedImageError):
+        return None
+
+
+def make_etag(stat_result: os.stat_result, content_hash: Optional[str] = None) -> str:
+    "Strong validator: changes whenever the stored hash or the file on disk changes"
+    return f'"{content_hash or "0"}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so ignore any W/ prefix
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates
+
+
+def not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if (if_none_match := request.headers.get("if-none-match")) is not None:
+        return etag_matches(etag, if_none_match)  # Takes precedence over If-Modified-Since
+    if (if_modified_since := request.headers.get("if-modified-since")) is not None:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """Parse a single byte range into inclusive (start, end) offsets.
+    Raises ValueError if the range can't be satisfied, returns None if it should be ignored
+    (malformed or multiple ranges), in which case the whole file is sent."""
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:  # Suffix range: the final N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError
+    return start, end
+
+
+def range_applies(request: Request, etag: str, last_modified: str) -> bool:
+    "If-Range: only honour the Range if the client's copy is still current"
+    if_range = request.headers.get("if-range")
+    return if_range is None or if_range.strip() in (etag, last_modified)
+
+
+class DeliveryStats:
+    "Bytes of file bodies served, per route, and how many responses went out each way"
+
+    METHODS = ("pathsend", "zerocopysend", "mmap", "head")
+
+    def __init__(self):
+        self._routes: defaultdict[str, dict[str, int]] = defaultdict(self._empty)
+        self._lock = threading.Lock()
+
+    def _empty(self) -> dict[str, int]:
+        return {"bytes": 0, **{method: 0 for method in self.METHODS}}
+
+    def record(self, route: str, method: str, length: int) -> None:
+        with self._lock:
+            counters = self._routes[route]
+            counters["bytes"] += length
+            counters[method] += 1
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        with self._lock:
+            return {route: dict(counters) for route, counters in self._routes.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._routes.clear()
+
+
+delivery_stats = DeliveryStats()
+
+
+class FileDelivery(Response):
+    """Send a file, or one byte range of it, as the response body without pushing it through
+    Python buffers where the server lets us avoid it. In order of preference:
+
+    - the pathsend extension: the server sends the file itself (e.g. with sendfile)
+    - the zerocopysend extension: the server sendfiles from a file descriptor we open
+    - otherwise, chunks sliced from a memory map of the file. The slices are copied in the thread
+      pool, as FileResponse's reads are, so page faults on a cold file don't hold up the event
+      loop"""
+
+    def __init__(
+        self,
+        path: str,
+        stat_result: os.stat_result,
+        start: int = 0,
+        length: Optional[int] = None,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        media_type: Optional[str] = None,
+        method: str = "GET",
+        background: Optional[BackgroundTask] = None,
+    ):
+        self.path = os.path.abspath(path)  # pathsend requires an absolute path
+        self.stat_result = stat_result
+        self.start = start
+        self.length = stat_result.st_size - start if length is None else length
+        self.send_header_only = method.upper() == "HEAD"
+        headers = {**(headers or {}), "content-length": str(self.length)}
+        super().__init__(None, status_code, headers, media_type, background)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        start = {"type": "http.response.start", "status": self.status_code}
+        await send({**start, "headers": self.raw_headers})
+        extensions = scope.get("extensions") or {}
+        whole_file = self.start == 0 and self.length == self.stat_result.st_size
+        if self.send_header_only:
+            method = "head"
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif PATHSEND in extensions and whole_file:
+            method = "pathsend"
+            await send({"type": PATHSEND, "path": self.path})
+        elif ZEROCOPYSEND in extensions:
+            method = "zerocopysend"
+            with open(self.path, "rb") as file:
+                message = {"type": ZEROCOPYSEND, "file": file, "more_body": False}
+                await send({**message, "offset": self.start, "count": self.length})
+        else:
+            method = "mmap"
+            await self.send_mapped(send)
+        route = scope.get("route")
+        delivery_stats.record(
+            getattr(route, "path", scope.get("path", "")),
+            method,
+            0 if self.send_header_only else self.length,
+        )
+        if self.background is not None:
+            await self.background()
+
+    async def send_mapped(self, send: Send) -> None:
+        end = self.start + self.length
+        if self.length == 0:  # Can't map an empty file
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        with open(self.path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)  # Read ahead aggressively
+                for offset in range(self.start, end, CHUNK_SIZE):
+                    chunk_end = min(offset + CHUNK_SIZE, end)
+                    body = await anyio.to_thread.run_sync(
+                        mapped.__getitem__, slice(offset, chunk_end)
+                    )
+                    await send(
+                        {"type": "http.response.body", "body": body, "more_body": chunk_end < end}
+                    )
+
+
+def file_response(
+    request: Request,
+    path: str,
+    media_type: Optional[str],
+    content_hash: Optional[str] = None,
+    cache_control: Optional[str] = None,
+) -> Response:
+    """Serve a file with validators, conditional GET and single byte range support.
+    Raises FileNotFoundError if the file has gone missing."""
+    stat_result = os.stat(path)
+    etag = make_etag(stat_result, content_hash)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {"etag": etag, "last-modified": last_modified, "accept-ranges": "bytes"}
+    if cache_control:
+        headers["cache-control"] = cache_control
+
+    if not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    size = stat_result.st_size
+    if (range_header := request.headers.get("range")) and range_applies(
+        request, etag, last_modified
+    ):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            return FileDelivery(
+                path,
+                stat_result,
+                start=start,
+                length=end - start + 1,
+                status_code=206,
+                headers=headers,
+                media_type=media_type,
+                method=request.method,
+            )
+
+    return FileDelivery(
+        path, stat_result, headers=headers, media_type=media_type, method=request.method
+    )
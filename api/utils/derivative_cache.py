@@ -0,0 +1,133 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+from uuid import uuid4
+
+from config import get_settings
+
+
+class DerivativeCache:
+    """A content-addressed, disk-backed cache for images derived from an original (thumbnails etc).
+
+    Entries are keyed on the original image (id, mtime, size), the derived dimensions and the
+    output format, so editing or replacing the original automatically misses the cache. The total
+    size on disk is bounded by max_bytes, with the least recently used entries evicted first.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, tuple[Path, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def make_key(image_id: int, path: str, dimensions: tuple[int, int], format: str) -> str:
+        "Build the cache key for a derivative. Raises FileNotFoundError if the original is missing."
+        stat = os.stat(path)
+        width, height = dimensions
+        key = f"{image_id}:{stat.st_mtime_ns}:{stat.st_size}:{width}x{height}:{format.lower()}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def path_for(self, key: str, format: str) -> Path:
+        return derivative_path(self.directory, key, format)
+
+    def get(self, key: str, format: str) -> Optional[Path]:
+        "Return the path of a cached derivative, or None on a miss."
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0].exists():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:  # Deleted from underneath us
+                self._forget(key)
+            path = self.path_for(key, format)
+            if path.exists():  # Written by another process, e.g. the generate-thumbnails command
+                self._register(key, path, path.stat().st_size)
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def put(self, key: str, format: str, data: bytes) -> Path:
+        "Store a derivative and return its path. Written atomically, so never seen half-written"
+        path = self.path_for(key, format)
+        write_atomic(path, data)
+        self.register(key, path)
+        return path
+
+    def register(self, key: str, path: Path) -> None:
+        "Add a derivative that has already been written to path to the cache."
+        size = path.stat().st_size
+        with self._lock:
+            self._register(key, path, size)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self.max_bytes,
+            }
+
+    def _register(self, key: str, path: Path, size: int) -> None:
+        if key in self._entries:
+            self._forget(key)
+        self._entries[key] = (path, size)
+        self._size += size
+        self._evict()
+
+    def _forget(self, key: str) -> None:
+        _, size = self._entries.pop(key)
+        self._size -= size
+
+    def _evict(self) -> None:
+        # Always keep the most recent entry, even if it is on its own larger than the budget
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, (path, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            path.unlink(missing_ok=True)
+
+    def _scan(self) -> None:
+        "Rebuild the index from disk, oldest access first, so a restart keeps the LRU order."
+        files = []
+        for path in self.directory.glob("*/*.*"):
+            if path.name.startswith("."):  # Temp file from an in-progress (or interrupted) write
+                continue
+            stat = path.stat()
+            files.append((stat.st_atime, path, stat.st_size))
+        with self._lock:
+            for _, path, size in sorted(files):
+                self._register(path.stem, path, size)
+
+
+def derivative_path(directory: Path, key: str, format: str) -> Path:
+    return directory / key[:2] / f"{key}.{format.lower()}"
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+@lru_cache
+def get_derivative_cache() -> DerivativeCache:
+    settings = get_settings()
+    return DerivativeCache(Path(settings.THUMBNAIL_CACHE_DIR), settings.THUMBNAIL_CACHE_SIZE)
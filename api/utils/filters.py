@@ -1,11 +1,72 @@
-from sqlalchemy import Select, func, select
+import json
+from typing import Any, Optional
+
+from fastapi import HTTPException
+from fastapi_pagination.cursor import decode_cursor
+from sqlalchemy import Select, and_, func, inspect, or_, select
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+from sqlalchemy.orm.strategy_options import _AbstractLoad
 
 from api.models import Combat, Entity, Image, ImageType, Message, Participant, Tag
 from api.schemas import BaseFilter, SortBy, SortOption
-
-
-def generate_filter_query(model, filter: BaseFilter) -> Select:
+from core.db import Base
+
+# Relationship paths to load with a query, like ("tags", "images.entities:joined")
+Load = tuple[str, ...]
+LOADERS = {"selectin": selectinload, "joined": joinedload, "raise": raiseload}
+
+
+def loader_options(model: type[Base], load: Load) -> list[_AbstractLoad]:
+    """Loader options for relationship paths like "images.tags", starting from model. Each is a
+    selectinload unless it ends with a strategy: "entity.image:joined" suits many-to-one
+    relationships, "collections:raise" makes a lazy load of that relationship an error"""
+    options = []
+    for path in load:
+        path, _, strategy = path.partition(":")
+        loader = LOADERS[strategy or "selectin"]
+        *parents, last = path.split(".")
+        option, current = None, model
+        for name in parents:
+            attribute = getattr(current, name)
+            option = selectinload(attribute) if option is None else option.selectinload(attribute)
+            current = attribute.property.mapper.class_
+        attribute = getattr(current, last)
+        options.append(
+            loader(attribute) if option is None else getattr(option, loader.__name__)(attribute)
+        )
+    return options
+
+
+def loaded_relationships(load: Load) -> set[str]:
+    "The relationships of the model itself that load brings in with the rows"
+    return {path.split(".")[0] for path in load if not path.endswith(":raise")}
+
+
+def loaded_tables(model: type[Base], load: Load) -> set[str]:
+    "The model's table, and every table read to load the relationship paths in load with it"
+    tables = {model.__table__.name}  # type: ignore
+    for path in load:
+        if path.endswith(":raise"):
+            continue
+        mapper = inspect(model)
+        for name in path.split(":")[0].split("."):
+            relationship = mapper.relationships[name]
+            if relationship.secondary is not None:
+                tables.add(relationship.secondary.name)
+            mapper = relationship.mapper
+            tables.add(mapper.local_table.name)
+    return tables
+
+
+def has_loader_options(q: Select) -> bool:
+    return any(isinstance(option, _AbstractLoad) for option in q._with_options)
+
+
+def generate_filter_query(model, filter: BaseFilter, load: Optional[Load] = None) -> Select:
+    "The query for filter, loading load with the rows if given (else the service's eager_load)"
     q = select(model)
+    if load is not None:
+        q = q.options(*loader_options(model, load))
     filter_dump = filter.model_dump(exclude_defaults=True)
     if (
         "combat_participants_at_least" in filter_dump
@@ -143,46 +204,105 @@ def _combat_participants_name(q: Select, model: Combat, params: str) -> Select:
     return q
 
 
-def generate_sort_query(q: Select, model, order: SortBy) -> Select:
-    sort_statement = model.id
-    match order.sort_by:
+def sort_expression(model, sort_by: Optional[str]):
+    "What generate_sort_query orders by for sort_by, other than num_participants"
+    match sort_by:
         case "title":
-            sort_statement = func.lower(model.title)
+            return func.lower(model.title)
         case "name":
-            sort_statement = func.lower(model.name)
-        case "id":
-            sort_statement = model.id
-        case "num_participants":
-            if order.sort_dir == SortOption.desc:
-                q = (
-                    q.join(Participant)
-                    .order_by(func.count(Participant.id).desc())
-                    .group_by(Combat.id)
-                )
-            elif order.sort_dir == SortOption.asc:
-                q = (
-                    q.join(Participant)
-                    .order_by(func.count(Participant.id).asc())
-                    .group_by(Combat.id)
-                )
-            sort_statement = None  # func.count(model.participants)
+            return func.lower(model.name)
         case "ac":
-            sort_statement = model.ac
+            return model.ac
         case "cr":
-            sort_statement = model.cr
+            return model.cr
         case "initiative":
-            sort_statement = model.initiative_modifier
+            return model.initiative_modifier
         case "dimensions":
-            sort_statement = model.dimension_x * model.dimension_y
+            return model.dimension_x * model.dimension_y
         case "message":
-            sort_statement = func.lower(model.message)
+            return func.lower(model.message)
         case "source":
-            sort_statement = func.lower(model.source)
+            return func.lower(model.source)
         case "seq":
-            sort_statement = model.seq
+            return model.seq
+    return model.id
+
+
+def generate_sort_query(q: Select, model, order: SortBy) -> Select:
+    sort_statement = sort_expression(model, order.sort_by)
+    if order.sort_by == "num_participants":
+        if order.sort_dir == SortOption.desc:
+            q = q.join(Participant).order_by(func.count(Participant.id).desc()).group_by(Combat.id)
+        elif order.sort_dir == SortOption.asc:
+            q = q.join(Participant).order_by(func.count(Participant.id).asc()).group_by(Combat.id)
+        sort_statement = None  # func.count(model.participants)
     if order.sort_dir == SortOption.desc and sort_statement is not None:
         sort_statement = sort_statement.desc()
     if order.sort_dir != SortOption.NONE and sort_statement is not None:
         return q.order_by(sort_statement)
     else:
         return q
+
+
+def sort_name(order: SortBy) -> str:
+    "The sort a cursor was made for, so it can't be used with another"
+    if order.sort_dir == SortOption.NONE:
+        return "id:asc"
+    return f"{order.sort_by or 'id'}:{order.sort_dir}"
+
+
+def make_cursor(order: SortBy, key: Any, id: int) -> str:
+    "The cursor for the rows after one with this sort key and id (CursorPage base64 encodes it)"
+    return json.dumps({"sort": sort_name(order), "after": [key, id]})
+
+
+def read_cursor(cursor: Optional[str], order: SortBy) -> Optional[list]:
+    "The [key, id] from a cursor made by make_cursor for the same sort"
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        return None
+    try:
+        data = json.loads(decoded)
+        after, sort = data["after"], data["sort"]
+        key, id = after
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor value") from None
+    if sort != sort_name(order) or not isinstance(id, int):
+        raise HTTPException(status_code=400, detail="Cursor is for a different sort")
+    return [key, id]
+
+
+def generate_keyset_query(q: Select, model, order: SortBy, after: Optional[list]) -> Select:
+    """q ordered by the sort key then id, as generate_sort_query would order it, selecting the sort
+    key as a second column. after is the [key, id] of the last row of the previous page: rows that
+    come after it are found through the index rather than by counting past them with OFFSET"""
+    if order.sort_by == "num_participants":
+        raise HTTPException(status_code=400, detail="Can't page through num_participants by cursor")
+    key = sort_expression(model, order.sort_by)
+    descending = order.sort_dir == SortOption.desc
+    q = q.add_columns(key.label("sort_key"))
+    after_id = None
+    if after is not None:
+        value, last_id = after
+        after_id = model.id < last_id if descending else model.id > last_id
+    if key is model.id:
+        if after_id is not None:
+            q = q.where(after_id)
+        return q.order_by(model.id.desc() if descending else model.id.asc())
+
+    # NULLs come first going up and last coming down, as they do in SQLite by default
+    if after_id is not None:
+        if value is None:
+            condition = and_(key.is_(None), after_id)
+            if not descending:
+                condition = or_(condition, key.is_not(None))
+        else:
+            condition = or_(
+                key < value if descending else key > value, and_(key == value, after_id)
+            )
+            if descending:
+                condition = or_(condition, key.is_(None))
+        q = q.where(condition)
+    if descending:
+        return q.order_by(key.desc().nulls_last(), model.id.desc())
+    return q.order_by(key.asc().nulls_first(), model.id.asc())
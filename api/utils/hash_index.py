@@ -0,0 +1,71 @@
+from threading import RLock
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from api.models import Image
+from core.events import Changes, StaleCheck, on_commit
+from core.phash import HASH_BITS, MultiIndexHash, parse_hash
+
+# How many images have a hash the index can hold, and the highest id among them
+_SUMMARY = select(func.count(Image.id), func.coalesce(func.max(Image.id), 0)).where(
+    func.length(Image.hash) == HASH_BITS // 4
+)
+
+
+class ImageHashIndex:
+    """Every image's perceptual hash, held in memory for near-duplicate lookups. Loaded from the
+    database on first use and then kept in step by the commit hook below. Hashes written by other
+    processes (parse-image-directory, generate-hashes) are picked up by a StaleCheck."""
+
+    def __init__(self):
+        self.index: Optional[MultiIndexHash] = None
+        self.check = StaleCheck(_SUMMARY, [Image.__tablename__])
+        self.lock = RLock()
+
+    def _summary(self) -> tuple[int, int]:
+        assert self.index is not None
+        return len(self.index.hashes), max(self.index.hashes, default=0)
+
+    def get(self, db_session: Session) -> MultiIndexHash:
+        with self.lock:
+            if self.index is not None and self.check.stale(db_session, self._summary):
+                self.index = None
+            if self.index is None:
+                index = MultiIndexHash()
+                for image_id, value in db_session.execute(select(Image.id, Image.hash)):
+                    if (h := parse_hash(value)) is not None:
+                        index.add(image_id, h)
+                self.index = index
+                self.check.loaded()
+            return self.index
+
+    def apply(self, changes: Changes) -> None:
+        with self.lock:
+            if self.index is None:
+                return
+            if changes.bulk:
+                self.index = None  # Rebuild on next use
+                return
+            for row in changes.deleted:
+                self.index.remove(row["id"])
+            for row in changes.inserted + changes.updated:
+                if "hash" not in row:
+                    continue
+                if (h := parse_hash(row["hash"])) is not None:
+                    self.index.add(row["id"], h)
+                else:
+                    self.index.remove(row["id"])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.index = None
+
+
+hash_index = ImageHashIndex()
+
+
+@on_commit(Image.__tablename__)
+def _sync_hash_index(changes: Changes) -> None:
+    hash_index.apply(changes)
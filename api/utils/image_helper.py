@@ -1,4 +1,14 @@
 import base64
+from io import BytesIO
+from typing import Iterator, Optional
+
+from PIL import Image as PImage
+
+from core.colour import extract_pallete, extract_palletes
+from core.phash import dhash
+from core.utils import rgb_to_hex
+
+DEFAULT_THUMBNAIL_WIDTH = 400
 
 
 def calculate_thumbnail_size(image_dimension, **dimensions):
@@ -31,3 +41,105 @@ def get_image_as_base64(path):
     with open(path, "rb") as image:
         data = base64.b64encode(image.read())
     return data.decode("ascii")
+
+
+B64_CHUNK_SIZE = 3 * 64 * 1024  # A multiple of 3, so each chunk encodes without padding
+
+
+def iter_base64(path, chunk_size: int = B64_CHUNK_SIZE) -> Iterator[bytes]:
+    "Base64 encode a file a chunk at a time. The concatenated output matches b64encode."
+    assert chunk_size % 3 == 0
+    with open(path, "rb") as image:
+        while chunk := image.read(chunk_size):
+            yield base64.b64encode(chunk)
+
+
+def base64_length(size: int) -> int:
+    return 4 * ((size + 2) // 3)
+
+
+def stream_base64_json(metadata: bytes, path, field: str = "b64") -> Iterator[bytes]:
+    """Splice the base64 encoding of a file into a serialised (non-empty) JSON object as a string
+    field, without ever holding the whole file (or its encoding) in memory."""
+    yield metadata[:-1]  # Drop the closing brace
+    yield f',"{field}":"'.encode()
+    yield from iter_base64(path)
+    yield b'"}'
+
+
+def render_thumbnail(path, dimensions: tuple[int, int], format: str = "png") -> bytes:
+    with PImage.open(path) as p_image:
+        p_image.thumbnail(dimensions)
+        image_io = BytesIO()
+        p_image.save(image_io, format)
+    return image_io.getvalue()
+
+
+def hash_image(image: tuple[int, str]):
+    "Perceptual hash of the image at path. Returns (image_id, hash) or (image_id, exception)"
+    image_id, path = image
+    try:
+        with PImage.open(path) as im:
+            return image_id, dhash(im)
+    except Exception as e:
+        return image_id, e
+
+
+HEADER_BYTES = 12
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+    b"BM": "image/bmp",
+}
+
+
+def sniff_image_header(header: bytes) -> Optional[str]:
+    "The MIME type of an image from its first HEADER_BYTES bytes, or None if it isn't one we accept"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime_type in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return mime_type
+    return None
+
+
+def read_dimensions(path) -> tuple[int, int]:
+    "Only reads the header, the pixel data isn't decoded"
+    with PImage.open(path) as im:
+        return im.size
+
+
+def image_palette(path, palette_size: int = 5) -> str:
+    return ",".join(map(rgb_to_hex, extract_pallete(path, depth=palette_size)))
+
+
+def parse_image_file(path, palette_size: int = 0) -> tuple[str, dict | Exception]:
+    """Everything parse-image-directory stores about an image file: the dimensions and format from
+    the header, the perceptual hash and, if palette_size is set, the palette. Returns (path,
+    columns) or (path, exception), so one bad file doesn't stop a whole directory."""
+    try:
+        with PImage.open(path) as im:
+            columns: dict = {
+                "dimension_x": im.size[0],
+                "dimension_y": im.size[1],
+                "mime_type": PImage.MIME.get(im.format or ""),
+                "hash": dhash(im),
+            }
+        if palette_size:
+            columns["palette"] = image_palette(path, palette_size)
+        return str(path), columns
+    except Exception as e:
+        return str(path), e
+
+
+def image_palettes(
+    images: list[tuple[int, str]], palette_size: int = 5, quality: int = 2
+) -> list[tuple[int, str | Exception]]:
+    "image_palette for a batch of (image_id, path), so each worker process gets many images at once"
+    palettes = extract_palletes([path for _, path in images], depth=palette_size, quality=quality)
+    return [
+        (image_id, p if isinstance(p, Exception) else ",".join(map(rgb_to_hex, p)))
+        for (image_id, _), p in zip(images, palettes)
+    ]
@@ -0,0 +1,112 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy.orm import Session, sessionmaker
+
+from api.models import Image, Job, JobType
+from api.services.job import JobService
+from api.utils.derivative_cache import get_derivative_cache
+from api.utils.image_helper import hash_image, image_palette
+from api.utils.thumbnail import thumbnail_worker
+from config import Settings
+from core.session import get_engine
+from core.workers import run_in_process
+
+JobHandler = Callable[[Session, Image, Settings], Awaitable[None]]
+handlers: dict[JobType, JobHandler] = {}
+
+
+def handles(job_type: JobType) -> Callable[[JobHandler], JobHandler]:
+    def decorator(fn: JobHandler) -> JobHandler:
+        handlers[job_type] = fn
+        return fn
+
+    return decorator
+
+
+@handles(JobType.hash)
+async def _hash(session: Session, image: Image, settings: Settings) -> None:
+    _, result = await run_in_process(hash_image, (image.id, image.path))
+    if isinstance(result, Exception):
+        raise result
+    image.hash = result
+
+
+@handles(JobType.palette)
+async def _palette(session: Session, image: Image, settings: Settings) -> None:
+    image.palette = await run_in_process(image_palette, image.path)
+
+
+@handles(JobType.thumbnail)
+async def _thumbnail(session: Session, image: Image, settings: Settings) -> None:
+    worker = thumbnail_worker(settings)
+    _, derivatives, _ = await run_in_process(
+        worker, (image.id, image.path, image.dimension_x, image.dimension_y)
+    )
+    if isinstance(derivatives, Exception):
+        raise derivatives
+    cache = get_derivative_cache()
+    for key, path in derivatives:
+        cache.register(key, path)
+
+
+class JobRunner:
+    """Works through the jobs table in the background. Each worker is a task on the event loop that
+    leases a job, hands the heavy lifting to the process pool, and records the outcome. Its queries
+    run in a thread, so waiting on the database's write lock doesn't hold up the event loop. Jobs
+    live in the database, so anything unfinished is picked up again after a restart."""
+
+    def __init__(self):
+        self.tasks: list[asyncio.Task] = []
+        self.session_factory: Optional[sessionmaker] = None
+
+    async def start(self, settings: Settings) -> None:
+        # Not expired on commit, so reading a job or image after lease() doesn't query on the loop
+        self.session_factory = sessionmaker(
+            bind=get_engine(), autoflush=False, expire_on_commit=False
+        )
+        self.tasks = [asyncio.create_task(self.work(settings)) for _ in range(settings.JOB_WORKERS)]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def work(self, settings: Settings) -> None:
+        assert self.session_factory is not None
+        while True:
+            try:
+                with self.session_factory() as session:
+                    ran = await self.run_once(session, settings)
+            except Exception:
+                ran = False  # Database unavailable, or not migrated yet. Try again later.
+            if not ran:
+                await asyncio.sleep(settings.JOB_POLL_INTERVAL)
+
+    async def run_once(self, session: Session, settings: Settings) -> bool:
+        "Lease and run a single job. Returns False if there was nothing to do"
+        service = JobService(session)
+        job = await asyncio.to_thread(service.lease, settings.JOB_LEASE_SECONDS)
+        if job is None:
+            return False
+        try:
+            await self.run(session, job, settings)
+            await asyncio.to_thread(session.commit)
+        except Exception as e:
+            await asyncio.to_thread(session.rollback)
+            await asyncio.to_thread(
+                service.fail, job, repr(e), settings.JOB_MAX_ATTEMPTS, settings.JOB_RETRY_BACKOFF
+            )
+        else:
+            await asyncio.to_thread(service.complete, job)
+        return True
+
+    async def run(self, session: Session, job: Job, settings: Settings) -> None:
+        image = await asyncio.to_thread(session.get, Image, job.image_id)
+        if image is None:
+            return  # Deleted since the job was queued, so there's nothing left to do
+        await handlers[job.type](session, image, settings)
+
+
+job_runner = JobRunner()
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional, Protocol
+
+from sqlalchemy import Table
+
+from api.utils.filters import loaded_tables
+from config import get_settings
+from core.events import Changes, on_commit
+
+# Read-through caches for BaseService lookups, one per model. An entry is dropped when a commit
+# writes to a row it was read from (see ObjectCache.apply), and expires after max_age seconds in
+# case a write happened outside the ORM's sight, e.g. the CLI's Core inserts.
+
+MISSING = object()
+
+
+class CacheBackend(Protocol):
+    "What BaseService needs of a model's cache, so something other than ObjectCache can be used"
+
+    tables: frozenset[str]
+
+    def get(self, key: Hashable) -> Any:
+        "The value for key, or MISSING"
+
+    def put(self, key: Hashable, value: Any, id: Any = None) -> None:
+        "Cache value for key. id is the row it was read from, None if it depends on every row"
+
+    def apply(self, changes: Changes) -> None:
+        "Drop whatever the committed changes make out of date"
+
+    def clear(self) -> None:
+        ...
+
+    def stats(self) -> dict[str, int]:
+        ...
+
+
+class ObjectCache:
+    """An in-process LRU cache of values read for one model, with a TTL. Each entry records the id
+    of the row it came from, so a write to that row (or to a row of a table it was loaded with
+    that refers to it, e.g. image_tags for an Image) drops just the entries for it. A write the
+    entries can't be traced back to, like renaming a tag that cached images carry, drops them all.
+    """
+
+    def __init__(self, model: type, tables: Iterable[str], max_entries: int, max_age: float):
+        self.model = model
+        self.tables = frozenset(tables)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, Any, float]] = OrderedDict()
+        self._keys: dict[Any, set[Hashable]] = {}  # Row id to the keys read from it
+        self._lock = threading.Lock()
+        table: Table = model.__table__  # type: ignore
+        # For each table loaded with the model, its columns that refer to the model's rows
+        self._references = {
+            name: [
+                column.key
+                for column in table.metadata.tables[name].columns
+                if any(key.column.table is table for key in column.foreign_keys)
+            ]
+            for name in self.tables
+        }
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[2] < self.max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._forget(key)
+            self.misses += 1
+            return MISSING
+
+    def put(self, key: Hashable, value: Any, id: Any = None) -> None:
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (value, id, time.monotonic())
+            self._keys.setdefault(id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._forget(next(iter(self._entries)))
+
+    def apply(self, changes: Changes) -> None:
+        if changes.bulk:
+            self.clear()
+            return
+        ids: set[Any] = set()
+        if changes.table == self.model.__table__.name:  # type: ignore
+            rows = changes.inserted + changes.updated + changes.deleted
+            ids.update(row["id"] for row in rows)
+        elif changes.updated or not self._references[changes.table]:
+            # Where the row used to point is lost, or it doesn't point at the model at all, e.g.
+            # image_tags for a cached Collection's images, so any entry could be out of date
+            self.clear()
+            return
+        else:
+            for column in self._references[changes.table]:
+                ids.update(row.get(column) for row in changes.inserted)  # Unset is NULL
+                if any(column not in row for row in changes.deleted):
+                    self.clear()  # Not loaded before it was deleted
+                    return
+                ids.update(row[column] for row in changes.deleted)
+        with self._lock:
+            for id in ids | {None}:  # None: entries read from every row, like a list of values
+                for key in self._keys.get(id, set()).copy():
+                    self._forget(key)
+                    self.invalidations += 1
+
+    def _forget(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._keys[entry[1]]
+            keys.discard(key)
+            if not keys:
+                del self._keys[entry[1]]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+_caches: dict[type, Optional[CacheBackend]] = {}
+_subscribed: set[tuple[type, str]] = set()
+_caches_lock = threading.RLock()
+
+
+def get_object_cache(model: type, load: Iterable[str] = ()) -> Optional[CacheBackend]:
+    """The cache for lookups of model (loaded with the relationship paths in load), or None if
+    it's listed in OBJECT_CACHE_DISABLED. Created on first use, and from then on kept in step with
+    every commit to the tables it reads."""
+    with _caches_lock:
+        if model in _caches:
+            return _caches[model]
+        settings = get_settings()
+        if model.__name__ in settings.OBJECT_CACHE_DISABLED:
+            cache = None
+        else:
+            tables = loaded_tables(model, load)
+            cache = ObjectCache(
+                model, tables, settings.OBJECT_CACHE_SIZE, settings.OBJECT_CACHE_SECONDS
+            )
+        register_object_cache(model, cache)
+        return cache
+
+
+def register_object_cache(model: type, cache: Optional[CacheBackend]) -> None:
+    "Use cache (None for no caching) for model's lookups, in place of the default ObjectCache"
+    with _caches_lock:
+        _caches[model] = cache
+        for table in cache.tables if cache is not None else ():
+            if (model, table) not in _subscribed:
+                on_commit(table)(lambda changes, model=model: _apply(model, changes))
+                _subscribed.add((model, table))
+
+
+def _apply(model: type, changes: Changes) -> None:
+    cache = _caches.get(model)
+    if cache is not None:
+        cache.apply(changes)
+
+
+def object_cache_stats() -> dict[str, dict[str, int]]:
+    with _caches_lock:
+        return {
+            model.__name__: cache.stats() for model, cache in _caches.items() if cache is not None
+        }
+
+
+def clear_object_caches() -> None:
+    with _caches_lock:
+        for cache in _caches.values():
+            if cache is not None:
+                cache.clear()
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+from enum import StrEnum
+from functools import lru_cache
+from typing import Any, Generic, Hashable, Optional, TypeVar
+
+from fastapi import Query, Response
+from fastapi_pagination import Page as _Page
+from fastapi_pagination import Params as _Params
+from fastapi_pagination.api import apply_items_transformer, create_page, resolve_params
+from fastapi_pagination.bases import AbstractParams
+from fastapi_pagination.ext.sqlalchemy import count_query, paginate_query
+from fastapi_pagination.ext.utils import unwrap_scalars
+from sqlalchemy import Select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+
+from api.utils.rows import RowSerializer, dumps
+from config import get_settings
+from core.events import table_versions, uncommitted_tables
+
+T = TypeVar("T")
+
+
+class TotalMode(StrEnum):
+    exact = "exact"  # Counted, or cached until one of the tables the query reads is written to
+    approximate = "approximate"  # Any cached count will do, however out of date
+    skip = "skip"  # Don't count at all, total and pages are null
+
+
+class Params(_Params):
+    total: TotalMode = Query(TotalMode.exact, description="How to work out the total")
+
+
+class Page(_Page[T], Generic[T]):
+    "fastapi_pagination's Page, with the total query parameter"
+    __params_type__ = Params
+
+
+class CountCache:
+    """Totals for paginated queries, so paging through a list doesn't count it on every request.
+
+    Entries are keyed on the count's SQL and parameters, and hold the write version (see
+    core.events.table_versions) of every table it reads. A commit to any of them makes the entry
+    stale. Writes from other processes (e.g. the CLI) aren't seen, so entries also expire after
+    max_age seconds. The least recently used entries are evicted past max_entries."""
+
+    def __init__(self, max_entries: int, max_age: float):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._entries: OrderedDict[Hashable, tuple[tuple[int, ...], int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, db_session: Session, q: Select, mode: TotalMode) -> Optional[int]:
+        "The total number of rows q returns, None if mode is skip"
+        if mode == TotalMode.skip:
+            return None
+        count = count_query(q)
+        compiled = count.compile(db_session.get_bind())
+        key = (str(db_session.get_bind().url), str(compiled), repr(sorted(compiled.params.items())))
+        tables = sorted({table.name for table in find_tables(count, include_aliases=True)})
+        if uncommitted_tables(db_session).intersection(tables):
+            # Only this session can see its own writes, so the cache is no use either way
+            return db_session.scalar(count)
+        versions = table_versions(tables)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                fresh = entry[0] == versions and time.monotonic() - entry[2] < self.max_age
+                if fresh or mode == TotalMode.approximate:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.stale_hits += not fresh
+                    return entry[1]
+            self.misses += 1
+        total = db_session.scalar(count)
+        with self._lock:
+            self._entries[key] = (versions, total, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return total
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.stale_hits = 0
+
+
+@lru_cache
+def get_count_cache() -> CountCache:
+    settings = get_settings()
+    return CountCache(settings.COUNT_CACHE_SIZE, settings.COUNT_CACHE_SECONDS)
+
+
+def paginate(
+    db_session: Session, q: Select, transformer=None, params: Optional[AbstractParams] = None
+) -> _Page[Any]:
+    """fastapi_pagination's paginate, with the total from the count cache (or not counted at all)
+    according to the total query parameter"""
+    params = resolve_params(params)
+    total = get_count_cache().count(db_session, q, getattr(params, "total", TotalMode.exact))
+    items = unwrap_scalars(db_session.execute(paginate_query(q, params)).unique().all())
+    return create_page(apply_items_transformer(items, transformer), total=total, params=params)
+
+
+def paginate_rows(
+    db_session: Session, q: Select, serializer: RowSerializer, params: Optional[Params] = None
+) -> Response:
+    "The same page as paginate, as a response with the JSON serializer builds from Core rows"
+    params = resolve_params(params)
+    total = get_count_cache().count(db_session, q, params.total)
+    page = Page.create([], params, total=total).model_dump()
+    page["items"] = serializer.load(db_session, paginate_query(q, params))
+    return Response(dumps(page), media_type="application/json")
@@ -0,0 +1,161 @@
+from threading import RLock
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+
+from api.models import Image, ImageType
+from core.colour import pack_palette, unpack_lab
+from core.events import Changes, StaleCheck, on_commit
+
+PALETTE_SIZE = 5
+# Added to the colour difference for each place a colour is down an image's palette, so a match on
+# the dominant colour beats an equally close match on an accent colour
+RANK_PENALTY = 4.0
+TYPE_CODES = {t: code for code, t in enumerate(ImageType)}
+
+
+class PaletteMatrix:
+    """Every image's palette as rows of an (N, PALETTE_SIZE, 3) array of Lab colours, so a query is
+    scored against all of them in one vectorised pass. Rows are kept dense: removing an image moves
+    the last row into its slot."""
+
+    def __init__(self, size: int = PALETTE_SIZE):
+        self.size = size
+        self.count = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.types = np.zeros(0, dtype=np.int8)
+        self.labs = np.zeros((0, size, 3), dtype=np.float32)
+        self.slots: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _grow(self) -> None:
+        capacity = max(1024, 2 * len(self.ids))
+        self.ids = np.resize(self.ids, capacity)
+        self.types = np.resize(self.types, capacity)
+        self.labs = np.resize(self.labs, (capacity, self.size, 3))
+
+    def add(self, image_id: int, lab: np.ndarray, type: ImageType) -> None:
+        slot = self.slots.get(image_id)
+        if slot is None:
+            if self.count == len(self.ids):
+                self._grow()
+            slot = self.slots[image_id] = self.count
+            self.count += 1
+        row = np.full((self.size, 3), np.inf, dtype=np.float32)  # Short palettes never match
+        row[: len(lab[: self.size])] = lab[: self.size]
+        self.ids[slot] = image_id
+        self.types[slot] = TYPE_CODES[type]
+        self.labs[slot] = row
+
+    def set_type(self, image_id: int, type: ImageType) -> None:
+        if (slot := self.slots.get(image_id)) is not None:
+            self.types[slot] = TYPE_CODES[type]
+
+    def remove(self, image_id: int) -> None:
+        slot = self.slots.pop(image_id, None)
+        if slot is None:
+            return
+        last = self.count - 1
+        if slot != last:
+            self.ids[slot] = self.ids[last]
+            self.types[slot] = self.types[last]
+            self.labs[slot] = self.labs[last]
+            self.slots[int(self.ids[slot])] = slot
+        self.count = last
+
+    def search(
+        self, lab: np.ndarray, type: Optional[ImageType] = None, limit: int = 20
+    ) -> list[tuple[float, int]]:
+        "The (distance, image_id) of the images with the closest palette colour to lab, nearest first"
+        labs = self.labs[: self.count]
+        difference = labs - lab
+        distance = np.sqrt(np.einsum("ijk,ijk->ij", difference, difference))  # CIE76
+        distance += RANK_PENALTY * np.arange(self.size, dtype=np.float32)
+        scores = distance.min(axis=1)
+        if type is not None:
+            scores[self.types[: self.count] != TYPE_CODES[type]] = np.inf
+        limit = min(limit, int(np.isfinite(scores).sum()))
+        if limit == 0:
+            return []
+        nearest = np.argpartition(scores, limit - 1)[:limit]
+        nearest = nearest[np.argsort(scores[nearest])]
+        return [(float(scores[i]), int(self.ids[i])) for i in nearest]
+
+
+# How many images have a palette, and the highest id among them
+_SUMMARY = select(func.count(Image.id), func.coalesce(func.max(Image.id), 0)).where(
+    or_(Image.palette_lab.is_not(None), Image.palette != "")
+)
+
+
+class ImagePaletteIndex:
+    """The palette matrix, loaded from the database on first use and then kept in step by the
+    commit hook below. Palettes written by other processes (e.g. the CLI) are picked up by a
+    StaleCheck."""
+
+    def __init__(self):
+        self.matrix: Optional[PaletteMatrix] = None
+        self.check = StaleCheck(_SUMMARY, [Image.__tablename__])
+        self.lock = RLock()
+
+    def _summary(self) -> tuple[int, int]:
+        assert self.matrix is not None
+        return len(self.matrix), max(self.matrix.slots, default=0)
+
+    def get(self, db_session: Session) -> PaletteMatrix:
+        with self.lock:
+            if self.matrix is not None and self.check.stale(db_session, self._summary):
+                self.matrix = None
+            if self.matrix is None:
+                matrix = PaletteMatrix()
+                q = select(Image.id, Image.type, Image.palette_lab, Image.palette)
+                for image_id, type, palette_lab, palette in db_session.execute(q):
+                    # Rows from before palette_lab existed can be packed on the fly
+                    if (packed := palette_lab or pack_palette(palette)) is not None:
+                        matrix.add(image_id, unpack_lab(packed), type)
+                self.matrix = matrix
+                self.check.loaded()
+            return self.matrix
+
+    def search(
+        self, db_session: Session, lab: np.ndarray, type: Optional[ImageType], limit: int
+    ) -> list[tuple[float, int]]:
+        with self.lock:  # Rows can move around while a commit is being applied
+            return self.get(db_session).search(lab, type, limit)
+
+    def apply(self, changes: Changes) -> None:
+        with self.lock:
+            if self.matrix is None:
+                return
+            if changes.bulk:
+                self.matrix = None  # Rebuild on next use
+                return
+            for row in changes.deleted:
+                self.matrix.remove(row["id"])
+            for row in changes.inserted + changes.updated:
+                if "palette_lab" in row:
+                    # As in get(), a row from before palette_lab existed can still have a palette
+                    packed = row["palette_lab"] or pack_palette(row.get("palette"))
+                    if packed is None:
+                        self.matrix.remove(row["id"])
+                    else:
+                        type = row.get("type") or ImageType.backdrop
+                        self.matrix.add(row["id"], unpack_lab(packed), type)
+                elif row.get("type") is not None:
+                    self.matrix.set_type(row["id"], row["type"])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.matrix = None
+
+
+palette_index = ImagePaletteIndex()
+
+
+@on_commit(Image.__tablename__)
+def _sync_palette_index(changes: Changes) -> None:
+    palette_index.apply(changes)
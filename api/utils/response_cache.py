@@ -0,0 +1,178 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterable, Optional
+from urllib.parse import parse_qsl, urlencode
+
+from fastapi import APIRouter
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import get_settings
+from core.events import table_versions
+
+# Conditional GETs for routes that are polled far more often than they change. A response's ETag
+# is worked out from the write versions (see core.events.table_versions) of the tables its router
+# reads, so a client that already has it gets a 304 without the route running at all.
+
+
+@dataclass(frozen=True)
+class CachedRouter:
+    "The GET routes under prefix (or only prefix + each of paths), and the tables they read"
+    prefix: str
+    tables: tuple[str, ...]
+    paths: Optional[tuple[str, ...]] = None
+    store: bool = False  # Also keep the bodies, so a client without the ETag skips the route too
+
+    def matches(self, path: str) -> bool:
+        if self.paths is not None:
+            return any(path == self.prefix + p for p in self.paths)
+        return path == self.prefix or path.startswith(self.prefix + "/")
+
+
+_routers: list[CachedRouter] = []
+
+
+def cache_responses(
+    router: APIRouter,
+    tables: Iterable[str],
+    paths: Optional[Iterable[str]] = None,
+    store: bool = False,
+) -> None:
+    """Give the GET responses of router (or just those at paths under it) ETags that change
+    whenever one of tables is written to, see ETagMiddleware"""
+    _routers.append(
+        CachedRouter(
+            router.prefix, tuple(sorted(tables)), None if paths is None else tuple(paths), store
+        )
+    )
+
+
+def etag(scope: Scope, cached: CachedRouter, epoch: int) -> str:
+    """A weak ETag for the response to a request: the same as long as none of the router's tables
+    have been written to, and epoch hasn't changed. The query string is normalized, as the order
+    of the parameters doesn't matter."""
+    query = urlencode(sorted(parse_qsl(scope["query_string"].decode(), keep_blank_values=True)))
+    versions = ",".join(map(str, table_versions(cached.tables)))
+    key = f"{scope['path']}?{query}|{versions}|{epoch}".encode()
+    return f'W/"{hashlib.blake2b(key, digest_size=12).hexdigest()}"'
+
+
+class ResponseCache:
+    "The bodies of responses with an ETag, least recently used dropped past max_bytes in total"
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._entries: OrderedDict[str, tuple[list[tuple[bytes, bytes]], bytes]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, tag: str) -> Optional[tuple[list[tuple[bytes, bytes]], bytes]]:
+        with self._lock:
+            entry = self._entries.get(tag)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(tag)
+            self.hits += 1
+            return entry
+
+    def record_not_modified(self) -> None:
+        with self._lock:
+            self.not_modified += 1
+
+    def put(self, tag: str, headers: list[tuple[bytes, bytes]], body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if tag in self._entries:
+                return
+            self._entries[tag] = (headers, body)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = self.not_modified = 0
+
+
+@lru_cache
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(get_settings().RESPONSE_CACHE_SIZE)
+
+
+class ETagMiddleware:
+    """ETags for the GET routes registered with cache_responses. A request whose If-None-Match has
+    the current ETag gets a 304 and the route isn't called. Writes from other processes aren't
+    seen, so the ETags also change every max_age seconds whatever happens."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.max_age = get_settings().RESPONSE_CACHE_SECONDS
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        cached = None
+        if scope["type"] == "http" and scope["method"] == "GET":
+            cached = next((c for c in _routers if c.matches(scope["path"])), None)
+        if cached is None:
+            await self.app(scope, receive, send)
+            return
+
+        response_cache = get_response_cache()
+        tag = etag(scope, cached, int(time.time() // self.max_age) if self.max_age else 0)
+        tag_headers = [(b"etag", tag.encode()), (b"cache-control", b"no-cache")]
+        if_none_match = Headers(scope=scope).get("if-none-match", "")
+        if tag in {value.strip() for value in if_none_match.split(",")} or if_none_match == "*":
+            response_cache.record_not_modified()
+            await send({"type": "http.response.start", "status": 304, "headers": tag_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if cached.store and (entry := response_cache.get(tag)) is not None:
+            headers, body = entry
+            await send({"type": "http.response.start", "status": 200, "headers": list(headers)})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        headers: Optional[list[tuple[bytes, bytes]]] = None
+        chunks: list[bytes] = []
+
+        async def send_with_etag(message: Message) -> None:
+            nonlocal headers
+            if message["type"] == "http.response.start":
+                if message["status"] != 200:
+                    await send(message)
+                    return
+                headers = [
+                    (name, value)
+                    for name, value in message.get("headers", [])
+                    if name.lower() not in (b"etag", b"cache-control")
+                ] + tag_headers
+                # Kept apart from the message, which middleware further out may add to in place
+                message["headers"] = list(headers)
+            elif headers is not None and cached.store:
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response_cache.put(tag, headers, b"".join(chunks))
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
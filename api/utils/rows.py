@@ -0,0 +1,133 @@
+import typing
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+import orjson
+from pydantic import BaseModel
+from sqlalchemy import ColumnElement, Row, Select, inspect, select
+from sqlalchemy.orm import RelationshipDirection, RelationshipProperty, Session
+
+# Read-only lists can skip the ORM entirely: select just the columns the response schema shows,
+# as Core rows, and build the JSON from those. There's no identity map, no instances to hydrate
+# and no validation from_attributes, which is most of the time spent on a page of 100 rows.
+
+
+def _item_schema(annotation: Any) -> Optional[type[BaseModel]]:
+    "The schema of a list[Schema] or Schema field, None for anything else"
+    if typing.get_origin(annotation) is list:
+        annotation = typing.get_args(annotation)[0]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    return None
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return value.decode()  # As pydantic serializes bytes
+    raise TypeError
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default)
+
+
+class RowSerializer:
+    """Builds the JSON form (by alias) of a response schema for rows of a model. Each field of the
+    schema must be one of:
+      - a column of the model, which is selected
+      - a collection of the model, loaded for the whole page in one query and serialized with its
+        own RowSerializer
+      - a property of the model that only reads the columns above (e.g. Image.url), which is
+        called with the row in place of an instance"""
+
+    def __init__(self, model: type, schema: type[BaseModel]):
+        mapper = inspect(model)
+        self.model = model
+        self.columns: dict[str, ColumnElement] = {}
+        self.relationships: dict[str, tuple[RelationshipProperty, RowSerializer]] = {}
+        self.fields: list[tuple[str, str, Optional[Callable[[Row], Any]]]] = []
+        for name, field in schema.model_fields.items():
+            alias = field.alias or name
+            if name in mapper.column_attrs:
+                self.columns[name] = mapper.column_attrs[name].expression.label(name)
+                self.fields.append((alias, name, None))
+            elif name in mapper.relationships and (item := _item_schema(field.annotation)):
+                relationship = mapper.relationships[name]
+                if relationship.direction == RelationshipDirection.MANYTOONE:
+                    raise TypeError(f"{model.__name__}.{name} isn't a collection")
+                self.relationships[name] = (
+                    relationship,
+                    row_serializer(relationship.entity.class_, item),
+                )
+                self.fields.append((alias, name, None))
+            elif isinstance(prop := getattr(model, name, None), property):
+                self.fields.append((alias, name, prop.fget))
+            else:
+                raise TypeError(f"{schema.__name__}.{name} isn't a column or property of {model}")
+        # The columns the collections join on, whether or not the schema shows them
+        self.join_keys: dict[str, str] = {}
+        for name, (relationship, _) in self.relationships.items():
+            if len(relationship.synchronize_pairs) != 1:
+                raise TypeError(f"{relationship} joins on more than one column")
+            local = relationship.synchronize_pairs[0][0]
+            key = mapper.get_property_by_column(local).key
+            self.columns.setdefault(key, local.label(key))
+            self.join_keys[name] = key
+        # Rows are read by position: a column could be called e.g. count, like a method of Row
+        self.positions = {key: n for n, key in enumerate(self.columns)}
+
+    def query(self, q: Select) -> Select:
+        "q (a select of the model) narrowed to the columns this serializer needs"
+        return q.with_only_columns(*self.columns.values(), maintain_column_froms=True)
+
+    def load(self, db_session: Session, q: Select) -> list[dict[str, Any]]:
+        "Run q, a select of the model, and serialize every row it returns"
+        return self.serialize(db_session, list(db_session.execute(self.query(q))))
+
+    def serialize(self, db_session: Session, rows: list[Row]) -> list[dict[str, Any]]:
+        "The JSON form of each of rows, a result of query()"
+        keys = {name: self.positions[key] for name, key in self.join_keys.items()}
+        related = {
+            name: self.load_related(db_session, name, [row[n] for row in rows])
+            for name, n in keys.items()
+        }
+        items = []
+        for row in rows:
+            item = {}
+            for alias, name, getter in self.fields:
+                if getter is not None:
+                    item[alias] = getter(row)
+                elif name in related:
+                    item[alias] = related[name].get(row[keys[name]], [])
+                else:
+                    item[alias] = row[self.positions[name]]
+            items.append(item)
+        return items
+
+    def load_related(
+        self, db_session: Session, name: str, keys: list[Any]
+    ) -> dict[Any, list[dict[str, Any]]]:
+        "The serialized collection name for each of keys (values of its join column)"
+        relationship, serializer = self.relationships[name]
+        if not keys:
+            return {}
+        target = relationship.entity
+        # The foreign key to this model: in the association table for a many-to-many, otherwise
+        # in the related table
+        remote = relationship.synchronize_pairs[0][1]
+        q = select(target.class_)
+        if relationship.secondary is not None:
+            q = q.join_from(relationship.secondary, target.class_, relationship.secondaryjoin)
+        order_by = relationship.order_by or target.primary_key
+        q = serializer.query(q.where(remote.in_(set(keys))).order_by(*order_by))
+        found = list(db_session.execute(q.add_columns(remote)))  # Last, after serializer's columns
+        grouped: defaultdict[Any, list[dict[str, Any]]] = defaultdict(list)
+        for row, item in zip(found, serializer.serialize(db_session, found)):
+            grouped[row[-1]].append(item)
+        return grouped
+
+
+@lru_cache
+def row_serializer(model: type, schema: type[BaseModel]) -> RowSerializer:
+    return RowSerializer(model, schema)
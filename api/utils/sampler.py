@@ -0,0 +1,139 @@
+import random
+from threading import RLock
+from typing import Any, Hashable, Optional, Type
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from core.db import Base
+from core.events import Changes, StaleCheck, on_commit
+
+_MISSING = object()
+
+
+class IdPool:
+    "A set of ids that can also pick a member uniformly at random in constant time"
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.positions: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.positions
+
+    def add(self, id: int) -> None:
+        if id not in self.positions:
+            self.positions[id] = len(self.ids)
+            self.ids.append(id)
+
+    def remove(self, id: int) -> None:
+        position = self.positions.pop(id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if last != id:  # Move the last id into the gap
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def choice(self) -> Optional[int]:
+        return random.choice(self.ids) if self.ids else None
+
+
+class RandomSampler:
+    """The ids of every row of a model, split into pools by the value of one column (e.g. the image
+    type), so that a random row is a constant time pick followed by a primary key lookup, instead
+    of ORDER BY random() over the whole table. Loaded on first use, then kept in step on commit.
+
+    Writes made by other processes (e.g. the CLI) aren't seen on commit. Instead, a StaleCheck
+    compares the row count and highest id with the pools', and they're reloaded if either differs.
+    Until then callers should treat an id whose row has gone as stale and discard it."""
+
+    def __init__(self, model: Type[Base], partition_by: Optional[str] = None):
+        self.model = model
+        self.partition_by = partition_by
+        self.pools: Optional[dict[Hashable, IdPool]] = None
+        self.keys: dict[int, Hashable] = {}  # Which pool each id is in
+        self.max_id = 0
+        q = select(func.count(model.id), func.coalesce(func.max(model.id), 0))
+        self.check = StaleCheck(q, [model.__tablename__])
+        self.lock = RLock()
+        on_commit(model.__tablename__)(self.apply)
+
+    def _load(self, db_session: Session) -> dict[Hashable, IdPool]:
+        if self.pools is not None and self.check.stale(db_session, self._summary):
+            self.pools = None
+        if self.pools is None:
+            self.pools, self.keys, self.max_id = {}, {}, 0
+            self.check.loaded()
+            column = getattr(self.model, self.partition_by) if self.partition_by else None
+            q = select(self.model.id, column) if column is not None else select(self.model.id)
+            for row in db_session.execute(q):
+                self._add(row[0], row[1] if column is not None else None)
+        return self.pools
+
+    def _summary(self) -> tuple[int, int]:
+        return len(self.keys), self.max_id
+
+    def _add(self, id: int, key: Hashable) -> None:
+        assert self.pools is not None
+        self.max_id = max(self.max_id, id)
+        current = self.keys.get(id, _MISSING)
+        if current is not _MISSING and current != key:
+            self.pools[current].remove(id)
+        self.keys[id] = key
+        self.pools.setdefault(key, IdPool()).add(id)
+
+    def _remove(self, id: int) -> None:
+        assert self.pools is not None
+        if (key := self.keys.pop(id, _MISSING)) is not _MISSING:
+            self.pools[key].remove(id)
+
+    def choice(self, db_session: Session, key: Hashable = None) -> Optional[int]:
+        "A random id, from the pool for key if the sampler is partitioned"
+        with self.lock:
+            pool = self._load(db_session).get(key)
+            return pool.choice() if pool is not None else None
+
+    def members(self, db_session: Session, key: Hashable = None) -> IdPool:
+        with self.lock:
+            return self._load(db_session).get(key) or IdPool()
+
+    def discard(self, id: int) -> None:
+        with self.lock:
+            if self.pools is not None:
+                self._remove(id)
+
+    def apply(self, changes: Changes) -> None:
+        with self.lock:
+            if self.pools is None:
+                return
+            if changes.bulk:
+                self.pools = None  # Reload on next use
+                return
+            for row in changes.deleted:
+                self._remove(row["id"])
+            for row in changes.inserted:
+                self._add(row["id"], row.get(self.partition_by) if self.partition_by else None)
+            if self.partition_by:
+                for row in changes.updated:
+                    if self.partition_by in row:
+                        self._add(row["id"], row[self.partition_by])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.pools = None
+
+
+_samplers: dict[Any, RandomSampler] = {}
+_samplers_lock = RLock()
+
+
+def get_sampler(model: Type[Base], partition_by: Optional[str] = None) -> RandomSampler:
+    "The shared sampler for a model, created the first time it's asked for"
+    with _samplers_lock:
+        if (model, partition_by) not in _samplers:
+            _samplers[(model, partition_by)] = RandomSampler(model, partition_by)
+        return _samplers[(model, partition_by)]
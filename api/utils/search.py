@@ -0,0 +1,146 @@
+import re
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from sqlalchemy import column, func, literal_column, table
+
+# Full text search over images, by name and by the names of their tags, collections and entities.
+# image_search is an SQLite FTS5 table with one row per image (rowid = image id), kept up to date by
+# the triggers below, so every writer (the API, the CLI, a bulk Core statement) keeps it in step.
+
+SEARCH_TABLE = "image_search"
+COLUMNS = ("name", "tags", "collections", "entities")
+# bm25 weight of a match in each column: a hit on the image's own name counts most
+WEIGHTS = (10.0, 4.0, 2.0, 4.0)
+
+image_search = table(SEARCH_TABLE, column("rowid"), *(column(c) for c in COLUMNS))
+
+_ROW = """
+SELECT i.id, i.name,
+    (SELECT group_concat(t.tag, ' ') FROM image_tags it JOIN tags t ON t.id = it.tag_id
+        WHERE it.image_id = i.id),
+    (SELECT group_concat(c.name, ' ') FROM image_collections ic
+        JOIN collections c ON c.id = ic.collection_id WHERE ic.image_id = i.id),
+    (SELECT group_concat(e.name, ' ') FROM entities e WHERE e.image_id = i.id)
+FROM images i"""
+
+
+def _refresh(image_ids: str) -> list[str]:
+    "Statements that rewrite the rows for image_ids (a SQL expression or subquery)"
+    return [
+        f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({image_ids})",
+        f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(COLUMNS)}) {_ROW}"
+        f" WHERE i.id IN ({image_ids})",
+    ]
+
+
+# trigger name -> (event, body)
+_TRIGGERS = {
+    "images_insert": ("AFTER INSERT ON images", _refresh("new.id")),
+    "images_update": ("AFTER UPDATE OF id, name ON images", _refresh("old.id, new.id")),
+    "images_delete": ("AFTER DELETE ON images", _refresh("old.id")),
+    "image_tags_insert": ("AFTER INSERT ON image_tags", _refresh("new.image_id")),
+    "image_tags_update": (
+        "AFTER UPDATE ON image_tags",
+        _refresh("old.image_id, new.image_id"),
+    ),
+    "image_tags_delete": ("AFTER DELETE ON image_tags", _refresh("old.image_id")),
+    "tags_update": (
+        "AFTER UPDATE OF tag ON tags",
+        _refresh("SELECT image_id FROM image_tags WHERE tag_id = new.id"),
+    ),
+    "tags_delete": (
+        "AFTER DELETE ON tags",
+        _refresh("SELECT image_id FROM image_tags WHERE tag_id = old.id"),
+    ),
+    "image_collections_insert": ("AFTER INSERT ON image_collections", _refresh("new.image_id")),
+    "image_collections_delete": ("AFTER DELETE ON image_collections", _refresh("old.image_id")),
+    "collections_update": (
+        "AFTER UPDATE OF name ON collections",
+        _refresh("SELECT image_id FROM image_collections WHERE collection_id = new.id"),
+    ),
+    "collections_delete": (
+        "AFTER DELETE ON collections",
+        _refresh("SELECT image_id FROM image_collections WHERE collection_id = old.id"),
+    ),
+    "entities_insert": ("AFTER INSERT ON entities", _refresh("new.image_id")),
+    "entities_update": (
+        "AFTER UPDATE OF name, image_id ON entities",
+        _refresh("old.image_id, new.image_id"),
+    ),
+    "entities_delete": ("AFTER DELETE ON entities", _refresh("old.image_id")),
+}
+
+
+def trigger_statements() -> list[str]:
+    "DDL for just the triggers"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_{name} {when} BEGIN\n"
+        + "".join(f"{statement};\n" for statement in body)
+        + "END"
+        for name, (when, body) in _TRIGGERS.items()
+    ]
+
+
+def drop_trigger_statements() -> list[str]:
+    return [f"DROP TRIGGER IF EXISTS {SEARCH_TABLE}_{name}" for name in _TRIGGERS]
+
+
+def create_statements() -> list[str]:
+    "DDL for the search table and its triggers, then a statement to fill it from the existing rows"
+    statements = [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5({', '.join(COLUMNS)}, "
+        "prefix='2 3', tokenize='unicode61 remove_diacritics 2')"
+    ]
+    return statements + trigger_statements() + rebuild_statements()
+
+
+def drop_statements() -> list[str]:
+    return drop_trigger_statements() + [f"DROP TABLE IF EXISTS {SEARCH_TABLE}"]
+
+
+@contextmanager
+def triggers_dropped(execute: Callable[[str], Any]) -> Iterator[None]:
+    """Drop the triggers while the body runs and put them back after, for migrations. An alembic
+    batch operation on SQLite rebuilds the table and renames the copy into place, which fails while
+    a trigger refers to one of the tables the search reads (images, image_tags, tags, collections,
+    image_collections, entities):
+
+        with triggers_dropped(op.execute), op.batch_alter_table("entities") as batch_op:
+            ...
+
+    The rebuild copies the rows unchanged, so the search table doesn't need refilling."""
+    for statement in drop_trigger_statements():
+        execute(statement)
+    yield
+    for statement in trigger_statements():
+        execute(statement)
+
+
+def rebuild_statements() -> list[str]:
+    "Rewrite every row, e.g. after changing the columns or tokenizer"
+    return [
+        f"DELETE FROM {SEARCH_TABLE}",
+        f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(COLUMNS)}) {_ROW}",
+    ]
+
+
+def create_search_table(target, connection, **kw) -> None:
+    "Metadata after_create hook, so that create_all (e.g. in the tests) makes the table too"
+    if connection.dialect.name == "sqlite":
+        for statement in create_statements():
+            connection.exec_driver_sql(statement)
+
+
+def match_query(text: str) -> Optional[str]:
+    """An FTS5 query for free text: every word must match, as a prefix, in any column. Each word
+    is quoted, so FTS5 syntax in the input (NEAR, column:, ^) is searched for literally."""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def relevance():
+    "Order by this for the best match first (bm25 scores are negative, lower is better)"
+    return func.bm25(literal_column(SEARCH_TABLE), *WEIGHTS)
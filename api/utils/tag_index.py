@@ -0,0 +1,203 @@
+from itertools import chain
+from threading import RLock
+from typing import Iterable, Optional
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from api.models import Image, Tag, image_tags
+from core.events import Changes, StaleCheck, on_commit
+
+# A bitmap is a Python int used as a set of image ids: bit n is set if image n is in the set. Ints
+# are immutable, so a query can take the bitmaps it needs under the lock and do the arithmetic
+# outside it. Image ids are dense, so even 1M images is only 125kB per tag.
+
+
+def to_bitmap(ids: Iterable[int]) -> int:
+    ids = np.fromiter(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return 0
+    bits = np.zeros(int(ids.max()) + 1, dtype=np.uint8)
+    bits[ids] = 1
+    return int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little")
+
+
+def from_bitmap(bitmap: int) -> np.ndarray:
+    "The ids in a bitmap, in ascending order"
+    if bitmap == 0:
+        return np.zeros(0, dtype=np.int64)
+    packed = np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"), np.uint8)
+    return np.flatnonzero(np.unpackbits(packed, bitorder="little"))
+
+
+def rank(bitmaps: list[int]) -> list[int]:
+    """Split the union of bitmaps by how many of them each id is in. Returns a list where item k is
+    the ids in exactly len(bitmaps) - k of them, i.e. best matches first. Counted with a running
+    "in at least n" bitmap per n, so it's len(bitmaps)**2 big-int operations, not one per image."""
+    at_least = [0] * (len(bitmaps) + 2)
+    for n, bitmap in enumerate(bitmaps, start=1):
+        for count in range(n, 1, -1):
+            at_least[count] |= at_least[count - 1] & bitmap
+        at_least[1] |= bitmap
+    return [at_least[count] & ~at_least[count + 1] for count in range(len(bitmaps), 0, -1)]
+
+
+def page_of(layers: list[int], offset: int, limit: int) -> list[int]:
+    "Ids offset..offset+limit of the layers read one after another, each in ascending order"
+    ids: list[int] = []
+    for layer in layers:
+        if len(ids) >= limit:
+            break
+        size = layer.bit_count()
+        if offset >= size:  # Skip whole layers without unpacking them
+            offset -= size
+            continue
+        ids.extend(from_bitmap(layer)[offset : offset + limit - len(ids)].tolist())
+        offset = 0
+    return ids
+
+
+class TagBitmaps:
+    "An inverted index from tag id to the bitmap of the images with that tag"
+
+    def __init__(self):
+        self.tags: dict[int, int] = {}
+        self.images = 0  # Every image, for queries that only exclude tags
+
+    def tag(self, image_id: int, tag_id: int) -> None:
+        self.tags[tag_id] = self.tags.get(tag_id, 0) | (1 << image_id)
+
+    def untag(self, image_id: int, tag_id: int) -> None:
+        if tag_id in self.tags:
+            self.tags[tag_id] &= ~(1 << image_id)
+
+    def add_image(self, image_id: int) -> None:
+        self.images |= 1 << image_id
+
+    def remove_image(self, image_id: int) -> None:
+        bit = 1 << image_id
+        self.images &= ~bit
+        for tag_id, bitmap in self.tags.items():
+            if bitmap & bit:
+                self.tags[tag_id] = bitmap & ~bit
+
+    def remove_tag(self, tag_id: int) -> None:
+        self.tags.pop(tag_id, None)
+
+    def get(self, tag_id: int) -> int:
+        return self.tags.get(tag_id, 0)
+
+
+# What the bitmaps should hold: every image, the highest image id, and the image_tags rows of
+# images and tags that exist
+_TAGGED = (
+    select(func.count())
+    .select_from(image_tags)
+    .join(Image, Image.id == image_tags.c.image_id)
+    .join(Tag, Tag.id == image_tags.c.tag_id)
+    .scalar_subquery()
+)
+_SUMMARY = select(func.count(Image.id), func.coalesce(func.max(Image.id), 0), _TAGGED)
+
+
+class ImageTagIndex:
+    """The tag bitmaps, loaded from image_tags on first use and then kept in step by the commit
+    hooks below, so tag queries never have to GROUP BY the join table. Images and tags written by
+    other processes are picked up by a StaleCheck."""
+
+    def __init__(self):
+        self.bitmaps: Optional[TagBitmaps] = None
+        self.check = StaleCheck(_SUMMARY, (Image.__tablename__, image_tags.name, Tag.__tablename__))
+        self.lock = RLock()
+
+    def _summary(self) -> tuple[int, int, int]:
+        assert self.bitmaps is not None
+        images = self.bitmaps.images
+        tagged = sum(bitmap.bit_count() for bitmap in self.bitmaps.tags.values())
+        return images.bit_count(), max(images.bit_length() - 1, 0), tagged
+
+    def get(self, db_session: Session) -> TagBitmaps:
+        with self.lock:
+            if self.bitmaps is not None and self.check.stale(db_session, self._summary):
+                self.bitmaps = None
+            if self.bitmaps is None:
+                bitmaps = TagBitmaps()
+                bitmaps.images = to_bitmap(db_session.scalars(select(Image.id)))
+                existing = set(db_session.scalars(select(Tag.id)))
+                # Through Core and sorted here, as ORM rows and a JOIN/ORDER BY are most of the cost
+                q = select(image_tags.c.tag_id, image_tags.c.image_id)
+                pairs = chain.from_iterable(db_session.connection().execute(q))
+                rows = np.fromiter(pairs, dtype=np.int64).reshape(-1, 2)
+                rows = rows[np.argsort(rows[:, 0], kind="stable")]
+                tag_ids, starts = np.unique(rows[:, 0], return_index=True)
+                for tag_id, ids in zip(tag_ids.tolist(), np.split(rows[:, 1], starts[1:])):
+                    if tag_id in existing:  # Rows left behind by deleted tags are ignored
+                        bitmaps.tags[tag_id] = to_bitmap(ids) & bitmaps.images
+                self.bitmaps = bitmaps
+                self.check.loaded()
+            return self.bitmaps
+
+    def query(
+        self,
+        db_session: Session,
+        any_of: Iterable[int] = (),
+        all_of: Iterable[int] = (),
+        exclude: Iterable[int] = (),
+        within: Optional[int] = None,
+    ) -> list[int]:
+        """The images with all of all_of, at least one of any_of (if given) and none of exclude,
+        restricted to the bitmap within (if given). Returned as layers (see rank), ordered by how
+        many of any_of each image has."""
+        any_of, all_of, exclude = set(any_of), set(all_of), set(exclude)
+        with self.lock:
+            bitmaps = self.get(db_session)
+            candidates = bitmaps.images if within is None else bitmaps.images & within
+            for tag_id in all_of:
+                candidates &= bitmaps.get(tag_id)
+            for tag_id in exclude:
+                candidates &= ~bitmaps.get(tag_id)
+            ranked = [bitmaps.get(tag_id) & candidates for tag_id in sorted(any_of)]
+        return rank(ranked) if any_of else [candidates]
+
+    def tags_of(self, db_session: Session, image_id: int, tag_ids: Iterable[int]) -> list[int]:
+        "Which of tag_ids the image has"
+        bit = 1 << image_id
+        with self.lock:
+            bitmaps = self.get(db_session)
+            return [tag_id for tag_id in tag_ids if bitmaps.get(tag_id) & bit]
+
+    def apply(self, changes: Changes) -> None:
+        with self.lock:
+            if self.bitmaps is None:
+                return
+            if changes.bulk:
+                self.bitmaps = None  # Rebuild on next use
+                return
+            if changes.table == image_tags.name:
+                for row in changes.deleted:
+                    self.bitmaps.untag(row["image_id"], row["tag_id"])
+                for row in changes.inserted:
+                    self.bitmaps.tag(row["image_id"], row["tag_id"])
+            elif changes.table == Image.__tablename__:
+                for row in changes.deleted:
+                    self.bitmaps.remove_image(row["id"])
+                for row in changes.inserted:
+                    self.bitmaps.add_image(row["id"])
+            else:
+                for row in changes.deleted:
+                    self.bitmaps.remove_tag(row["id"])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.bitmaps = None
+
+
+tag_index = ImageTagIndex()
+
+
+@on_commit(image_tags.name)
+@on_commit(Image.__tablename__)
+@on_commit(Tag.__tablename__)
+def _sync_tag_index(changes: Changes) -> None:
+    tag_index.apply(changes)
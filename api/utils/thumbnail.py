@@ -1,46 +1,74 @@
-#!/usr/local/bin/python3
-
-import glob
 from functools import partial
+from io import BytesIO
 from multiprocessing import Pool
 from pathlib import Path
 from timeit import default_timer as timer
+from typing import Callable, Iterable, Iterator, TypeVar
 
 from PIL import Image
 
+from api.utils.derivative_cache import DerivativeCache, derivative_path, write_atomic
+from api.utils.image_helper import DEFAULT_THUMBNAIL_WIDTH, calculate_thumbnail_size
+from config import Settings
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# (image_id, path, dimension_x, dimension_y)
+ImageRow = tuple[int, str, int, int]
+
+
+def standard_widths(settings: Settings) -> list[int]:
+    "The thumbnail widths the API serves by default, largest first."
+    return sorted({settings.THUMBNAIL_SIZE, DEFAULT_THUMBNAIL_WIDTH}, reverse=True)
 
-def generate_thumbnail(filename, zoom, outputdir="thumbnails"):
+
+def generate_thumbnails(image: ImageRow, widths: list[int], cache_dir: Path, format: str = "png"):
+    """Render any missing derivatives of a single image into the cache directory. Returns
+    (image_id, [(key, path), ...], seconds taken), or (image_id, exception, seconds taken)"""
+    start = timer()
+    image_id, path, dimension_x, dimension_y = image
     try:
-        # Load just once, then successively scale down
-        start = timer()
-        path = Path(filename)
-        im = Image.open(filename)
-        ar = im.size[1] / im.size[0]
-        im.thumbnail((im.size[0] * zoom, im.size[1] * zoom))  # (535//2,150))
-        im.save(path.parent.joinpath(outputdir).joinpath(path.name))
-        end = timer()
-        return path.name, end - start
+        derivatives = []
+        missing = []
+        for width in widths:
+            dimensions = calculate_thumbnail_size((dimension_x, dimension_y), width=width)
+            key = DerivativeCache.make_key(image_id, path, dimensions, format)
+            target = derivative_path(cache_dir, key, format)
+            derivatives.append((key, target))
+            if not target.exists():
+                missing.append((dimensions, target))
+        if missing:
+            # Load just once, then successively scale down
+            with Image.open(path) as im:
+                for dimensions, target in sorted(missing, reverse=True):
+                    im.thumbnail(dimensions)
+                    image_io = BytesIO()
+                    im.save(image_io, format)
+                    write_atomic(target, image_io.getvalue())
+        return image_id, derivatives, timer() - start
     except Exception as e:
-        return e
+        return image_id, e, timer() - start
 
 
-def parallel(files, zoom=0.25, outputdir="thumbnails", processes=8):
-    start = timer()
-    pool = Pool(processes)
-    gen = partial(generate_thumbnail, zoom=zoom, outputdir=outputdir)
-    results = pool.map(gen, files)
-    end = timer()
-    return end - start, results
+def parallel(
+    items: Iterable[T], func: Callable[[T], R], processes: int = 8, chunksize: int = 4
+) -> Iterator[R]:
+    "Map func over items with a process pool, yielding results as they complete."
+    with Pool(processes) as pool:
+        yield from pool.imap_unordered(func, items, chunksize)
 
 
-def seq(files, zoom=0.25, outputdir="thumbnails"):
-    start = timer()
-    output = [
-        generate_thumbnail(file, zoom=zoom, outputdir=outputdir) for file in files
-    ]
-    end = timer()
-    return end - start, output
+def seq(items: Iterable[T], func: Callable[[T], R]) -> Iterator[R]:
+    "The sequential equivalent of parallel, useful for debugging."
+    yield from map(func, items)
 
 
-if __name__ == "__main__":
-    files = glob.glob("D:\\RPGs\\Backdrops\\*.png")
+def thumbnail_worker(settings: Settings, format: str = "png") -> Callable[[ImageRow], tuple]:
+    "A picklable generate_thumbnails bound to the configured widths and cache directory"
+    return partial(
+        generate_thumbnails,
+        widths=standard_widths(settings),
+        cache_dir=Path(settings.THUMBNAIL_CACHE_DIR),
+        format=format,
+    )
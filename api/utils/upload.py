@@ -0,0 +1,30 @@
+from pathlib import Path
+
+import anyio
+from fastapi import UploadFile
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def write_upload(
+    upload: UploadFile,
+    path: Path,
+    header: bytes,
+    max_size: int,
+    chunk_size: int = UPLOAD_CHUNK_SIZE,
+) -> int:
+    """Copy an upload to disk a chunk at a time, after the header bytes that have already been read.
+    Raises UploadTooLarge as soon as more than max_size bytes have arrived. Returns the size."""
+    size = len(header)
+    async with await anyio.open_file(path, "wb") as f:
+        await f.write(header)
+        while chunk := await upload.read(chunk_size):
+            size += len(chunk)
+            if size > max_size:
+                raise UploadTooLarge
+            await f.write(chunk)
+    return size
@@ -0,0 +1,99 @@
+"""Peak memory of the /image/{image_id}/b64 response body, old (buffered) vs new (streamed).
+
+Each method runs in a fresh subprocess so that ru_maxrss only reflects that method.
+
+    python -m benchmarks.b64_memory --size-mb 50
+"""
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from types import SimpleNamespace
+
+from api.schemas import ImageB64
+from api.utils.image_helper import stream_base64_json
+
+
+def fake_image(path: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=1,
+        name="benchmark.png",
+        path=path,
+        type="backdrop",
+        focus_x=-1,
+        focus_y=-1,
+        hash="0" * 16,
+        dimension_x=4096,
+        dimension_y=4096,
+        tags=[],
+        palette="",
+        entities=[],
+        seq=None,
+        mime_type="image/png",
+        b64=None,
+    )
+
+
+def buffered(path: str) -> int:
+    "What the endpoint used to do: encode in memory, then let pydantic serialise it again"
+    image = fake_image(path)
+    with open(path, "rb") as f:
+        image.b64 = base64.b64encode(f.read()).decode("ascii")
+    return len(ImageB64.model_validate(image).model_dump_json(by_alias=True).encode())
+
+
+def streamed(path: str) -> int:
+    metadata = ImageB64.model_validate(fake_image(path))
+    metadata = metadata.model_dump_json(by_alias=True, exclude={"b64"}).encode()
+    return sum(len(chunk) for chunk in stream_base64_json(metadata, path))
+
+
+METHODS = {"buffered": buffered, "streamed": streamed}
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def run_child(method: str, path: str) -> None:
+    baseline = peak_rss_mb()
+    length = METHODS[method](path)
+    print(json.dumps({"baseline": baseline, "peak": peak_rss_mb(), "length": length}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=50)
+    parser.add_argument("--child", choices=METHODS)
+    parser.add_argument("--path")
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args.child, args.path)
+
+    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+        f.write(os.urandom(args.size_mb * 1024 * 1024))
+    try:
+        print(f"File size: {args.size_mb} MiB")
+        for method in METHODS:
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.b64_memory", "--child", method]
+                + ["--path", f.name],
+                capture_output=True,
+                check=True,
+                text=True,
+            )
+            result = json.loads(out.stdout)
+            print(
+                f"{method:>10}: peak RSS {result['peak']:8.1f} MiB "
+                f"(+{result['peak'] - result['baseline']:.1f} MiB), {result['length']} bytes"
+            )
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main()
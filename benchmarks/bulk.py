@@ -0,0 +1,97 @@
+"""Rows per second created, updated and deleted one request's worth at a time, or through the /bulk
+routes' service methods.
+
+One at a time is BaseService.create/update/delete for each row, a flush and a commit apiece, as
+a client making a request per message or tag does. Bulk is create_many/update_many/delete_many in
+batches of BULK_MAX_ITEMS. Each run gets a fresh session against a throwaway database, with the
+PRAGMAs the app sets.
+
+    python -m benchmarks.bulk [--rows 1000 10000]
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import Callable
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from api.schemas import (
+    MessageCreate,
+    MessageUpdate,
+    MessageUpdateID,
+    TagCreate,
+    TagUpdate,
+    TagUpdateID,
+)
+from api.services import MessageService, TagService
+from config import get_settings
+from core.db import Base
+from core.session import set_pragmas, sqlite_pragmas
+
+# The service, its create, update and bulk update schemas, and the values to create/update with
+SERVICES = {
+    "message": (
+        MessageService,
+        (MessageCreate, MessageUpdate, MessageUpdateID),
+        lambda n: {"message": f"Message #{n}"},
+    ),
+    "tag": (TagService, (TagCreate, TagUpdate, TagUpdateID), lambda n: {"tag": f"tag{n}"}),
+}
+
+
+def batches(items: list, size: int) -> list[list]:
+    return [items[n : n + size] for n in range(0, len(items), size)]
+
+
+def one_at_a_time(service, schemas: tuple, values: Callable, rows: int) -> tuple[float, ...]:
+    create, update, _ = schemas
+    start = time.perf_counter()
+    ids = [service.create(create(**values(n))).id for n in range(rows)]
+    created = time.perf_counter()
+    for id in ids:
+        service.update(id, update(**values(-id)))
+    updated = time.perf_counter()
+    for id in ids:
+        service.delete(id)
+    return created - start, updated - created, time.perf_counter() - updated
+
+
+def bulk(service, schemas: tuple, values: Callable, rows: int) -> tuple[float, ...]:
+    create, _, update = schemas
+    size = get_settings().BULK_MAX_ITEMS
+    start = time.perf_counter()
+    objs = [create(**values(n)) for n in range(rows)]
+    ids = [id for batch in batches(objs, size) for id in service.create_many(batch)]
+    created = time.perf_counter()
+    for batch in batches(ids, size):
+        service.update_many([update(id=id, **values(-id)) for id in batch])
+    updated = time.perf_counter()
+    for batch in batches(ids, size):
+        service.delete_many(batch)
+    return created - start, updated - created, time.perf_counter() - updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bulk.sqlite')}")
+        set_pragmas(engine, sqlite_pragmas(get_settings()))
+        Base.metadata.create_all(engine)
+        for rows in args.rows:
+            print(f"{rows} rows, rows/s for create / update / delete")
+            for name, (service_type, schemas, values) in SERVICES.items():
+                for label, fn in (("one at a time", one_at_a_time), ("bulk", bulk)):
+                    with Session(engine) as session:
+                        seconds = fn(service_type(session), schemas, values, rows)
+                    rates = " / ".join(f"{rows / s:8.0f}" for s in seconds)
+                    print(f"  {name:>7} {label:>13}: {rates}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
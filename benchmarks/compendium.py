@@ -0,0 +1,89 @@
+"""Time and peak memory to import a bestiary, json.load + ORM add_all vs import_monsters (api.utils.compendium).
+
+Writes a throwaway bestiary of made-up monsters and imports it into a fresh SQLite database each
+way, then imports it again with the streaming importer to show a re-import of unchanged data.
+
+    python -m benchmarks.compendium [--monsters 20000]
+"""
+import argparse
+import json
+import os
+import tempfile
+import tracemalloc
+from timeit import default_timer as timer
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from api.models import Entity
+from api.utils.compendium import import_monsters, iter_json_array
+from core.db import Base
+
+
+def make_monster(n: int) -> dict:
+    return {
+        "name": f"Monster {n}",
+        "source": f"S{n % 20}",
+        "page": n % 300,
+        "ac": [{"ac": 10 + n % 10, "from": ["natural armor"]}],
+        "hp": {"average": 22, "formula": "5d8"},
+        "cr": "1/2",
+        "dex": 8 + n % 10,
+        "trait": [{"name": "Keen Smell", "entries": ["Advantage on smell checks. " * 10]}] * 3,
+        "action": [{"name": "Bite", "entries": ["{@atk mw} {@hit 4} to hit, reach 5 ft. " * 5]}],
+    }
+
+
+def measure(fn) -> tuple[float, float]:
+    "Seconds taken, then peak MiB allocated in a second run (tracemalloc slows everything down)"
+    start = timer()
+    fn("timed")
+    elapsed = timer() - start
+    tracemalloc.start()
+    fn("traced")
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--monsters", type=int, default=20_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bestiary.json")
+        with open(path, "w") as f:
+            json.dump({"monster": [make_monster(n) for n in range(args.monsters)]}, f)
+        size = os.path.getsize(path) / 1024 / 1024
+        print(f"{args.monsters} monsters, {size:.0f} MiB of json")
+
+        def database(name: str) -> Session:
+            engine = create_engine(f"sqlite:///{os.path.join(directory, name + '.sqlite')}")
+            Base.metadata.create_all(engine)
+            return Session(engine)
+
+        def load_all(run: str):
+            with database(f"load-{run}") as session, open(path) as f:
+                session.add_all(Entity.from_jsondata(m) for m in json.load(f)["monster"])
+                session.commit()
+
+        def stream(name: str):
+            with database(name) as session, open(path) as f:
+                import_monsters(session, iter_json_array(f, "monster"))
+                session.commit()
+
+        results = {
+            "json.load + add_all": measure(load_all),
+            "streamed": measure(lambda run: stream(f"stream-{run}")),
+            # The same databases again, so every monster is unchanged
+            "streamed, unchanged": measure(lambda run: stream(f"stream-{run}")),
+        }
+
+    for name, (elapsed, peak) in results.items():
+        rate = args.monsters / elapsed
+        print(f"  {name:>20}: {elapsed:6.2f} s ({rate:6.0f}/s), peak {peak:6.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""p50/p99 latency of HTTP requests and websocket round trips under mixed load, with and without
+ASYNC_DATABASE.
+
+Runs the real server (uvicorn, one worker) against a throwaway SQLite database, once per setting.
+HTTP clients page through /image/ and /entity/ while websocket clients send a message every
+--ws-interval and time how long the broadcast takes to come back. With the synchronous session every
+query holds up the event loop, so the websockets wait behind the HTTP traffic.
+
+    python -m benchmarks.concurrency [--images 20000] [--http 16] [--ws 8] [--seconds 10]
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import websockets
+from sqlalchemy import create_engine, insert
+
+from api.models import Entity, Image, Tag, image_tags
+from core.db import Base
+
+
+def populate(url: str, images: int) -> None:
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Tag), [{"tag": f"tag{n}"} for n in range(50)])
+        rows = [
+            {"name": f"{n}.png", "path": f"/images/{n}.png", "dimension_x": 1, "dimension_y": 1}
+            for n in range(images)
+        ]
+        connection.execute(insert(Image), rows)
+        pairs = {(random.randint(1, images), random.randint(1, 50)) for _ in range(images * 3)}
+        connection.execute(insert(image_tags), [{"image_id": i, "tag_id": t} for i, t in pairs])
+        entities = [{"name": f"Monster {n}", "source": "MM"} for n in range(images // 4)]
+        connection.execute(insert(Entity), entities)
+    engine.dispose()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(times: list[float]) -> str:
+    if len(times) < 2:
+        return "no samples"
+    cuts = statistics.quantiles(times, n=100)
+    return f"p50 {1000 * cuts[49]:7.1f} ms  p99 {1000 * cuts[98]:7.1f} ms  (n={len(times)})"
+
+
+async def load(port: int, args) -> tuple[list[float], list[float]]:
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.seconds
+    http_times: list[float] = []
+    ws_times: list[float] = []
+
+    async def http_client(client: httpx.AsyncClient):
+        while time.monotonic() < deadline:
+            path = random.choice(["/image/", "/entity/"])
+            start = time.perf_counter()
+            rv = await client.get(path, params={"page": random.randint(1, 50), "size": 50})
+            rv.raise_for_status()
+            http_times.append(time.perf_counter() - start)
+
+    async def ws_client(n: int):
+        async with websockets.connect(f"ws://127.0.0.1:{port}/live/socket/{n}") as ws:
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                await ws.send(f'{{"sent": {start}}}')
+                await ws.recv()
+                ws_times.append(time.perf_counter() - start)
+                await asyncio.sleep(args.ws_interval)
+
+    async with httpx.AsyncClient(base_url=base, timeout=60) as client:
+        await asyncio.gather(
+            *(http_client(client) for _ in range(args.http)),
+            *(ws_client(n) for n in range(args.ws)),
+        )
+    return http_times, ws_times
+
+
+def run(url: str, async_database: bool, args) -> tuple[list[float], list[float]]:
+    port = free_port()
+    env = {
+        **os.environ,
+        "DATABASE_URL": url,
+        "ASYNC_DATABASE": str(async_database),
+        "JOB_WORKERS": "0",
+    }
+    command = [sys.executable, "-m", "uvicorn", "api.main:app", "--port", str(port)]
+    output = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    server = subprocess.Popen(command, env=env, **output)
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/health")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        return asyncio.run(load(port, args))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=20_000)
+    parser.add_argument("--http", type=int, default=16, help="Concurrent HTTP clients")
+    parser.add_argument("--ws", type=int, default=8, help="Websocket clients")
+    parser.add_argument("--ws-interval", type=float, default=0.05, help="Seconds between messages")
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'concurrency.sqlite')}"
+        populate(url, args.images)
+        print(f"{args.images} images, {args.http} HTTP clients, {args.ws} websocket clients")
+        for async_database in (False, True):
+            http_times, ws_times = run(url, async_database, args)
+            print(f"  ASYNC_DATABASE={async_database}")
+            print(f"    {'HTTP':>9}: {percentiles(http_times)}")
+            print(f"    {'websocket':>9}: {percentiles(ws_times)}")
+
+
+if __name__ == "__main__":
+    main()
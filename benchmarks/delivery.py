@@ -0,0 +1,62 @@
+"""CPU time to send an image file body, FileResponse vs FileDelivery (api.utils.delivery).
+
+Drives each response as an ASGI app with a send() that throws the body away, so this measures only
+the work done in the worker. With pathsend the server does the copy, so the worker does almost none.
+
+    python -m benchmarks.delivery [--size-mb 50] [--repeat 10]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from fastapi.responses import FileResponse
+
+from api.utils.delivery import FileDelivery
+
+
+async def discard(message: dict) -> None:
+    pass
+
+
+def cpu_ms(make_response, extensions: dict, repeat: int) -> float:
+    scope = {"type": "http", "path": "/benchmark", "extensions": extensions}
+
+    async def run():
+        for _ in range(repeat):
+            await make_response()(scope, None, discard)
+
+    start = time.process_time()
+    asyncio.run(run())
+    return 1000 * (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+        f.write(os.urandom(args.size_mb * 1024 * 1024))
+    try:
+        stat_result = os.stat(f.name)
+        methods = {
+            "FileResponse": (lambda: FileResponse(f.name, stat_result=stat_result), {}),
+            "FileDelivery, mmap": (lambda: FileDelivery(f.name, stat_result), {}),
+            "FileDelivery, pathsend": (
+                lambda: FileDelivery(f.name, stat_result),
+                {"http.response.pathsend": {}},
+            ),
+        }
+        print(f"File size: {args.size_mb} MiB")
+        for name, (make_response, extensions) in methods.items():
+            ms = cpu_ms(make_response, extensions, args.repeat)
+            print(f"  {name:>22}: {ms:8.2f} ms CPU per response")
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Per-image palette latency and agreement, NumPy k-means (core.colour) vs ColorThief.
+
+Runs over a directory of images, or over generated fixtures (like the test suite's) if none given.
+Agreement is the mean distance (in RGB units, out of a possible 441) from each ColorThief colour to
+the nearest colour in our palette. Lower is closer; MMCQ and k-means split busy images differently,
+so expect the dominant colours to match and the minor ones to drift.
+
+    python -m benchmarks.palette [--images DIR] [--count 10] [--quality 2]
+"""
+import argparse
+import pathlib
+import random
+import statistics
+import tempfile
+from timeit import default_timer as timer
+
+import numpy as np
+from colorthief import ColorThief
+from PIL import Image as PImage
+from PIL import ImageDraw
+
+from core.colour import extract_pallete
+
+
+def make_fixtures(directory: pathlib.Path, count: int) -> list[pathlib.Path]:
+    random.seed(0)
+    paths = []
+    for n in range(count):
+        width, height = 2912, 1632
+        image = PImage.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(image)
+        for _ in range(50):
+            x = random.randint(0, width - 1)
+            y = random.randint(0, height - 1)
+            x2 = random.randint(x, width - 1)
+            y2 = random.randint(y, height - 1)
+            col = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+            draw.rectangle((x, y, x2, y2), fill=col)
+        image.save(path := directory / f"{n}.png")
+        paths.append(path)
+    return paths
+
+
+def agreement(reference: list, palette: list) -> float:
+    a = np.array(reference, dtype=float)[:, None, :]
+    b = np.array(palette, dtype=float)[None, :, :]
+    return float(np.sqrt(((a - b) ** 2).sum(axis=2)).min(axis=1).mean())
+
+
+def timed(fn, *args, **kwargs):
+    start = timer()
+    result = fn(*args, **kwargs)
+    return result, timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=pathlib.Path)
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--quality", type=int, default=2)
+    parser.add_argument("--depth", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images:
+            paths = sorted(p for p in args.images.iterdir() if p.is_file())[: args.count]
+        else:
+            paths = make_fixtures(pathlib.Path(tmp), args.count)
+
+        ours, theirs, distances = [], [], []
+        for path in paths:
+            palette, t_ours = timed(extract_pallete, path, depth=args.depth, quality=args.quality)
+            reference, t_theirs = timed(
+                ColorThief(path).get_palette, color_count=args.depth, quality=args.quality
+            )
+            ours.append(t_ours)
+            theirs.append(t_theirs)
+            distances.append(agreement(reference, palette))
+            print(
+                f"{path.name:>24}: {t_ours * 1000:8.1f}ms vs {t_theirs * 1000:8.1f}ms, "
+                f"mean colour distance {distances[-1]:.1f}"
+            )
+
+    print(f"\n{len(paths)} images, depth={args.depth}, quality={args.quality}")
+    print(f"  numpy k-means: median {statistics.median(ours) * 1000:.1f}ms per image")
+    print(f"  colorthief:    median {statistics.median(theirs) * 1000:.1f}ms per image")
+    print(f"  speedup:       {statistics.median(theirs) / statistics.median(ours):.1f}x")
+    print(f"  agreement:     mean colour distance {statistics.mean(distances):.1f} (of 441)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Latency of picking a random image, ORDER BY random() vs the in-memory id pools (api.utils.sampler).
+
+Builds a throwaway SQLite database of each size, then times both ways of fetching one random row,
+with and without a type filter.
+
+    python -m benchmarks.random_sample [--sizes 10000 100000 1000000] [--repeat 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+from timeit import default_timer as timer
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import Session
+
+from api.models import Image, ImageType
+from api.utils.sampler import RandomSampler
+from core.db import Base
+
+
+def populate(session: Session, size: int) -> None:
+    types = list(ImageType)
+    rows = [
+        {
+            "name": f"{n}.png",
+            "path": f"/images/{n}.png",
+            "type": random.choice(types),
+            "hash": None,
+            "dimension_x": 1920,
+            "dimension_y": 1080,
+            "palette": "",
+            "focus_x": -1,
+            "focus_y": -1,
+        }
+        for n in range(size)
+    ]
+    for start in range(0, size, 50_000):
+        session.execute(insert(Image), rows[start : start + 50_000])
+    session.commit()
+
+
+def timed(fn, repeat: int) -> float:
+    "Median milliseconds per call"
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        fn()
+        times.append(timer() - start)
+    return 1000 * statistics.median(times)
+
+
+def run(size: int, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'images.sqlite')}")
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            populate(session, size)
+            everything = RandomSampler(Image)
+            by_type = RandomSampler(Image, "type")
+
+            start = timer()
+            everything.choice(session)
+            by_type.choice(session)
+            load = 1000 * (timer() - start)
+
+            def order_by_random(type=None):
+                q = select(Image).order_by(func.random()).limit(1)
+                if type is not None:
+                    q = q.where(Image.type == type)
+                session.scalar(q)
+                session.expunge_all()
+
+            def sampled(sampler, key=None):
+                session.get(Image, sampler.choice(session, key))
+                session.expunge_all()
+
+            results = {
+                "ORDER BY random()": timed(order_by_random, repeat),
+                "sampler": timed(lambda: sampled(everything), repeat),
+                "ORDER BY random(), type=map": timed(
+                    lambda: order_by_random(ImageType.map), repeat
+                ),
+                "sampler, type=map": timed(lambda: sampled(by_type, ImageType.map), repeat),
+            }
+        engine.dispose()
+    print(f"{size} images (pools loaded in {load:.0f} ms)")
+    for name, ms in results.items():
+        print(f"  {name:>28}: {ms:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    random.seed(0)
+    for size in args.sizes:
+        run(size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
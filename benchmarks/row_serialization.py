@@ -0,0 +1,104 @@
+"""Rows per second serialized for pages of /entity/ and /image/, from ORM objects or Core rows.
+
+The ORM path is what the list routes did before BaseService.get_some_json: load the page as
+instances (with the relationships the schema reads), validate them from_attributes and dump the
+JSON as FastAPI would. The Core path is get_some_json. Each page gets a fresh session, as a request
+would, against a throwaway database.
+
+    python -m benchmarks.row_serialization [--rows 20000] [--size 100] [--pages 100]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from fastapi_pagination.api import set_page
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+from api.models import Entity, Image, Tag, image_tags
+from api.routers import entity, image
+from api.schemas import Entity as EntitySchema
+from api.schemas import ImageURL
+from api.utils.filters import loader_options
+from api.utils.pagination import Page, Params, paginate, paginate_rows
+from api.utils.rows import row_serializer
+from core.db import Base
+
+ROUTES = {
+    "/entity/": (Entity, EntitySchema, entity.LIST_LOAD),
+    "/image/": (Image, ImageURL, image.LIST_LOAD),
+}
+
+
+def populate(url: str, rows: int) -> None:
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Tag), [{"tag": f"tag{n}"} for n in range(50)])
+        images = [
+            {"name": f"{n}.png", "path": f"/images/{n}.png", "dimension_x": 1, "dimension_y": 1}
+            for n in range(rows)
+        ]
+        connection.execute(insert(Image), images)
+        tags = [
+            {"image_id": i, "tag_id": t}
+            for i in range(1, rows + 1)
+            for t in random.sample(range(1, 51), 3)
+        ]
+        connection.execute(insert(image_tags), tags)
+        data = json.dumps({"str": 10, "dex": 14, "trait": [{"name": "Keen Senses"}] * 3}).encode()
+        entities = [
+            {"name": f"Monster {n}", "image_id": n + 1, "cr": n % 20, "data": data}
+            for n in range(rows)
+        ]
+        connection.execute(insert(Entity), entities)
+    engine.dispose()
+
+
+def orm_page(session: Session, model, schema, load, params: Params) -> bytes:
+    q = select(model).options(*loader_options(model, load))
+    page = paginate(session, q, params=params)
+    adapter = TypeAdapter(Page[schema])
+    content = adapter.dump_python(
+        adapter.validate_python(page, from_attributes=True), mode="json", by_alias=True
+    )
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def rows_page(session: Session, model, schema, load, params: Params) -> bytes:
+    return paginate_rows(session, select(model), row_serializer(model, schema), params).body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=100)
+    args = parser.parse_args()
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'rows.sqlite')}"
+        populate(url, args.rows)
+        engine = create_engine(url)
+        print(f"{args.rows} rows, pages of {args.size}")
+        for route, (model, schema, load) in ROUTES.items():
+            for name, fn in (("ORM", orm_page), ("Core rows", rows_page)):
+                pages = [random.randint(1, args.rows // args.size) for _ in range(args.pages)]
+                with set_page(Page):
+                    start = time.perf_counter()
+                    for page in pages:
+                        with Session(engine) as session:
+                            fn(session, model, schema, load, Params(page=page, size=args.size))
+                    seconds = time.perf_counter() - start
+                rows = args.pages * args.size
+                print(f"  {route:>8} {name:>9}: {rows / seconds:8.0f} rows/s")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
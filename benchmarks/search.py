@@ -0,0 +1,109 @@
+"""Latency of /image/search, name ILIKE '%x%' vs the FTS5 index (api.utils.search).
+
+Builds a throwaway SQLite database of images with made-up names and tags (the search table is filled
+by its triggers as the rows go in, so the insert time includes them), then times a page of results
+for a few queries.
+
+    python -m benchmarks.search [--images 100000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+from timeit import default_timer as timer
+
+from sqlalchemy import create_engine, func, insert, literal_column, select
+from sqlalchemy.orm import Session
+
+from api.models import Image, Tag, image_tags
+from api.utils.search import SEARCH_TABLE, image_search, match_query, relevance
+from core.db import Base
+
+WORDS = (
+    "dragon lair cave forest tavern castle ruins swamp temple market harbour tower crypt "
+    "mountain village bridge camp mine desert glacier throne library sewer arena"
+).split()
+
+
+def populate(session: Session, images: int) -> float:
+    "Returns the time taken to insert the images, including the search triggers"
+    tags = [{"tag": word} for word in WORDS]
+    session.execute(insert(Tag), tags)
+    rows = [
+        {
+            "name": " ".join(random.sample(WORDS, 3)) + f" {n}.png",
+            "path": f"/images/{n}.png",
+            "dimension_x": 1,
+            "dimension_y": 1,
+        }
+        for n in range(images)
+    ]
+    start = timer()
+    session.execute(insert(Image), rows)
+    pairs = [
+        {"image_id": image_id, "tag_id": tag_id}
+        for image_id in range(1, images + 1)
+        for tag_id in random.sample(range(1, len(WORDS) + 1), 2)
+    ]
+    session.execute(insert(image_tags), pairs)
+    session.commit()
+    return timer() - start
+
+
+def timed(fn, repeat: int) -> float:
+    "Median milliseconds per call"
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        fn()
+        times.append(timer() - start)
+    return 1000 * statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'images.sqlite')}")
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            elapsed = populate(session, args.images)
+            print(f"{args.images} images inserted in {elapsed:.1f} s (with search triggers)")
+
+            def page(q):
+                session.scalar(select(func.count()).select_from(q.subquery()))
+                session.scalars(q.limit(50)).all()
+                session.expunge_all()
+
+            def ilike(text: str):
+                q = select(Image).where(Image.name.ilike(f"%{text}%")).order_by(Image.id)
+                page(q)
+
+            def fts(text: str):
+                # As ImageService.smart_search does it
+                matches = literal_column(SEARCH_TABLE).op("MATCH")(match_query(text))
+                session.scalar(select(func.count()).select_from(image_search).where(matches))
+                q = (
+                    select(image_search.c.rowid)
+                    .where(matches)
+                    .order_by(relevance(), image_search.c.rowid)
+                    .limit(50)
+                )
+                ids = session.scalars(q).all()
+                session.scalars(select(Image).where(Image.id.in_(ids))).all()
+                session.expunge_all()
+
+            for text in ("dragon", "drag", "dragon lair", "glacier 9999"):
+                print(f"  {text!r}")
+                print(f"    {'ILIKE':>6}: {timed(lambda: ilike(text), args.repeat):8.3f} ms")
+                print(f"    {'FTS5':>6}: {timed(lambda: fts(text), args.repeat):8.3f} ms")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
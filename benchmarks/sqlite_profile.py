@@ -0,0 +1,113 @@
+"""Read and write throughput of a SQLite file database under each connection profile (core.session).
+
+Reader threads page through images with their tags while writer threads tag images, one small
+transaction at a time, against a throwaway database. "database is locked" errors are counted
+rather than retried.
+
+    python -m benchmarks.sqlite_profile [--images 20000] [--readers 4] [--writers 2] [--seconds 5]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, delete, insert, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, selectinload
+
+from api.models import Image, Tag, image_tags
+from config import Settings
+from core.db import Base
+from core.session import engine_options, set_pragmas, sqlite_pragmas
+
+PROFILES = {
+    # What get_engine did before the PRAGMAs: rollback journal, default cache
+    "default": None,
+    "WAL, synchronous=FULL": Settings(SQLITE_SYNCHRONOUS="FULL"),
+    "WAL, no mmap": Settings(SQLITE_MMAP_SIZE=0),
+    "tuned (Settings defaults)": Settings(),
+}
+
+
+def populate(url: str, images: int) -> None:
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Tag), [{"tag": f"tag{n}"} for n in range(50)])
+        rows = [
+            {"name": f"{n}.png", "path": f"/images/{n}.png", "dimension_x": 1, "dimension_y": 1}
+            for n in range(images)
+        ]
+        connection.execute(insert(Image), rows)
+    engine.dispose()
+
+
+def run(url: str, settings: Settings | None, args) -> tuple[int, int, int]:
+    if settings is None:
+        engine = create_engine(url, pool_pre_ping=True)
+    else:
+        engine = create_engine(url, **engine_options(url, settings))
+        set_pragmas(engine, sqlite_pragmas(settings))
+    deadline = time.monotonic() + args.seconds
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def count(name: str) -> None:
+        with lock:
+            counts[name] += 1
+
+    def reader() -> None:
+        while time.monotonic() < deadline:
+            offset = random.randint(0, args.images - 50)
+            with Session(engine) as session:
+                q = select(Image).order_by(Image.id).offset(offset).limit(50)
+                session.scalars(q.options(selectinload(Image.tags))).all()
+            count("reads")
+
+    def writer() -> None:
+        while time.monotonic() < deadline:
+            row = {"image_id": random.randint(1, args.images), "tag_id": random.randint(1, 50)}
+            try:
+                with engine.begin() as connection:
+                    connection.execute(delete(image_tags).filter_by(**row))
+                    connection.execute(insert(image_tags), row)
+                count("writes")
+            except OperationalError:
+                count("locked")
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return counts["reads"], counts["writes"], counts["locked"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=20_000)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+    random.seed(0)
+
+    print(f"{args.images} images, {args.readers} readers, {args.writers} writers")
+    for name, settings in PROFILES.items():
+        # A fresh database each time, as journal_mode=WAL sticks to the file
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{os.path.join(directory, 'profile.sqlite')}"
+            populate(url, args.images)
+            reads, writes, locked = run(url, settings, args)
+        print(
+            f"  {name:>26}: {reads / args.seconds:7.0f} pages/s, "
+            f"{writes / args.seconds:7.0f} writes/s, {locked} locked"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Latency of a ranked /image/tag query, GROUP BY over image_tags vs the tag bitmaps (api.utils.tag_index).
+
+Builds a throwaway SQLite database with tags handed out Zipf-style (a few common tags, a long tail),
+then times one page of "images with the most of these tags" both ways.
+
+    python -m benchmarks.tag_match [--images 100000] [--tags 500] [--per-image 6] [--query 3]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+from timeit import default_timer as timer
+
+from sqlalchemy import create_engine, func, insert, select, text
+from sqlalchemy.orm import Session
+
+from api.models import Image, Tag, image_tags
+from api.utils.tag_index import ImageTagIndex, page_of
+from core.db import Base
+
+
+def populate(session: Session, images: int, tags: int, per_image: int) -> None:
+    session.execute(insert(Tag), [{"tag": f"tag{n}"} for n in range(tags)])
+    rows = [
+        {"name": f"{n}.png", "path": f"/images/{n}.png", "dimension_x": 1, "dimension_y": 1}
+        for n in range(images)
+    ]
+    session.execute(insert(Image), rows)
+    weights = [1 / (rank + 1) for rank in range(tags)]
+    pairs = set()
+    for image_id in range(1, images + 1):
+        for tag_id in random.choices(range(1, tags + 1), weights, k=per_image):
+            pairs.add((image_id, tag_id))
+    session.execute(insert(image_tags), [{"image_id": i, "tag_id": t} for i, t in pairs])
+    session.commit()
+
+
+def timed(fn, repeat: int) -> float:
+    "Median milliseconds per call"
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        fn()
+        times.append(timer() - start)
+    return 1000 * statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=100_000)
+    parser.add_argument("--tags", type=int, default=500)
+    parser.add_argument("--per-image", type=int, default=6)
+    parser.add_argument("--query", type=int, default=3, help="Tags per query")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'images.sqlite')}")
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            populate(session, args.images, args.tags, args.per_image)
+            index = ImageTagIndex()
+            start = timer()
+            index.get(session)
+            load = 1000 * (timer() - start)
+            queries = [random.sample(range(1, 21), args.query) for _ in range(args.repeat)]
+
+            def group_by():
+                taglist = random.choice(queries)
+                s = (
+                    select(Image.id, func.count(image_tags.c.image_id).label("match_count"))
+                    .join(Image, Image.id == image_tags.c.image_id)
+                    .where(image_tags.c.tag_id.in_(taglist))
+                    .group_by(image_tags.c.image_id)
+                    .order_by(text("match_count DESC"))
+                    .subquery()
+                )
+                q = select(Image).join(s, s.c.id == Image.id)
+                session.scalar(select(func.count()).select_from(q.subquery()))
+                session.scalars(q.limit(50).offset(50)).all()
+                session.expunge_all()
+
+            def bitmaps():
+                layers = index.query(session, any_of=random.choice(queries))
+                sum(layer.bit_count() for layer in layers)
+                ids = page_of(layers, 50, 50)
+                session.scalars(select(Image).where(Image.id.in_(ids))).all()
+                session.expunge_all()
+
+            results = {
+                "GROUP BY": timed(group_by, args.repeat),
+                "bitmaps": timed(bitmaps, args.repeat),
+            }
+        engine.dispose()
+
+    print(f"{args.images} images, {args.tags} tags, {args.query} tags per query")
+    print(f"  bitmaps loaded in {load:.0f} ms")
+    for name, ms in results.items():
+        print(f"  {name:>10}: {ms:8.3f} ms per page")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ import pathlib
 import shutil
 import uuid
 from collections import namedtuple
+from functools import partial
+from multiprocessing import Pool
 from typing import Annotated, Callable, Iterator, Optional
 
 import typer
@@ -13,12 +15,17 @@ from alembic.config import Config
 from PIL import Image as PImage
 from rich import print
 from rich.progress import Progress, track
-from sqlalchemy import select, update
+from sqlalchemy import func, insert, or_, select, update
 
 from api.models import Combat, Entity, Image, ImageType, Message, Participant
-from core.colour import extract_pallete
+from api.utils.compendium import BATCH_SIZE, import_monsters, iter_json_array
+from api.utils.image_helper import hash_image, image_palettes, parse_image_file
+from api.utils.thumbnail import parallel, thumbnail_worker
+from config import get_settings
+from core.colour import pack_palette
+from core.phash import HASH_BITS
 from core.session import create_session
-from core.utils import make_seq, rgb_to_hex
+from core.utils import make_seq
 
 app = typer.Typer()
 
@@ -68,8 +75,16 @@ def parse_image_directory(
             help="Attempt to attach any images found to entities within the database based on name"
         ),
     ] = False,
+    palette: Annotated[
+        bool, typer.Option(help="Extract each image's colour palette as it is parsed")
+    ] = False,
+    processes: Annotated[int, typer.Option(help="Number of worker processes")] = 8,
+    batch_size: Annotated[int, typer.Option(help="Number of images stored per commit")] = 500,
 ):
-    """Parse a directory for image files, and then store them in the database. Optionally attempt to find an entity that matches and link the image to the entity"""
+    """Parse a directory for image files, and then store them in the database. Optionally attempt to find an entity that matches and link the image to the entity.
+
+    Files are read by a pool of worker processes and stored in batches, each in its own commit, so
+    an interrupted run can be restarted and will carry on from where it stopped."""
     print, input = make_print("[red]\\[parse-directory][/red]  ", verbose)
 
     if force_reparse:
@@ -90,39 +105,74 @@ def parse_image_directory(
         iterable = multiple_file_types(path.rglob, extensions_list)
     else:
         iterable = multiple_file_types(path.glob, extensions_list)
-    if not verbose:
-        iterable = track([i for i in iterable], description="Processing...")
-    i = 0
-    seq = make_seq()
+    # One query for everything already stored, rather than one per file
+    existing: dict[str, int] = dict(
+        db_session.execute(select(Image.path, Image.id).where(Image.type == image_type)).all()
+    )
+    paths = []
     for image_path in iterable:
-        image = db_session.scalar(
-            select(Image).where(
-                Image.path == str(image_path) and Image.type == image_type  # type: ignore
-            )
-        )
-        if image:
-            print(
-                f"Found image ([yellow]{image.type.name}[/yellow]) at [green]{image_path}[/green]",
-                end="",
-            )
-            if force_reparse:
-                db_session.delete(image)
-                print(" - [red]Removing[/red]", np=True)
-            else:
-                print(" - [yellow]Skipping[/yellow]", np=True)
-                continue
-        if attach_entity:
-            new_image = Image.create_from_local_file(image_path, type=image_type, seq=seq)
-            e = db_session.scalar(select(Entity).where(Entity.name.ilike(image_path.stem)))
-            if e:
-                e.image = new_image
+        if str(image_path) in existing and not force_reparse:
+            print(f"Found image at [green]{image_path}[/green] - [yellow]Skipping[/yellow]")
         else:
-            new_image = Image.create_from_local_file(image_path, type=image_type, seq=seq)
-        db_session.add(new_image)
-        i = i + 1
-        print(f"Adding image ([yellow]{new_image.type}[/yellow]) at [green]{image_path}[/green]")
-    print(f"{i} images parsed <Seq={seq}>", override=True)
-    db_session.commit()
+            paths.append(image_path)
+    entities: dict[str, int] = {}
+    if attach_entity:
+        for entity_id, name in db_session.execute(select(Entity.id, Entity.name)):
+            entities.setdefault(name.lower(), entity_id)
+
+    seq = make_seq()
+    worker = partial(parse_image_file, palette_size=5 if palette else 0)
+    added, replaced, failed = 0, 0, 0
+    new_rows: list[dict] = []
+    replaced_rows: list[dict] = []
+
+    def store() -> None:
+        "Write out the current batch in a single commit"
+        links: list[dict] = []
+        if new_rows:
+            q = insert(Image).returning(Image.id, Image.path)
+            for image_id, image_path in db_session.execute(q, new_rows):
+                existing[image_path] = image_id
+        if replaced_rows:
+            db_session.execute(update(Image), replaced_rows)
+        for row in new_rows + replaced_rows:
+            entity_id = entities.get(pathlib.Path(row["path"]).stem.lower())
+            if entity_id is not None:
+                links.append({"id": entity_id, "image_id": existing[row["path"]]})
+        if links:
+            db_session.execute(update(Entity), links)
+        db_session.commit()
+        new_rows.clear()
+        replaced_rows.clear()
+
+    with Progress() as progress:
+        task = progress.add_task("[red]Processing...", total=len(paths))
+        for image_path, columns in parallel(paths, worker, processes=processes, chunksize=8):
+            progress.update(task, advance=1)
+            if isinstance(columns, Exception):
+                failed += 1
+                print(f"Error reading [green]{image_path}[/green]: {columns}", override=True)
+                continue
+            if "palette" in columns:  # Otherwise a replaced row keeps the one it has
+                columns["palette_lab"] = pack_palette(columns["palette"])
+            row = {"path": image_path, "type": image_type, "seq": seq, **columns}
+            if image_path in existing:
+                replaced_rows.append({"id": existing[image_path], **row})
+                replaced += 1
+                print(f"Replacing image at [green]{image_path}[/green]")
+            else:
+                new_rows.append({"name": pathlib.Path(image_path).stem, **row})
+                added += 1
+                print(
+                    f"Adding image ([yellow]{image_type}[/yellow]) at [green]{image_path}[/green]"
+                )
+            if len(new_rows) + len(replaced_rows) >= batch_size:
+                store()
+        store()
+    print(
+        f"{added} images added, {replaced} replaced, {failed} failed <Seq={seq}>",
+        override=True,
+    )
 
 
 @app.command()
@@ -141,13 +191,12 @@ def parse_compendium(
             help="The folder to scan. If not supplied, will attempt to guess the folder (using the usual structure of the 5e.tools codebase)"
         ),
     ] = None,
+    batch_size: Annotated[int, typer.Option(help="Number of entities per insert")] = BATCH_SIZE,
 ):
-    """Parse a 5e.tools file for entities to store in the database. This is horrible and globby but works for the moment."""
+    """Parse a 5e.tools file for entities to store in the database. Monsters are read from the file one
+    at a time and written in batches; re-running it updates only the monsters that have changed."""
     print, input = make_print("[red]\[parse-compendium][/red] ", verbose)
     db_session = create_session()
-    with open(compendium_file, "r") as f:
-        data = json.load(f)
-    seq = make_seq()
 
     if process_images and image_directory is None:
         process_images = True
@@ -171,55 +220,41 @@ def parse_compendium(
     else:
         bestiaryimagepath = None
 
-    i = 0
-    j = 0
-    for monster in track(data["monster"], description="processing"):
-        try:
-            try:
-                cr = (
-                    (monster["cr"] if isinstance(monster["cr"], str) else monster["cr"]["cr"])
-                    if "cr" in monster
-                    else ""
-                )
-                hit_dice = monster["hp"]["formula"] if "hp" in monster else ""
-                ac = find_max(monster, "ac") if "ac" in monster else 0
-                init = (monster.get("dex", 10) - 10) // 2 if "dex" in monster else 0
-            except KeyError:
-                # print(monster, ac, cr, hit_dice, override=True)
-                continue
-            m = Entity(
-                name=monster["name"],
-                hit_dice=hit_dice,
-                ac=ac,
-                cr=cr,
-                initiative_modifier=init,
-                is_PC=False,
-                source=monster["source"],
-                source_page=monster["page"],
-                data=json.dumps(monster).encode(),
-                seq=seq,
-            )
-            if process_images and monster.get("hasToken", False) and bestiaryimagepath is not None:
-                datapath = bestiaryimagepath.joinpath(monster["source"].upper())
-                if not datapath.is_dir():
-                    continue
-
-                file = list(datapath.glob(f'{monster.get("name")}*'))
-                if file:
-                    file = file[0]
-                    image = Image.create_from_local_file(file, type=ImageType.character, seq=seq)
-                    m.image = image
-                    db_session.add(image)
-                    j = j + 1
-
-        except Exception as e:
-            print(monster)
-            raise e
-        print(f"Parsing {monster['name']}")
-        db_session.add(m)
-        i = i + 1
-    print(f"{i} entites parsed. {j} images created.", override=True)
+    images = 0
+    seq = make_seq()
+
+    def image_for(monster: dict) -> Optional[int]:
+        "Called for each new entity: find its token and store it as an image"
+        nonlocal images
+        if not (process_images and monster.get("hasToken", False) and bestiaryimagepath):
+            return None
+        datapath = bestiaryimagepath.joinpath(str(monster.get("source", "")).upper())
+        if not datapath.is_dir():
+            return None
+        file = next(datapath.glob(f'{monster.get("name")}*'), None)
+        if file is None:
+            return None
+        image = Image.create_from_local_file(file, type=ImageType.character, seq=seq)
+        db_session.add(image)
+        db_session.flush()
+        images += 1
+        return image.id
+
+    def monsters() -> Iterator[dict]:
+        with open(compendium_file, "r", encoding="utf-8") as f:
+            for monster in iter_json_array(f, "monster"):
+                print(f"Parsing {monster.get('name')}")
+                yield monster
+
+    stats = import_monsters(
+        db_session,
+        track(monsters(), description="processing"),
+        batch_size=batch_size,
+        image_for=image_for,
+        seq=seq,
+    )
     db_session.commit()
+    print(f"{stats}. {images} images created.", override=True)
 
 
 # @app.command()
@@ -554,7 +589,7 @@ def generate_colours(
     quality: Annotated[
         int,
         typer.Argument(
-            help="quality for the colour thief algorithm (1-10). Lower is slower",
+            help="quality for the palette extraction (1-10). Lower is slower",
             min=1,
             max=10,
         ),
@@ -563,26 +598,133 @@ def generate_colours(
     force_regen: Annotated[
         bool, typer.Option(help="Regenerate all previous colour swatches")
     ] = False,
+    processes: Annotated[int, typer.Option(help="Number of worker processes")] = 8,
+    batch_size: Annotated[
+        int, typer.Option(help="Number of images handed to a worker at once")
+    ] = 32,
 ):
-    print, input = make_print("[green]\[generate-colours][/green]", True)
+    print, input = make_print("[green]\\[generate-colours][/green]", True)
 
     session = create_session()
     if force_regen:
-        q = select(Image)
+        q = select(Image.id, Image.path)
     else:
-        q = select(Image).where(Image.palette == None)  # noqa: E711
-    results = session.scalars(q).all()
-    print(f"Extracting colours for {len(results)} images.")
+        q = select(Image.id, Image.path).where(Image.palette == None)  # noqa: E711
+    rows = [tuple(row) for row in session.execute(q.order_by(Image.id)).all()]
+    print(f"Extracting colours for {len(rows)} images.")
+    batches = [rows[i : i + batch_size] for i in range(0, len(rows), batch_size)]
+    worker = partial(image_palettes, palette_size=num_images, quality=quality)
     try:
-        for image in track(results):
-            palette = extract_pallete(image.path, depth=num_images, quality=quality)
-            image.palette = ",".join(map(rgb_to_hex, palette))
+        with Progress() as progress:
+            task = progress.add_task("[green]Extracting colours...", total=len(rows))
+            for results in parallel(batches, worker, processes=processes, chunksize=1):
+                updates = []
+                for image_id, palette in results:
+                    if isinstance(palette, Exception):
+                        print(f"Error extracting colours for <Image id={image_id}>: {palette}")
+                    else:
+                        lab = pack_palette(palette)
+                        updates.append({"id": image_id, "palette": palette, "palette_lab": lab})
+                if updates:
+                    session.execute(update(Image), updates)
+                progress.update(task, advance=len(results))
         session.commit()
     except Exception as e:
         print(e)
         session.rollback()
 
 
+@app.command()
+def generate_thumbnails(
+    processes: Annotated[int, typer.Option(help="Number of worker processes")] = 8,
+    batch_size: Annotated[
+        int, typer.Option(help="Number of images per batch. Progress is checkpointed every batch")
+    ] = 250,
+    start_id: Annotated[int, typer.Option(help="Only process images with an id above this")] = 0,
+    verbose: Annotated[bool, typer.Option(help="Display detailed debugging")] = False,
+):
+    """Pre-generate the standard thumbnail sizes (THUMBNAIL_SIZE and the API default) for every
+    image into the thumbnail cache. Up to date thumbnails are skipped, so an interrupted run can
+    simply be restarted. THUMBNAIL_CACHE_SIZE isn't enforced here, as evicting thumbnails made
+    earlier in the run would only have them made again on a restart: the server trims the cache
+    to size when it next starts."""
+    print, input = make_print("[cyan]\\[generate-thumbnails][/cyan]", verbose)
+    settings = get_settings()
+    worker = thumbnail_worker(settings)
+    db_session = create_session()
+
+    total = db_session.scalar(select(func.count(Image.id)).where(Image.id > start_id))
+    print(f"Generating thumbnails for {total} images with {processes} processes", override=True)
+    count = 0
+    failed = 0
+    derivatives = 0
+    last_id = start_id
+    with Progress() as progress, Pool(processes) as pool:  # One pool for every batch
+        task = progress.add_task("[cyan]Generating thumbnails...", total=total)
+        while True:
+            q = (
+                select(Image.id, Image.path, Image.dimension_x, Image.dimension_y)
+                .where(Image.id > last_id)
+                .order_by(Image.id)
+                .limit(batch_size)
+            )
+            rows = [tuple(row) for row in db_session.execute(q).all()]
+            if not rows:
+                break
+            for image_id, result, elapsed in pool.imap_unordered(worker, rows, 4):
+                if isinstance(result, Exception):
+                    failed += 1
+                    print(f"Error generating thumbnails for <Image id={image_id}>: {result}")
+                else:
+                    derivatives += len(result)
+                    print(f"<Image id={image_id}> done in {elapsed:.2f}s")
+                count += 1
+                progress.update(task, advance=1)
+            last_id = rows[-1][0]
+            print(f"Checkpoint: all images up to <Image id={last_id}> are done")
+    print(f"{count} images processed, {failed} failed, {derivatives} thumbnails", override=True)
+
+
+@app.command()
+def generate_hashes(
+    processes: Annotated[int, typer.Option(help="Number of worker processes")] = 8,
+    batch_size: Annotated[int, typer.Option(help="Number of images hashed per commit")] = 500,
+    force_regen: Annotated[bool, typer.Option(help="Rehash every image")] = False,
+    verbose: Annotated[bool, typer.Option(help="Display detailed debugging")] = False,
+):
+    """Compute the perceptual hash of every image that doesn't have one yet (including the random
+    placeholders written by older versions), for the /image/{image_id}/similar endpoint."""
+    print, input = make_print("[magenta]\\[generate-hashes][/magenta]", verbose)
+    db_session = create_session()
+
+    q = select(Image.id, Image.path).order_by(Image.id)
+    if not force_regen:
+        q = q.where(
+            or_(Image.hash == None, func.length(Image.hash) != HASH_BITS // 4)  # noqa: E711
+        )
+    rows = [tuple(row) for row in db_session.execute(q).all()]
+    print(f"Hashing {len(rows)} images with {processes} processes", override=True)
+    failed = 0
+    batch = []
+    with Progress() as progress:
+        task = progress.add_task("[magenta]Hashing images...", total=len(rows))
+        for image_id, result in parallel(rows, hash_image, processes=processes):
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"Error hashing <Image id={image_id}>: {result}")
+            else:
+                batch.append({"id": image_id, "hash": result})
+            if len(batch) >= batch_size:
+                db_session.execute(update(Image), batch)
+                db_session.commit()
+                batch = []
+            progress.update(task, advance=1)
+        if batch:
+            db_session.execute(update(Image), batch)
+            db_session.commit()
+    print(f"{len(rows) - failed} images hashed, {failed} failed.", override=True)
+
+
 @app.command()
 def migrate(message: Annotated[str, typer.Argument(help="Description of the changes made")]):
     "Generate a migration script"
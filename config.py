@@ -13,6 +13,22 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     REFRESH_TOKEN_EXPIRE_DAYS: int = 8
     DATABASE_URL: str = "sqlite:///db.sqlite"
+    # Serve requests from an AsyncSession (aiosqlite for SQLite), so queries don't block the event
+    # loop. The CLI and the job workers always use the synchronous engine
+    ASYNC_DATABASE: bool = False
+    # PRAGMAs run on every new SQLite connection, see core.session.sqlite_pragmas
+    SQLITE_JOURNAL_MODE: str = "WAL"  # Readers don't block the writer, or each other
+    SQLITE_SYNCHRONOUS: str = "NORMAL"  # Safe with WAL, only the last commits can be lost
+    SQLITE_CACHE_SIZE: int = -64000  # Pages, or KiB if negative
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024  # bytes
+    SQLITE_TEMP_STORE: str = "MEMORY"
+    SQLITE_BUSY_TIMEOUT: int = 5000  # ms to wait for a lock before "database is locked"
+    # The association tables have no ON DELETE, so with this on, deleting a tagged image fails
+    SQLITE_FOREIGN_KEYS: bool = False
+    SQLITE_POOL_SIZE: int = 5
+    SQLITE_OPTIMIZE_INTERVAL: float = (
+        3600.0  # seconds between PRAGMA optimize/checkpoints, 0 for never
+    )
 
     FIRST_SUPERUSER: str = "test@example.com"
     FIRST_SUPERUSER_PW: str = "test"
@@ -22,12 +38,39 @@ class Settings(BaseSettings):
     GOOGLE_CLIENT_ID: str = ""
     GOOGLE_CLIENT_SECRET: str = ""
 
+    # Time every query, see /debug/queries and the Server-Timing header
     PROFILE_QUERIES: bool = False
+    SLOW_QUERY_MS: float = 100.0  # Queries slower than this are logged with their query plan
+    # Totals of paginated lists, see api.utils.pagination.CountCache
+    COUNT_CACHE_SIZE: int = 1024
+    COUNT_CACHE_SECONDS: float = 60.0  # Catches writes from other processes, e.g. the CLI
+    # Lookups by BaseService.get and the like, see api.utils.object_cache
+    OBJECT_CACHE_SIZE: int = 2048  # Entries per model
+    OBJECT_CACHE_SECONDS: float = 300.0
+    OBJECT_CACHE_DISABLED: list[str] = []  # Model names, e.g. ["Image"]
+    # ETags for the routers registered with api.utils.response_cache.cache_responses
+    RESPONSE_CACHE_SECONDS: float = 60.0  # ETags change this often regardless, 0 for never
+    RESPONSE_CACHE_SIZE: int = 32 * 1024 * 1024  # bytes of stored response bodies
+
+    # How often /random and the in-memory image indexes look for rows written by the CLI
+    SAMPLER_CHECK_SECONDS: float = 10.0
+
+    BULK_MAX_ITEMS: int = 1000  # Per request to the /bulk routes
 
     UPLOAD_DIR: str = ""
+    MAX_UPLOAD_SIZE: int = 64 * 1024 * 1024  # bytes
+    WORKER_PROCESSES: int = 2
+    JOB_WORKERS: int = 2
+    JOB_POLL_INTERVAL: float = 1.0  # seconds
+    JOB_LEASE_SECONDS: float = 300.0
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BACKOFF: float = 10.0  # seconds, doubled after every failed attempt
     CONVERT_PNG: bool = False
     GENERATE_THUMBNAIL: bool = False
     THUMBNAIL_SIZE: int = 200
+    THUMBNAIL_CACHE_DIR: str = ".cache/thumbnails"
+    THUMBNAIL_CACHE_SIZE: int = 512 * 1024 * 1024  # bytes
+    IMAGE_CACHE_CONTROL: str = "public, max-age=86400"
 
     class Config:
         env_file = ".env"
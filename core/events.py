@@ -0,0 +1,290 @@
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Optional
+
+import sqlalchemy
+from sqlalchemy import BindParameter, Delete, Insert, Select, Table, Update, event, inspect, select
+from sqlalchemy.orm import ORMExecuteState, Session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, ColumnElement
+
+from config import get_settings
+
+# Keep in-memory structures (indexes, caches) in step with the database. Writes are collected as
+# the session flushes and executes statements, and are only handed to subscribers once the
+# transaction commits, so a rollback never leaves an index pointing at rows that don't exist.
+
+
+@dataclass
+class Changes:
+    """Rows written to a single table in a committed transaction. Each row is a dict of the loaded
+    column values (always including the primary key). If bulk is set, a Core/bulk statement touched
+    the table and the individual rows are unknown, so subscribers should reload."""
+
+    table: str
+    inserted: list[dict[str, Any]] = field(default_factory=list)
+    updated: list[dict[str, Any]] = field(default_factory=list)
+    deleted: list[dict[str, Any]] = field(default_factory=list)
+    bulk: bool = False
+
+
+Subscriber = Callable[[Changes], None]
+_subscribers: dict[str, list[Subscriber]] = {}
+# How many committed transactions have written to each table, for caches of query results
+_versions: Counter[str] = Counter()
+
+
+def on_commit(table: str) -> Callable[[Subscriber], Subscriber]:
+    "Register a function to be called with the Changes to table after every commit that touches it."
+
+    def decorator(fn: Subscriber) -> Subscriber:
+        _subscribers.setdefault(table, []).append(fn)
+        return fn
+
+    return decorator
+
+
+def table_versions(tables: Iterable[str]) -> tuple[int, ...]:
+    "The write version of each table, which goes up whenever a commit touches it"
+    return tuple(_versions[table] for table in tables)
+
+
+def uncommitted_tables(session: Session) -> set[str]:
+    "Tables this session has written to in its current transaction"
+    return session.info.get("touched_tables", set())
+
+
+class StaleCheck:
+    """Writes made by other processes (e.g. the CLI) never reach the commit hooks, so every interval
+    seconds (SAMPLER_CHECK_SECONDS by default) a summary of the rows, such as their count and highest
+    id, is read with query and compared with what the in-memory copy holds. If they differ, the copy
+    is stale and should be reloaded. A row changed in place, keeping the summary the same, isn't
+    noticed."""
+
+    def __init__(self, query: Select, tables: Iterable[str], interval: Optional[float] = None):
+        self.query = query
+        self.tables = set(tables)
+        self.interval = interval
+        self.checked = 0.0
+
+    def loaded(self) -> None:
+        "Call when the copy has just been (re)loaded, so it isn't checked again for a while"
+        self.checked = time.monotonic()
+
+    def stale(self, db_session: Session, expected: Callable[[], tuple]) -> bool:
+        "True if it's time to look and the database doesn't match expected()"
+        interval = get_settings().SAMPLER_CHECK_SECONDS if self.interval is None else self.interval
+        if time.monotonic() - self.checked <= interval:
+            return False
+        if self.tables & uncommitted_tables(db_session):
+            return False  # This session can see rows the copy doesn't yet, but they may not commit
+        self.checked = time.monotonic()
+        return tuple(db_session.execute(self.query).one()) != tuple(expected())
+
+
+def _touch(session: Session, table: str) -> None:
+    session.info.setdefault("touched_tables", set()).add(table)
+
+
+def _pending(session: Session, table: str) -> Changes:
+    pending: dict[str, Changes] = session.info.setdefault("pending_changes", {})
+    if table not in pending:
+        pending[table] = Changes(table)
+    return pending[table]
+
+
+def _snapshot(obj) -> dict[str, Any]:
+    state = inspect(obj)
+    values = {
+        attr.key: state.dict[attr.key]
+        for attr in state.mapper.column_attrs
+        if attr.key in state.dict
+    }
+    if state.identity is not None:
+        values["id"] = state.identity[0]
+    return values
+
+
+def _collect_secondary(session: Session, obj) -> None:
+    "Rows added to or removed from many-to-many tables by changing a relationship collection"
+    state = inspect(obj)
+    for relationship in state.mapper.relationships:
+        secondary = relationship.secondary
+        if secondary is None or relationship.viewonly or secondary.name not in _subscribers:
+            continue
+        history = state.attrs[relationship.key].history  # Doesn't load the collection
+        if not history.added and not history.deleted:
+            continue
+        local = {
+            column.key: getattr(obj, relationship.parent.get_property_by_column(parent).key)
+            for parent, column in relationship.synchronize_pairs
+        }
+        changes = _pending(session, secondary.name)
+        for attribute, targets in (("inserted", history.added), ("deleted", history.deleted)):
+            rows = getattr(changes, attribute)
+            for target in targets:
+                row = dict(local)
+                for remote, column in relationship.secondary_synchronize_pairs:
+                    prop = relationship.mapper.get_property_by_column(remote)
+                    row[column.key] = getattr(target, prop.key)
+                if row not in rows:  # Both sides of a back_populates pair see the same change
+                    rows.append(row)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_flush(session: Session, flush_context) -> None:
+    for attribute, objects in (
+        ("inserted", session.new),
+        ("updated", session.dirty),
+        ("deleted", session.deleted),
+    ):
+        for obj in objects:
+            table = obj.__table__.name
+            _touch(session, table)
+            for relationship in inspect(obj).mapper.relationships:
+                if relationship.secondary is not None and not relationship.viewonly:
+                    _touch(session, relationship.secondary.name)
+            if table in _subscribers:
+                getattr(_pending(session, table), attribute).append(_snapshot(obj))
+            if attribute != "deleted":
+                _collect_secondary(session, obj)
+
+
+def _key_rows(session: Session, table: Table, whereclause) -> list[dict[str, Any]]:
+    "The primary key of every row a statement's WHERE clause matches"
+    q = select(*table.primary_key.columns)
+    if whereclause is not None:
+        q = q.where(whereclause)
+    return [dict(row) for row in session.execute(q).mappings()]
+
+
+def _where_keys(table: Table, whereclause) -> Optional[list[dict[str, Any]]]:
+    """The primary keys picked out by a WHERE clause of `pk == value` or `pk IN (values)`, or None
+    for any other, which can only be found by asking the database."""
+    pk = list(table.primary_key.columns)
+    if len(pk) != 1 or not isinstance(whereclause, BinaryExpression):
+        return None
+    column, value = whereclause.left, whereclause.right
+    if not isinstance(column, ColumnElement) or not pk[0].shares_lineage(column):
+        return None
+    if not isinstance(value, BindParameter) or value.callable is not None:
+        return None
+    if whereclause.operator is operators.eq:
+        return [{pk[0].key: value.value}]
+    if whereclause.operator is operators.in_op and value.expanding:
+        return [{pk[0].key: key} for key in dict.fromkeys(value.value)]
+    return None
+
+
+# There's no public way to read back what was passed to Insert/Update.values(), so only look at the
+# attributes that hold them on the SQLAlchemy they're known to, and otherwise treat it as bulk
+_VALUES_READABLE = sqlalchemy.__version__.startswith("2.0.")
+
+
+def _statement_values(statement) -> Optional[dict[str, Any]]:
+    """The literal values given to statement.values() ({} if it wasn't called), or None if they can't
+    be read: several rows' worth, an INSERT from SELECT, or SQL expressions."""
+    if not _VALUES_READABLE or not hasattr(statement, "_values"):
+        return None
+    if getattr(statement, "_multi_values", None) or getattr(statement, "select", None) is not None:
+        return None
+    values = {}
+    for column, value in (statement._values or {}).items():
+        if not isinstance(value, BindParameter) or value.callable is not None:
+            return None
+        values[getattr(column, "key", column)] = value.value
+    return values
+
+
+def _literal_rows(orm_execute_state: ORMExecuteState) -> Optional[list[dict[str, Any]]]:
+    """The column values an INSERT (or the SET of an UPDATE) writes, one dict per row, or None if
+    any of them is a SQL expression that only the database can work out."""
+    values = _statement_values(orm_execute_state.statement)
+    if values is None:
+        return None
+    parameters = orm_execute_state.parameters
+    if isinstance(parameters, (list, tuple)):  # executemany
+        return [{**values, **row} for row in parameters]
+    return [{**values, **(parameters or {})}]
+
+
+def _by_key(orm_execute_state: ORMExecuteState, changes: Changes, attribute: str, rows: list):
+    """Run a statement that picks rows by primary key and record them, so that nothing has to be
+    selected to find out which. An update that missed some leaves it to the subscribers to reload,
+    rather than say rows were written that don't exist (deleting them is harmless)."""
+    result = orm_execute_state.invoke_statement()
+    if attribute == "deleted" or getattr(result, "rowcount", -1) == len(rows):
+        getattr(changes, attribute).extend(rows)
+    else:
+        changes.bulk = True
+    return result
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_statement(orm_execute_state: ORMExecuteState):
+    statement = orm_execute_state.statement
+    if not isinstance(statement, (Insert, Update, Delete)):
+        return None
+    table: Table = statement.table  # type: ignore
+    session = orm_execute_state.session
+    _touch(session, table.name)
+    if table.name not in _subscribers:
+        return None
+    changes = _pending(session, table.name)
+    keys = {column.key for column in table.primary_key.columns}
+    if not keys:
+        changes.bulk = True
+        return None
+    if isinstance(statement, Delete):
+        matched = _where_keys(table, statement.whereclause)
+        if matched is not None:
+            return _by_key(orm_execute_state, changes, "deleted", matched)
+        # Cheap to find out exactly which rows any other delete will touch, so look before it runs
+        changes.deleted.extend(_key_rows(session, table, statement.whereclause))
+    elif isinstance(statement, Insert):
+        rows = _literal_rows(orm_execute_state)
+        if rows is not None and all(keys <= row.keys() for row in rows):
+            changes.inserted.extend(rows)
+        else:
+            changes.bulk = True  # e.g. the primary key is generated by the database
+    else:
+        rows = _literal_rows(orm_execute_state)
+        by_key = isinstance(orm_execute_state.parameters, (list, tuple))
+        if rows is not None and by_key and statement.whereclause is None:
+            # An ORM UPDATE by primary key, a row for each set of parameters
+            if all(keys <= row.keys() for row in rows):
+                changes.updated.extend(rows)
+            else:
+                changes.bulk = True
+            return None
+        if rows is None or len(rows) != 1:
+            changes.bulk = True
+            return None
+        values = rows[0]
+        matched = _where_keys(table, statement.whereclause)
+        if matched is not None and not keys & values.keys():
+            updated = [{**row, **values} for row in matched]
+            return _by_key(orm_execute_state, changes, "updated", updated)
+        matched = _key_rows(session, table, statement.whereclause)
+        if keys & values.keys():  # Rows re-keyed, e.g. an association pointed at another tag
+            changes.deleted.extend(matched)
+            changes.inserted.extend({**row, **values} for row in matched)
+        else:
+            changes.updated.extend({**row, **values} for row in matched)
+    return None
+
+
+@event.listens_for(Session, "after_commit")
+def _dispatch(session: Session) -> None:
+    _versions.update(session.info.pop("touched_tables", set()))
+    pending: dict[str, Changes] = session.info.pop("pending_changes", {})
+    for table, changes in pending.items():
+        for subscriber in _subscribers.get(table, []):
+            subscriber(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard(session: Session) -> None:
+    session.info.pop("pending_changes", None)
+    session.info.pop("touched_tables", None)
@@ -0,0 +1,105 @@
+from itertools import combinations
+from typing import Optional
+
+from PIL import Image as PImage
+
+# https://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(image: PImage.Image, hash_size: int = HASH_SIZE) -> str:
+    """Difference hash: shrink to a (hash_size + 1) x hash_size greyscale image and record whether
+    each pixel is brighter than its right-hand neighbour. Returns hash_size**2 bits as a hex string.
+    Visually similar images have hashes a small Hamming distance apart."""
+    image.draft("L", (hash_size * 8, hash_size * 8))  # JPEGs can decode straight to a smaller size
+    small = image.convert("L").resize(
+        (hash_size + 1, hash_size), PImage.Resampling.BILINEAR, reducing_gap=2.0
+    )
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def parse_hash(value: Optional[str], bits: int = HASH_BITS) -> Optional[int]:
+    "Convert a stored hash to an int, or None if it isn't a valid perceptual hash"
+    if value is None or len(value) != bits // 4:
+        return None
+    try:
+        return int(value, 16)
+    except ValueError:
+        return None
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """Index fixed-width hashes for Hamming distance range queries (multi-index hashing, Norouzi).
+
+    Each hash is split into `chunks` substrings, each with its own hash table. If two hashes are
+    within distance r, then by the pigeonhole principle at least one pair of substrings is within
+    r // chunks, so only the buckets near the query's substrings need to be checked.
+    """
+
+    def __init__(self, bits: int = HASH_BITS, chunks: int = 4):
+        self.bits = bits
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self.mask = (1 << self.chunk_bits) - 1
+        self.tables: list[dict[int, set[int]]] = [{} for _ in range(chunks)]
+        self.hashes: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def _split(self, value: int) -> list[int]:
+        return [(value >> (i * self.chunk_bits)) & self.mask for i in range(self.chunks)]
+
+    def add(self, key: int, value: int) -> None:
+        self.remove(key)
+        self.hashes[key] = value
+        for table, chunk in zip(self.tables, self._split(value)):
+            table.setdefault(chunk, set()).add(key)
+
+    def remove(self, key: int) -> None:
+        value = self.hashes.pop(key, None)
+        if value is None:
+            return
+        for table, chunk in zip(self.tables, self._split(value)):
+            bucket = table[chunk]
+            bucket.discard(key)
+            if not bucket:
+                del table[chunk]
+
+    def _probes(self, radius: int) -> list[int]:
+        "XOR masks for every value within radius of a chunk"
+        masks = [0]
+        for r in range(1, radius + 1):
+            for flips in combinations(range(self.chunk_bits), r):
+                masks.append(sum(1 << bit for bit in flips))
+        return masks
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, int]]:
+        "Return (distance, key) for every hash within max_distance of value, nearest first"
+        probes = self._probes(max_distance // self.chunks)
+        if len(probes) * self.chunks >= len(self.hashes):  # Cheaper to just check everything
+            candidates = self.hashes.keys()
+        else:
+            candidates = set()
+            for table, chunk in zip(self.tables, self._split(value)):
+                for mask in probes:
+                    bucket = table.get(chunk ^ mask)
+                    if bucket:
+                        candidates.update(bucket)
+        results = []
+        for key in candidates:
+            distance = hamming(value, self.hashes[key])
+            if distance <= max_distance:
+                results.append((distance, key))
+        return sorted(results)
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from statistics import mean, quantiles
+from typing import Any, Optional
+
+from sqlalchemy import Connection, event
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+HISTORY = 1000  # Requests kept per route for the histograms
+SLOWEST = 5  # Statements kept per route
+SLOW_LOG = 50  # Entries kept in the slow query log
+REPEATED = 5  # Times a statement can run in one request before it counts as an N+1
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)  # ms, for the db time histograms
+
+
+@dataclass
+class RequestProfile:
+    "The queries made while handling one request"
+    scope: Scope = field(default_factory=dict)
+    queries: int = 0
+    seconds: float = 0.0
+    statements: Counter = field(default_factory=Counter)
+    slowest: list[tuple[float, str]] = field(default_factory=list)
+
+    @property
+    def route(self) -> str:
+        "The name of the route (see api.api.custom_id_fn), once the request has been routed"
+        route = self.scope.get("route")
+        return getattr(route, "name", None) or self.scope.get("path", "")
+
+    def record(self, statement: str, seconds: float) -> None:
+        self.queries += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+        self.slowest = sorted([*self.slowest, (seconds, statement)], reverse=True)[:SLOWEST]
+
+    def repeated(self) -> dict[str, int]:
+        return {sql: n for sql, n in self.statements.items() if n >= REPEATED}
+
+    def server_timing(self) -> str:
+        return f'db;dur={1000 * self.seconds:.1f};desc="{self.queries} queries"'
+
+
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("current_profile", default=None)
+
+
+def histogram(samples: list[float]) -> dict[str, int]:
+    counts = {f"<={bucket}": 0 for bucket in BUCKETS} | {"more": 0}
+    for sample in samples:
+        bucket = next((b for b in BUCKETS if sample <= b), None)
+        counts["more" if bucket is None else f"<={bucket}"] += 1
+    return counts
+
+
+def summary(samples: list[float]) -> dict[str, float]:
+    cuts = quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+    return {"mean": mean(samples), "p50": cuts[49], "p99": cuts[98], "max": max(samples)}
+
+
+class QueryStats:
+    """Query counts and database time per route, over the last HISTORY requests to each, the
+    statements that repeat within a request (N+1s) and a log of slow queries with their plans"""
+
+    def __init__(self):
+        self._requests: defaultdict[str, deque[tuple[int, float]]] = defaultdict(
+            lambda: deque(maxlen=HISTORY)
+        )
+        self._slowest: defaultdict[str, list[tuple[float, str]]] = defaultdict(list)
+        self._repeated: defaultdict[str, dict[str, int]] = defaultdict(dict)
+        self._slow_log: deque[dict[str, Any]] = deque(maxlen=SLOW_LOG)
+        self._lock = threading.Lock()
+
+    def record(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._requests[profile.route].append((profile.queries, 1000 * profile.seconds))
+            slowest = self._slowest[profile.route] + profile.slowest
+            self._slowest[profile.route] = sorted(set(slowest), reverse=True)[:SLOWEST]
+            repeated = self._repeated[profile.route]
+            for sql, n in profile.repeated().items():
+                repeated[sql] = max(repeated.get(sql, 0), n)
+
+    def record_slow(self, route: str, statement: str, seconds: float, plan: list[str]) -> None:
+        entry = {"route": route, "ms": 1000 * seconds, "statement": statement, "plan": plan}
+        with self._lock:
+            self._slow_log.append(entry)
+        logger.warning("Slow query (%.1f ms) in %s: %s\n%s", 1000 * seconds, route, statement, plan)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            routes = {}
+            for route, requests in self._requests.items():
+                counts = [float(queries) for queries, _ in requests]
+                times = [ms for _, ms in requests]
+                routes[route] = {
+                    "requests": len(requests),
+                    "queries": summary(counts) | {"histogram": histogram(counts)},
+                    "db_ms": summary(times) | {"histogram": histogram(times)},
+                    "slowest": [
+                        {"ms": 1000 * s, "statement": sql} for s, sql in self._slowest[route]
+                    ],
+                    "repeated": dict(self._repeated[route]),
+                }
+            return {"routes": routes, "slow_queries": list(self._slow_log)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._requests.clear()
+            self._slowest.clear()
+            self._repeated.clear()
+            self._slow_log.clear()
+
+
+query_stats = QueryStats()
+
+
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+
+def explain(conn: Connection, statement: str, parameters) -> list[str]:
+    "The query plan for a statement, run on the DBAPI connection that just executed it"
+    if not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return []
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    explain_cursor = conn.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        return [" ".join(str(column) for column in row) for row in explain_cursor.fetchall()]
+    except Exception as e:
+        return [f"EXPLAIN failed: {e!r}"]
+    finally:
+        explain_cursor.close()
+
+
+def profile_queries(target: Any, slow_query_ms: float) -> None:
+    """Time every statement run through target (an Engine, or the Engine class for all of them),
+    adding it to the current request's profile and explaining any slower than slow_query_ms"""
+    if event.contains(target, "before_cursor_execute", before_cursor_execute):
+        return
+
+    event.listen(target, "before_cursor_execute", before_cursor_execute)
+
+    @event.listens_for(target, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_start_time"].pop(-1)
+        profile = current_profile.get()
+        if profile is not None:
+            profile.record(statement, seconds)
+        if 1000 * seconds >= slow_query_ms and not executemany:
+            plan = explain(conn, statement, parameters)
+            query_stats.record_slow(profile.route if profile else "", statement, seconds, plan)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+class QueryProfileMiddleware:
+    """Profile the queries made by each HTTP request: sends them back in a Server-Timing header,
+    and adds them to query_stats under the name of the route that handled the request"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile(scope)
+        token = current_profile.set(profile)
+
+        async def send_with_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("Server-Timing", profile.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_profile.reset(token)
+            query_stats.record(profile)
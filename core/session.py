@@ -1,32 +1,77 @@
-import time
+import asyncio
 from functools import lru_cache
-from typing import Generator
+from typing import Any, AsyncGenerator
 
-from sqlalchemy import Engine, create_engine, event
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import (
+    URL,
+    AsyncAdaptedQueuePool,
+    Engine,
+    QueuePool,
+    create_engine,
+    event,
+    make_url,
+)
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 
-from config import get_settings
+from config import Settings, get_settings
+from core.profiling import profile_queries
 
 # from api.logger import logger
 
 
+def sqlite_pragmas(settings: Settings) -> dict[str, Any]:
+    "The PRAGMAs for each new SQLite connection, busy_timeout first so the others can wait on locks"
+    return {
+        "busy_timeout": settings.SQLITE_BUSY_TIMEOUT,
+        "journal_mode": settings.SQLITE_JOURNAL_MODE,
+        "synchronous": settings.SQLITE_SYNCHRONOUS,
+        "cache_size": settings.SQLITE_CACHE_SIZE,
+        "mmap_size": settings.SQLITE_MMAP_SIZE,
+        "temp_store": settings.SQLITE_TEMP_STORE,
+        "foreign_keys": "ON" if settings.SQLITE_FOREIGN_KEYS else "OFF",
+    }
+
+
+def is_sqlite_file(url: str | URL) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+
+def engine_options(url: str | URL, settings: Settings, is_async: bool = False) -> dict[str, Any]:
+    "Keyword arguments for create_engine. SQLite files get a fixed size pool of connections"
+    if not is_sqlite_file(url):
+        return {"pool_pre_ping": True}
+    # A file can't drop the connection, so there's nothing for pre_ping to check
+    return {
+        "poolclass": AsyncAdaptedQueuePool if is_async else QueuePool,
+        "pool_size": settings.SQLITE_POOL_SIZE,
+    }
+
+
+def set_pragmas(engine: Engine, pragmas: dict[str, Any]) -> None:
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
 @lru_cache
 def get_engine() -> Engine:
     settings = get_settings()
     if settings.PROFILE_QUERIES:
+        profile_queries(Engine, settings.SLOW_QUERY_MS)
 
-        @event.listens_for(Engine, "before_cursor_execute")
-        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
-            conn.info.setdefault("query_start_time", []).append(time.time())
-            # logger.debug(f"Start Query {statement}")
-
-        @event.listens_for(Engine, "after_cursor_execute")
-        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
-            total = time.time() - conn.info["query_start_time"].pop(-1)
-            # logger.debug("Query Complete!")
-            # logger.debug(f"Total time: {total}")
-
-    engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True)
+    engine = create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL, settings))
+    if engine.dialect.name == "sqlite":
+        set_pragmas(engine, sqlite_pragmas(settings))
     return engine
 
 
@@ -37,9 +82,61 @@ def create_session() -> scoped_session:
     return Session
 
 
-def get_session() -> Generator[scoped_session, None, None]:
-    Session = create_session()
+# The async driver to use for each database, see ASYNC_DATABASE
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_url(url: str) -> URL:
+    parsed = make_url(url)
+    return parsed.set(drivername=ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername))
+
+
+@lru_cache
+def get_async_engine() -> AsyncEngine:
+    settings = get_settings()
+    get_engine()  # For the PROFILE_QUERIES listeners, which are on Engine so apply to both
+    url = async_url(settings.DATABASE_URL)
+    engine = create_async_engine(url, **engine_options(url, settings, is_async=True))
+    if engine.dialect.name == "sqlite":
+        set_pragmas(engine.sync_engine, sqlite_pragmas(settings))
+    return engine
+
+
+@lru_cache
+def create_async_session() -> async_sessionmaker[AsyncSession]:
+    # Nothing may be loaded from an AsyncSession implicitly, so don't expire objects on commit
+    return async_sessionmaker(get_async_engine(), autoflush=False, expire_on_commit=False)
+
+
+async def get_session() -> AsyncGenerator[Session | AsyncSession, None]:
+    "A session per request: an AsyncSession with ASYNC_DATABASE set, a Session otherwise"
+    if get_settings().ASYNC_DATABASE:
+        async with create_async_session()() as session:
+            yield session
+    else:
+        with create_session().session_factory() as session:
+            yield session
+
+
+def optimize_database(engine: Engine) -> None:
+    """Let SQLite refresh its query planner statistics, and copy the WAL back into the database so
+    it doesn't grow without bound. The checkpoint is PASSIVE, so it never waits on readers"""
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA optimize")
+        if connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal":
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+async def run_optimize() -> None:
+    "optimize_database in a thread, so it doesn't block the event loop"
     try:
-        yield Session
-    finally:
-        Session.remove()
+        await asyncio.to_thread(optimize_database, get_engine())
+    except Exception:
+        pass  # Locked or unavailable, try again next time
+
+
+async def maintain_database(interval: float) -> None:
+    "run_optimize every interval seconds until cancelled"
+    while True:
+        await asyncio.sleep(interval)
+        await run_optimize()
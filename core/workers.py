@@ -0,0 +1,28 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from typing import Callable, TypeVar
+
+from config import get_settings
+
+R = TypeVar("R")
+
+# CPU bound work (decoding images, palettes, hashes) has to stay off the event loop, or every
+# request and websocket stalls behind it. A small process pool also caps how many run at once.
+
+
+@lru_cache
+def get_process_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=get_settings().WORKER_PROCESSES)
+
+
+async def run_in_process(func: Callable[..., R], *args, **kwargs) -> R:
+    "Run a picklable function in the worker pool without blocking the event loop."
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), partial(func, *args, **kwargs))
+
+
+def shutdown_process_pool() -> None:
+    if get_process_pool.cache_info().currsize:
+        get_process_pool().shutdown(cancel_futures=True)
+        get_process_pool.cache_clear()
@@ -41,6 +41,13 @@ target_metadata = Base.metadata
 #     return f"postgresql://{user}:{password}@{server}/{db}"
 
 
+def include_name(name, type_, parent_names) -> bool:
+    # The image full text search table and its shadow tables aren't models, see api.utils.search
+    if type_ == "table":
+        return not (name or "").startswith("image_search")
+    return True
+
+
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
 
@@ -57,6 +64,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_name=include_name,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -80,7 +88,10 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata, render_as_batch=True
+            connection=connection,
+            target_metadata=target_metadata,
+            include_name=include_name,
+            render_as_batch=True,
         )
 
         with context.begin_transaction():
@@ -1,3 +1,4 @@
+import os
 import random
 from pathlib import Path
 from typing import Generator
@@ -43,6 +44,9 @@ from core.db import Base
 # from api.db.models import Base, Organisation, Roster, Shift, Tag, Worker
 from core.session import get_session
 
+os.environ["JOB_WORKERS"] = "0"  # Tests run queued jobs explicitly, against the test database
+os.environ["SQLITE_OPTIMIZE_INTERVAL"] = "0"  # Nor should the app touch DATABASE_URL
+
 
 @pytest.fixture(scope="session")
 def engine() -> Generator[Engine, None, None]:
@@ -0,0 +1,95 @@
+import io
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from api.models import Entity
+from api.services import entity as entity_service
+from api.utils import compendium
+from api.utils.compendium import import_monsters, iter_json_array
+
+
+def bestiary(*monsters: dict) -> str:
+    return json.dumps(
+        {"_meta": {"sources": [{"json": "TST"}]}, "monster": list(monsters)}, indent=1
+    )
+
+
+def monster(name: str, **kwargs) -> dict:
+    return {"name": name, "source": "TST", "page": 1, "dex": 14, "cr": "1/2", **kwargs}
+
+
+def test_entity_iter_json_array(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(compendium, "READ_SIZE", 7)  # Values split across many reads
+    items = [monster(f"Goblin {n}", ac=[15, {"ac": 12}], note='a "quoted" } ]') for n in range(20)]
+    text = bestiary(*items)
+    assert list(iter_json_array(io.StringIO(text), "monster")) == items
+    assert list(iter_json_array(io.StringIO('{"a": 1, "monster": [1, 22, 333]}'), "monster")) == [
+        1,
+        22,
+        333,
+    ]
+    assert list(iter_json_array(io.StringIO('{"monster": []}'), "monster")) == []
+    assert list(iter_json_array(io.StringIO("{}"), "monster")) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO('{"monster": [{"name": "Goblin"}'), "monster"))
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO("[]"), "monster"))
+
+
+def test_entity_import_monsters(db: Session) -> None:
+    monsters = [monster(f"Import {n}", hp={"formula": "2d6"}) for n in range(5)]
+    stats = import_monsters(db, monsters + [{"source": "TST"}], batch_size=2)
+    db.commit()
+    assert (stats.inserted, stats.updated, stats.unchanged, stats.skipped) == (5, 0, 0, 1)
+    entity = db.scalars(select(Entity).where(Entity.name == "Import 0")).one()
+    assert (entity.cr, entity.hit_dice, entity.initiative_modifier) == (0.5, "2d6", 2)
+    assert entity.data_hash is not None
+
+    monsters[1]["cr"] = "3"
+    stats = import_monsters(db, monsters + [monster("Import 5")])
+    db.commit()
+    assert (stats.inserted, stats.updated, stats.unchanged) == (1, 1, 4)
+    rows = db.scalars(select(Entity).where(Entity.name.like("Import %"))).all()
+    assert len(rows) == 6
+    db.refresh(entity := next(e for e in rows if e.name == "Import 1"))
+    assert entity.cr == 3
+
+
+def test_entity_create_from_json_client(db: Session, app_client: TestClient) -> None:
+    text = bestiary(monster("Upload 1"), monster("Upload 2"))
+    rv = app_client.post("/entity/json", files={"entity_file": ("b.json", text.encode())})
+    assert rv.status_code == 201
+    assert rv.json()["inserted"] == 2
+    rv = app_client.post("/entity/json", files={"entity_file": ("b.json", text.encode())})
+    assert (rv.json()["inserted"], rv.json()["unchanged"]) == (0, 2)
+
+    rv = app_client.post("/entity/json", files={"entity_file": ("b.json", text[:-20].encode())})
+    assert rv.status_code == 400
+
+
+def test_entity_import_duplicates(db: Session) -> None:
+    monsters = [monster("Twin"), monster("Twin", cr="2"), monster("Single"), monster("Twin")]
+    stats = import_monsters(db, monsters, batch_size=3)
+    db.commit()
+    assert (stats.inserted, stats.updated, stats.duplicates) == (2, 0, 2)
+    assert db.scalars(select(Entity.cr).where(Entity.name == "Twin")).all() == [0.5]
+
+
+def test_entity_create_from_json_rollback(
+    db: Session, app_client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def conflict(db_session: Session, monsters):
+        db_session.add(Entity(name="Half written"))
+        db_session.flush()
+        raise IntegrityError("INSERT", {}, Exception("UNIQUE constraint failed"))
+
+    monkeypatch.setattr(entity_service, "import_monsters", conflict)
+    text = bestiary(monster("Conflict"))
+    rv = app_client.post("/entity/json", files={"entity_file": ("b.json", text.encode())})
+    assert rv.status_code == 409
+    assert not db.new and db.scalar(select(Entity).where(Entity.name == "Half written")) is None
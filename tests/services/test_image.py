@@ -1,11 +1,31 @@
+import asyncio
+import base64
+import os
+from pathlib import Path
+
 import pytest
 from fastapi.testclient import TestClient
+from PIL import Image as PImage
 from pydantic import ValidationError
+from sqlalchemy import delete, event, insert, update
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 
-from api.models import Image, ImageType, Tag
+from api.models import Collection, Image, ImageType, Tag, image_tags
 from api.schemas import ImageCreate, ImageScale
 from api.services import ImageService
+from api.utils.delivery import FileDelivery, delivery_stats
+from api.utils.hash_index import hash_index
+from api.utils.image_helper import parse_image_file
+from api.utils.jobs import job_runner
+from api.utils.palette_index import palette_index
+from api.utils.sampler import RandomSampler
+from api.utils.tag_index import tag_index
+from config import Settings, get_settings
+from core import events
+from core.colour import extract_pallete, extract_palletes, pack_palette
+from core.events import Changes, on_commit
+from core.phash import dhash
 
 
 def test_image_create_db(db: Session) -> None:
@@ -188,3 +208,476 @@ def test_image_fetch_b64_client(app_client: TestClient, create_real_images: list
     data = b64.json()
     assert "b64" in data
     assert len(data["b64"]) > 1000
+
+
+def test_image_thumbnail_cache_client(
+    db: Session, app_client: TestClient, create_real_images: list[Image]
+) -> None:
+    db.commit()
+    before = app_client.get("/debug/thumbnails").json()
+    first = app_client.get(f"/image/{create_real_images[2].id}/thumb?width=50")
+    second = app_client.get(f"/image/{create_real_images[2].id}/thumb?width=50")
+    after = app_client.get("/debug/thumbnails").json()
+    assert first.status_code == 200 and second.status_code == 200
+    assert first.content == second.content
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+
+
+def test_image_similar_client(
+    db: Session, app_client: TestClient, create_image_files: list[Path], tmp_path: Path
+) -> None:
+    original = Image.create_from_local_file(create_image_files[0])
+    with PImage.open(create_image_files[0]) as im:
+        im.resize((728, 408)).save(path := tmp_path.joinpath("resized.jpg"), quality=70)
+    resized = Image.create_from_local_file(path)
+    db.add_all([original, resized])
+    db.commit()
+    assert len(original.hash) == 16
+
+    similar = app_client.get(f"/image/{original.id}/similar?max_distance=6")
+    assert similar.status_code == 200
+    assert resized.id in [i["image_id"] for i in similar.json()]
+    assert original.id not in [i["image_id"] for i in similar.json()]
+
+
+def test_image_full_conditional_range_client(
+    db: Session, app_client: TestClient, create_real_images: list[Image]
+) -> None:
+    db.commit()
+    url = f"/image/{create_real_images[1].id}/full"
+    full = app_client.get(url)
+    assert full.status_code == 200
+    assert full.headers["content-type"] == "image/png"
+    assert "cache-control" in full.headers
+
+    cached = app_client.get(url, headers={"If-None-Match": full.headers["etag"]})
+    assert cached.status_code == 304
+    assert cached.content == b""
+
+    since = app_client.get(url, headers={"If-Modified-Since": full.headers["last-modified"]})
+    assert since.status_code == 304
+
+    partial = app_client.get(url, headers={"Range": "bytes=100-199"})
+    assert partial.status_code == 206
+    assert partial.content == full.content[100:200]
+    assert partial.headers["content-range"] == f"bytes 100-199/{len(full.content)}"
+
+    tail = app_client.get(url, headers={"Range": "bytes=-10"})
+    assert tail.content == full.content[-10:]
+
+    unsatisfiable = app_client.get(url, headers={"Range": f"bytes={len(full.content)}-"})
+    assert unsatisfiable.status_code == 416
+
+
+def test_image_full_mime_type_backfill_client(
+    db: Session, app_client: TestClient, create_real_images: list[Image], monkeypatch
+) -> None:
+    "Rows from before the mime_type column are served straight away and filled in afterwards"
+    image = create_real_images[0]
+    image.mime_type = None
+    db.commit()
+    image_id, url = image.id, f"/image/{image.id}/full"
+
+    def locked(self) -> None:
+        raise OperationalError("COMMIT", {}, Exception("database is locked"))
+
+    with monkeypatch.context() as m:
+        m.setattr(Session, "commit", locked)
+        rv = app_client.get(url)
+    assert rv.status_code == 200
+    assert rv.headers["content-type"] == "image/png"
+    db.expire_all()
+    assert db.get(Image, image_id).mime_type is None
+
+    assert app_client.get(url).status_code == 200
+    db.expire_all()
+    assert db.get(Image, image_id).mime_type == "image/png"
+
+
+def test_image_full_delivery_client(
+    db: Session, app_client: TestClient, create_real_images: list[Image]
+) -> None:
+    db.commit()
+    path = create_real_images[2].path
+    with open(path, "rb") as f:
+        content = f.read()
+    before = delivery_stats.stats().get("/image/{image_id}/full", {"bytes": 0, "mmap": 0})
+    full = app_client.get(f"/image/{create_real_images[2].id}/full")
+    assert full.content == content
+    assert int(full.headers["content-length"]) == len(content)
+
+    after = app_client.get("/debug/delivery").json()["/image/{image_id}/full"]
+    assert after["bytes"] - before["bytes"] == len(content)
+    assert after["mmap"] - before["mmap"] == 1  # The test client offers no send extensions
+
+    # Servers that offer pathsend/zerocopysend are handed the file rather than its bytes
+    def deliver(extensions: dict, **kwargs) -> list[dict]:
+        messages: list[dict] = []
+
+        async def send(message: dict) -> None:
+            messages.append(message)
+
+        response = FileDelivery(path, os.stat(path), **kwargs)
+        scope = {"type": "http", "path": "/test", "extensions": extensions}
+        asyncio.run(response(scope, None, send))  # type: ignore
+        return messages
+
+    start, body = deliver({"http.response.pathsend": {}})
+    assert (b"content-length", str(len(content)).encode()) in start["headers"]
+    assert body == {"type": "http.response.pathsend", "path": os.path.abspath(path)}
+
+    both = {"http.response.pathsend": {}, "http.response.zerocopysend": {}}
+    _, body = deliver(both, start=10, length=20)  # A byte range can't be pathsent
+    assert body["type"] == "http.response.zerocopysend"
+    assert (body["offset"], body["count"]) == (10, 20)
+
+
+def test_image_b64_matches_file_client(
+    db: Session, app_client: TestClient, create_real_images: list[Image]
+) -> None:
+    db.commit()
+    image = create_real_images[3]
+    response = app_client.get(f"/image/{image.id}/b64")
+    assert response.status_code == 200
+    assert int(response.headers["content-length"]) == len(response.content)
+    data = response.json()
+    assert data["image_id"] == image.id
+    with open(image.path, "rb") as f:
+        assert base64.b64decode(data["b64"]) == f.read()
+
+
+def test_image_upload_client(
+    db: Session, app_client: TestClient, create_image_files: list[Path], tmp_path: Path
+) -> None:
+    app_client.app.dependency_overrides[get_settings] = lambda: Settings(  # type: ignore
+        UPLOAD_DIR=str(tmp_path), MAX_UPLOAD_SIZE=1024 * 1024
+    )
+    try:
+        with open(create_image_files[0], "rb") as f:
+            response = app_client.post("/image/upload", files={"image_file": ("up.png", f)})
+        assert response.status_code == 200
+        image_id = response.json()["image_id"]
+        jobs = app_client.get(f"/job/?image_id={image_id}").json()["items"]
+        assert {job["type"] for job in jobs} == {"hash", "palette"}
+
+        settings = get_settings()
+        while asyncio.run(job_runner.run_once(db, settings)):
+            pass
+        uploaded = db.get(Image, image_id)
+        assert uploaded is not None
+        assert uploaded.mime_type == "image/png"
+        assert len(uploaded.hash) == 16
+        assert uploaded.palette is not None
+
+        not_an_image = app_client.post(
+            "/image/upload", files={"image_file": ("evil.png", b"<script></script>")}
+        )
+        assert not_an_image.status_code == 415
+
+        too_big = b"\x89PNG\r\n\x1a\n" + bytes(1024 * 1024)
+        response = app_client.post("/image/upload", files={"image_file": ("big.png", too_big)})
+        assert response.status_code == 413
+        assert not tmp_path.joinpath("big.png").exists()
+    finally:
+        del app_client.app.dependency_overrides[get_settings]  # type: ignore
+
+
+def test_image_palette(tmp_path: Path) -> None:
+    image = PImage.new("RGB", (300, 200), (200, 30, 30))
+    image.paste((20, 40, 220), (0, 0, 100, 200))  # A third of the image
+    image.paste((255, 255, 255), (0, 0, 10, 10))  # Near-white is ignored, like ColorThief
+    image.save(path := tmp_path.joinpath("palette.png"))
+    assert extract_pallete(path, depth=2) == [(200, 30, 30), (20, 40, 220)]
+    assert extract_palletes([path, tmp_path.joinpath("missing.png")])[0] == extract_pallete(path)
+    assert isinstance(extract_palletes([tmp_path.joinpath("missing.png")])[0], Exception)
+
+
+@pytest.mark.parametrize("mode", ["P", "1"])
+def test_image_palette_large(tmp_path: Path, mode: str) -> None:
+    "Palette and 1-bit images bigger than the sample size, e.g. GIFs and 1-bit PNGs"
+    image = PImage.new("RGB", (1200, 800), (0, 0, 0))
+    image.paste((200, 30, 30) if mode == "P" else (255, 255, 255), (0, 0, 400, 800))
+    image.convert(mode).save(path := tmp_path.joinpath(f"{mode}.png"))
+    assert extract_pallete(path, depth=2)[0] == (0, 0, 0)
+
+
+def test_image_parse_file(create_image_files: list[Path], tmp_path: Path) -> None:
+    path, columns = parse_image_file(create_image_files[0], palette_size=5)
+    assert path == str(create_image_files[0])
+    with PImage.open(path) as im:
+        assert (columns["dimension_x"], columns["dimension_y"]) == im.size
+        assert columns["hash"] == dhash(im)
+    assert columns["mime_type"] == "image/png"
+    assert len(columns["palette"].split(",")) == 5
+    assert "palette" not in parse_image_file(create_image_files[0])[1]
+
+    (broken := tmp_path.joinpath("broken.png")).write_bytes(b"not an image")
+    assert isinstance(parse_image_file(broken)[1], Exception)
+
+
+def test_image_search_colour_client(db: Session, app_client: TestClient) -> None:
+    def make(name: str, palette: str, type: ImageType) -> Image:
+        return Image(
+            name=name, path=name, dimension_x=10, dimension_y=10, palette=palette, type=type
+        )
+
+    red = make("red.png", "#d01010,#202020", ImageType.backdrop)
+    blue = make("blue.png", "#1020d0,#f0f0f0", ImageType.backdrop)
+    accent = make("accent.png", "#10d010,#c81818", ImageType.map)
+    db.add_all([red, blue, accent])
+    db.commit()
+    red_id, blue_id, accent_id = red.id, blue.id, accent.id
+
+    found = app_client.get("/image/search/colour?hex=%23cc1111").json()
+    ids = [i["image_id"] for i in found]
+    assert ids.index(red_id) < ids.index(accent_id) < ids.index(blue_id)
+
+    maps = app_client.get("/image/search/colour?hex=cc1111&type=map").json()
+    assert accent_id in [i["image_id"] for i in maps]
+    assert red_id not in [i["image_id"] for i in maps]
+
+    # Changes are picked up as soon as they are committed
+    blue = db.get(Image, blue_id)
+    blue.palette = "#cc1111"
+    db.commit()
+    found = app_client.get("/image/search/colour?hex=cc1111&limit=1").json()
+    assert [i["image_id"] for i in found] == [blue_id]
+
+    assert app_client.get("/image/search/colour?hex=red").status_code == 422
+
+    # A row from before palette_lab existed stays searchable when something else about it changes
+    legacy_id = db.execute(
+        insert(Image).returning(Image.id),
+        {"name": "legacy.png", "path": "legacy.png", "dimension_x": 1, "dimension_y": 1},
+    ).scalar_one()
+    db.execute(update(Image).where(Image.id == legacy_id).values(palette="#11cc11"))
+    db.commit()
+    palette_index.clear()
+    assert (
+        app_client.get("/image/search/colour?hex=11cc11&limit=1").json()[0]["image_id"] == legacy_id
+    )
+    db.get(Image, legacy_id).name = "renamed.png"
+    db.commit()
+    assert (
+        app_client.get("/image/search/colour?hex=11cc11&limit=1").json()[0]["image_id"] == legacy_id
+    )
+
+
+def test_image_random_client(db: Session, app_client: TestClient) -> None:
+    def make(name: str, type: ImageType) -> Image:
+        return Image(name=name, path=name, dimension_x=10, dimension_y=10, type=type)
+
+    handouts = [make(f"handout{i}.png", ImageType.handout) for i in range(4)]
+    tag = Tag("random-test")
+    db.add_all([*handouts, tag])
+    db.flush()
+    # Tag ids get reused, so clear out anything left behind by the other tests
+    db.execute(delete(image_tags).where(image_tags.c.tag_id == tag.id))
+    tag.images = handouts[:2]
+    db.commit()
+    handout_ids = {i.id for i in handouts}
+    tagged_ids = {i.id for i in handouts[:2]}
+    tag_id, removed_id = tag.id, handouts[3].id
+
+    seen = set()
+    for _ in range(30):
+        rv = app_client.get("/image/random?image_type=handout")
+        assert rv.status_code == 200
+        assert rv.json()["type"] == "handout"
+        seen.add(rv.json()["image_id"])
+    assert handout_ids <= seen or len(seen & handout_ids) > 1
+
+    for _ in range(10):
+        rv = app_client.get(f"/image/random?image_type=handout&tags={tag_id}")
+        assert rv.json()["image_id"] in tagged_ids
+    assert app_client.get(f"/image/random?image_type=map&tags={tag_id}").status_code == 404
+
+    # Deletions are seen by the sampler straight away
+    assert app_client.delete(f"/image/{removed_id}").status_code == 204
+    for _ in range(30):
+        rv = app_client.get("/image/random?image_type=handout")
+        assert rv.json()["image_id"] != removed_id
+
+
+def test_image_random_sees_other_processes(db: Session) -> None:
+    "Rows written without the ORM's commit hooks, as the CLI does from another process"
+    sampler = RandomSampler(Image, "type")
+    sampler.check.interval = 0
+    before = len(sampler.members(db, ImageType.map))
+    row = {"name": "cli.png", "path": "cli.png", "dimension_x": 1, "dimension_y": 1}
+    with db.get_bind().begin() as connection:
+        q = insert(Image).values(type=ImageType.map, **row).returning(Image.id)
+        image_id = connection.execute(q).scalar_one()
+    assert image_id in sampler.members(db, ImageType.map)
+    assert len(sampler.members(db, ImageType.map)) == before + 1
+
+
+def test_image_hash_index_sees_other_processes(
+    db: Session, app_client: TestClient, monkeypatch
+) -> None:
+    "Hashes written without the ORM's commit hooks, as generate-hashes does"
+    monkeypatch.setattr(hash_index.check, "interval", 0)
+    row = {"path": "hashed.png", "dimension_x": 1, "dimension_y": 1, "hash": "0123456789abcdef"}
+    image = Image(name="hashed.png", **row)
+    db.add(image)
+    db.commit()
+    image_id = image.id
+    assert app_client.get(f"/image/{image_id}/similar?max_distance=0").json() == []
+
+    with db.get_bind().begin() as connection:
+        q = insert(Image).values(name="copy.png", **row).returning(Image.id)
+        copy_id = connection.execute(q).scalar_one()
+    similar = app_client.get(f"/image/{image_id}/similar?max_distance=0").json()
+    assert [i["image_id"] for i in similar] == [copy_id]
+
+
+def test_image_palette_index_sees_other_processes(
+    db: Session, app_client: TestClient, monkeypatch
+) -> None:
+    "Palettes written without the ORM's commit hooks, as generate-colours does"
+    monkeypatch.setattr(palette_index.check, "interval", 0)
+    image = Image(name="plain.png", path="plain.png", dimension_x=1, dimension_y=1)
+    db.add(image)
+    db.commit()
+    image_id = image.id
+    assert app_client.get("/image/search/colour?hex=2468ac&limit=1").status_code == 200
+
+    palette = "#2468ac,#202020"
+    with db.get_bind().begin() as connection:
+        q = update(Image).where(Image.id == image_id)
+        connection.execute(q.values(palette=palette, palette_lab=pack_palette(palette)))
+    found = app_client.get("/image/search/colour?hex=2468ac&limit=1").json()
+    assert [i["image_id"] for i in found] == [image_id]
+
+
+def test_image_tag_index_sees_other_processes(
+    db: Session, app_client: TestClient, monkeypatch
+) -> None:
+    "Images and tags written without the ORM's commit hooks, as parse-image-directory does"
+    monkeypatch.setattr(tag_index.check, "interval", 0)
+    tag = Tag("elsewhere")
+    db.add(tag)
+    db.flush()
+    # Tag ids get reused, so clear out anything left behind by the other tests
+    db.execute(delete(image_tags).where(image_tags.c.tag_id == tag.id))
+    db.commit()
+    tag_id = tag.id
+    assert app_client.get(f"/image/tag?taglist={tag_id}").json()["total"] == 0
+
+    row = {"name": "cli.png", "path": "cli.png", "dimension_x": 1, "dimension_y": 1}
+    with db.get_bind().begin() as connection:
+        image_id = connection.execute(insert(Image).values(**row).returning(Image.id)).scalar_one()
+        connection.execute(insert(image_tags).values(image_id=image_id, tag_id=tag_id))
+    page = app_client.get(f"/image/tag?taglist={tag_id}").json()
+    assert [i["image_id"] for i in page["items"]] == [image_id]
+    assert page["total"] == 1
+
+
+def test_image_core_statement_changes(db: Session, monkeypatch) -> None:
+    "Core statements are turned into the rows they wrote, without asking the database which"
+    seen: list[Changes] = []
+    on_commit("images")(seen.append)
+    statements = []
+    engine = db.get_bind()
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(engine, "before_cursor_execute", listener)
+    row = {"name": "core.png", "path": "core.png", "dimension_x": 1, "dimension_y": 1}
+    try:
+        image_id = db.execute(insert(Image).values(id=9001, **row)).inserted_primary_key[0]
+        db.execute(update(Image).where(Image.id == image_id).values(name="renamed.png"))
+        db.execute(update(Image).where(Image.id == 9002).values(name="missing.png"))
+        db.commit()
+        assert seen[-1].inserted == [{"id": 9001, **row}]
+        assert seen[-1].updated == [{"id": 9001, "name": "renamed.png"}]
+        assert seen[-1].bulk  # Nothing matched 9002, so it can't say what was written
+        db.execute(delete(Image).where(Image.id.in_([image_id, image_id])))
+        db.commit()
+        assert seen[-1].deleted == [{"id": 9001}] and not seen[-1].bulk
+        assert not any(s.lstrip().upper().startswith("SELECT") for s in statements)
+
+        # Without a SQLAlchemy known to keep .values() where it can be read, it's a bulk change
+        monkeypatch.setattr(events, "_VALUES_READABLE", False)
+        assert events._statement_values(insert(Image).values(id=9001, **row)) is None
+        db.execute(insert(Image).values(id=9001, **row))
+        db.commit()
+        assert seen[-1].bulk and not seen[-1].inserted
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+        events._subscribers["images"].remove(seen.append)
+        db.execute(delete(Image).where(Image.id == 9001))
+        db.commit()
+
+
+def test_image_tag_match_client(db: Session, app_client: TestClient) -> None:
+    images = [
+        Image(name=f"tagmatch{i}.png", path=f"tagmatch{i}.png", dimension_x=10, dimension_y=10)
+        for i in range(4)
+    ]
+    a, b, c, d = Tag("tagmatch-a"), Tag("tagmatch-b"), Tag("tagmatch-c"), Tag("tagmatch-d")
+    db.add_all([*images, a, b, c, d])
+    db.flush()
+    # Tag ids get reused, so clear out anything left behind by the other tests
+    db.execute(delete(image_tags).where(image_tags.c.tag_id.in_([a.id, b.id, c.id, d.id])))
+    a.images = images[:2]
+    b.images = [images[0], images[2]]
+    c.images = [images[2]]
+    db.commit()
+    ids = [i.id for i in images]
+    a_id, b_id, c_id, d_id = a.id, b.id, c.id, d.id
+
+    def match(query: str) -> list[int]:
+        rv = app_client.get(f"/image/tag?name=tagmatch&{query}")
+        assert rv.status_code == 200, rv.json()
+        return [i["image_id"] for i in rv.json()["items"]]
+
+    # Most matching tags first
+    assert match(f"taglist={a_id}&taglist={b_id}") == [ids[0], ids[1], ids[2]]
+    assert match(f"taglist={a_id}&taglist={b_id}&size=1&page=2") == [ids[1]]
+    assert match(f"all_tags={b_id}") == [ids[0], ids[2]]
+    assert match(f"taglist={b_id}&exclude_tags={c_id}") == [ids[0]]
+    assert match(f"exclude_tags={a_id}&exclude_tags={b_id}") == [ids[3]]
+
+    # Tagging through the API, and merging tags, are picked up as soon as they're committed
+    assert app_client.patch(f"/image/{ids[3]}/tag?tag_id={c_id}").status_code == 200
+    assert match(f"taglist={c_id}") == [ids[2], ids[3]]
+    assert app_client.put(f"/image/{ids[1]}/tag", json=[c_id]).status_code == 200
+    assert match(f"taglist={a_id}") == [ids[0]]
+    assert app_client.put(f"/tag/{d_id}/merge/{c_id}").status_code == 204
+    assert match(f"taglist={c_id}") == []
+    assert match(f"taglist={d_id}") == ids[1:]
+
+
+def test_image_search_client(db: Session, app_client: TestClient) -> None:
+    def make(name: str) -> Image:
+        return Image(name=name, path=name, dimension_x=10, dimension_y=10)
+
+    named, tagged, other = make("Quokkadragon lair.png"), make("cave.png"), make("forest.png")
+    tag = Tag("quokkadragon")
+    tag.images = [tagged]
+    collection = Collection(name="Quokka Campaign")
+    collection.images = [other]
+    db.add_all([named, tagged, other, tag, collection])
+    db.commit()
+    named_id, tagged_id, other_id, tag_id = named.id, tagged.id, other.id, tag.id
+
+    def search(q: str) -> list[int]:
+        rv = app_client.get("/image/search", params={"q": q})
+        assert rv.status_code == 200, rv.json()
+        return [i["image_id"] for i in rv.json()["items"]]
+
+    # Prefix matches on any column, with a match on the image's own name ranked first
+    assert search("quokkadrag") == [named_id, tagged_id]
+    assert search("quok") == [named_id, tagged_id, other_id]
+    assert search("quokka campaign") == [other_id]
+    assert search("quokkadragon lair") == [named_id]
+    assert search('quokka" OR "NEAR') == []  # Query syntax is searched for literally
+
+    # Kept in step with renames and untagging
+    assert app_client.patch(f"/tag/{tag_id}", json={"tag": "wombat"}).status_code == 200
+    assert search("quokkadragon") == [named_id]
+    assert search("wombat") == [tagged_id]
+    assert app_client.delete(f"/image/{tagged_id}/tag?tag_id={tag_id}").status_code == 200
+    assert search("wombat") == []
+
+    assert app_client.get("/image/search", params={"q": "  !? "}).status_code == 400
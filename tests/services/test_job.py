@@ -0,0 +1,63 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from api.models import Image, Job, JobStatus, JobType
+from api.services import JobService
+
+
+@pytest.fixture()
+def job_service(db: Session) -> JobService:
+    db.execute(delete(Job))
+    db.commit()
+    return JobService(db)
+
+
+def test_job_lease_complete_service(job_service: JobService, create_image: Image) -> None:
+    job = job_service.enqueue(JobType.hash, create_image.id)
+    leased = job_service.lease(60)
+    assert leased is not None and leased.id == job.id
+    assert leased.status == JobStatus.running
+    assert leased.attempts == 1
+    assert job_service.lease(60) is None  # Already taken
+
+    job_service.complete(leased)
+    assert leased.status == JobStatus.done
+    assert job_service.lease(60) is None
+
+
+def test_job_expired_lease_service(job_service: JobService, create_image: Image) -> None:
+    job = job_service.enqueue(JobType.palette, create_image.id)
+    job_service.lease(-1)  # The worker "dies" holding the lease
+    leased = job_service.lease(60)
+    assert leased is not None and leased.id == job.id
+    assert leased.attempts == 2
+
+
+def test_job_retry_dead_letter_client(
+    db: Session, app_client: TestClient, job_service: JobService, create_image: Image
+) -> None:
+    job = job_service.enqueue(JobType.thumbnail, create_image.id)
+    for attempt in range(1, 4):
+        leased = job_service.lease(60)
+        assert leased is not None and leased.attempts == attempt
+        job_service.fail(leased, "boom", max_attempts=3, backoff=60)
+        if attempt < 3:
+            assert leased.status == JobStatus.queued
+            assert leased.run_after > time.time() + 60 * 2 ** (attempt - 1) - 5
+            assert job_service.lease(60) is None  # Backing off
+            leased.run_after = time.time()
+            db.commit()
+    assert job.status == JobStatus.dead
+    assert job_service.lease(60) is None
+
+    job_id = job.id
+    stats = app_client.get("/job/stats").json()
+    assert stats["dead"] == 1
+    retried = app_client.post(f"/job/{job_id}/retry")
+    assert retried.status_code == 200
+    assert retried.json()["status"] == "queued"
+    assert app_client.post(f"/job/{job_id}/retry").status_code == 409
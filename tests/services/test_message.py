@@ -65,3 +65,29 @@ def test_message_update_client(app_client: TestClient, create_message: Message)
     message_json = rv.json()
     assert rv.status_code == 200, message_json
     assert create_message.message == "test1"
+
+
+def test_message_bulk_client(app_client: TestClient) -> None:
+    messages = [{"message": f"Bulk message #{i}"} for i in range(20)]
+    rv = app_client.post("/message/bulk", json=messages)
+    assert rv.status_code == 201
+    ids = rv.json()
+    assert [app_client.get(f"/message/{id}").json()["message"] for id in ids[:3]] == [
+        "Bulk message #0",
+        "Bulk message #1",
+        "Bulk message #2",
+    ]
+
+    updates = [{"message_id": id, "message": "Updated"} for id in ids[:2]]
+    rv = app_client.patch("/message/bulk", json=updates)
+    assert rv.status_code == 200 and rv.json() == ids[:2]
+    assert app_client.get(f"/message/{ids[1]}").json()["message"] == "Updated"
+
+    # A missing id fails the whole batch, and says which item it was
+    rv = app_client.request("DELETE", "/message/bulk", json=[ids[0], 0])
+    assert rv.status_code == 404
+    assert [error["index"] for error in rv.json()["detail"]] == [1]
+    assert app_client.get(f"/message/{ids[0]}").status_code == 200
+    rv = app_client.request("DELETE", "/message/bulk", json=ids)
+    assert rv.status_code == 204
+    assert app_client.get(f"/message/{ids[0]}").status_code == 404
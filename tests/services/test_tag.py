@@ -36,6 +36,21 @@ def test_tag_create_client(app_client: TestClient) -> None:
     assert rv.status_code == 201
     assert rv.json()["tag_id"] is not None
 
+def test_tag_bulk_conflict_client(app_client: TestClient) -> None:
+    tags = [{"tag": "bulk1"}, {"tag": "bulk2"}, {"tag": "Bulk1"}, {"tag": "bulk3"}]
+    rv = app_client.post("/tag/bulk", json=tags)
+    assert rv.status_code == 409
+    assert [error["index"] for error in rv.json()["detail"]] == [2]
+    assert app_client.get("/tag", params={"tag": "bulk"}).json()["total"] == 0  # None created
+
+    ids = app_client.post("/tag/bulk", json=tags[:2] + tags[3:]).json()
+    rv = app_client.patch("/tag/bulk", json=[{"tag_id": ids[2], "tag": "bulk2"}])
+    assert rv.status_code == 409
+    assert app_client.get(f"/tag/{ids[2]}").json()["tag"] == "bulk3"
+
+    rv = app_client.post("/tag/bulk", json=[{"tag": f"many{i}"} for i in range(1001)])
+    assert rv.status_code == 413
+
 def test_tag_delete_client(app_client: TestClient, create_tag: Tag) -> None:
     rv = app_client.get(f"/tag/{create_tag.id}")
     assert rv.status_code == 200
@@ -1,6 +1,359 @@
+from pathlib import Path
+from typing import Any, AsyncGenerator, Generator
+
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import NullPool, QueuePool, create_engine, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+from api.api import create_app
+from api.models import (
+    Collection,
+    Combat,
+    Entity,
+    Image,
+    Participant,
+    RollTable,
+    RollTableRow,
+    Tag,
+    image_collections,
+    image_tags,
+)
+from api.utils import sampler
+from api.utils.hash_index import hash_index
+from api.utils.object_cache import clear_object_caches
+from api.utils.pagination import get_count_cache
+from api.utils.palette_index import palette_index
+from api.utils.response_cache import get_response_cache
+from api.utils.tag_index import tag_index
+from config import Settings
+from core.db import Base
+from core.profiling import QueryProfileMiddleware, RequestProfile, profile_queries, query_stats
+from core.session import (
+    async_url,
+    engine_options,
+    get_session,
+    optimize_database,
+    set_pragmas,
+    sqlite_pragmas,
+)
 
 
 def test_health(app_client: TestClient) -> None:
     rv = app_client.get("/health")
-    assert rv.status_code == 200
\ No newline at end of file
+    assert rv.status_code == 200
+
+
+def clear_indexes() -> None:
+    "The in-memory indexes are per process, so must not carry rows between test databases"
+    for index in (hash_index, palette_index, tag_index, *sampler._samplers.values()):
+        index.clear()
+    get_count_cache().clear()
+    clear_object_caches()
+    get_response_cache().clear()
+
+
+def test_async_database(tmp_path: Path) -> None:
+    url = f"sqlite:///{tmp_path.joinpath('async.sqlite')}"
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        image = {"path": "/images/a.png", "dimension_x": 10, "dimension_y": 10}
+        connection.execute(insert(Image), [{"name": "a.png", **image}, {"name": "b.png", **image}])
+    engine.dispose()
+    # Without lifespan events (which would reconnect the shared broadcaster) the client runs each
+    # request in its own event loop, so connections can't be pooled between them
+    async_engine = create_async_engine(async_url(url), poolclass=NullPool)
+    make_session = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def _create_session() -> AsyncGenerator[AsyncSession, None]:
+        async with make_session() as session:
+            yield session
+
+    app = create_app()
+    app.dependency_overrides[get_session] = _create_session
+    clear_indexes()
+    try:
+        client = TestClient(app)
+        tag = client.post("/tag/", json={"tag": "Forest"}).json()
+        assert client.get(f"/tag/{tag['tag_id']}").json()["tag"] == "forest"
+        assert client.patch(f"/tag/{tag['tag_id']}", json={"tag": "wood"}).status_code == 200
+
+        # Relationships in the responses are loaded before they leave the session
+        rv = client.patch("/image/1/tag", params={"tag_id": tag["tag_id"]})
+        assert [t["tag"] for t in rv.json()["tags"]] == ["wood"]
+        page = client.get("/image/", params={"size": 10}).json()
+        assert [len(i["tags"]) for i in page["items"]] == [1, 0]
+        assert client.get("/image/tag", params={"taglist": [tag["tag_id"]]}).json()["total"] == 1
+
+        collection = client.post("/collection/", json={"name": "Maps"}).json()
+        url = f"/collection/{collection['collection_id']}"
+        client.patch("/image/2/collection", params={"collection_id": collection["collection_id"]})
+        assert [i["image_id"] for i in client.get(url).json()["images"]] == [2]
+
+        combat = {"title": "Ambush", "participants": [{"name": "Goblin"}]}
+        combat = client.post("/combat/", json=combat).json()
+        rv = client.get(f"/combat/{combat['combat_id']}")
+        assert [p["name"] for p in rv.json()["participants"]] == ["Goblin"]
+
+        assert client.delete(url).status_code == 204
+        assert client.get(url).status_code == 404
+    finally:
+        clear_indexes()
+        async_engine.sync_engine.dispose()
+
+
+def test_sqlite_pragmas(tmp_path: Path) -> None:
+    settings = Settings(SQLITE_BUSY_TIMEOUT=1234, SQLITE_POOL_SIZE=2)
+    url = f"sqlite:///{tmp_path.joinpath('pragmas.sqlite')}"
+    assert engine_options("sqlite://", settings) == {"pool_pre_ping": True}
+    engine = create_engine(url, **engine_options(url, settings))
+    set_pragmas(engine, sqlite_pragmas(settings))
+    assert isinstance(engine.pool, QueuePool) and engine.pool.size() == 2
+    with engine.connect() as connection:
+        names = ["journal_mode", "busy_timeout", "synchronous", "temp_store"]
+        values = [connection.exec_driver_sql(f"PRAGMA {name}").scalar() for name in names]
+        assert values == ["wal", 1234, 1, 2]  # synchronous NORMAL, temp_store MEMORY
+    optimize_database(engine)
+    engine.dispose()
+
+
+def test_query_profile(tmp_path: Path) -> None:
+    engine = create_engine(f"sqlite:///{tmp_path.joinpath('profile.sqlite')}")
+    Base.metadata.create_all(engine)
+    profile_queries(engine, slow_query_ms=0)  # Every query is slow
+
+    def _create_session():
+        with Session(engine) as session:
+            yield session
+
+    app = create_app()
+    app.add_middleware(QueryProfileMiddleware)
+    app.dependency_overrides[get_session] = _create_session
+    query_stats.clear()
+    clear_indexes()
+    try:
+        client = TestClient(app)
+        assert client.post("/tag/", json={"tag": "forest"}).status_code == 201
+        rv = client.get("/tag/")
+        assert rv.headers["server-timing"].startswith("db;dur=")
+        stats = client.get("/debug/queries").json()
+        assert stats["routes"]["list_tags"]["requests"] == 1
+        assert stats["routes"]["list_tags"]["queries"]["max"] >= 2  # The count, then the page
+        slow = stats["slow_queries"][-1]
+        assert slow["route"] == "list_tags" and slow["plan"]
+    finally:
+        query_stats.clear()
+        clear_indexes()
+        engine.dispose()
+
+    profile = RequestProfile()
+    for n in range(6):
+        profile.record("SELECT * FROM tags WHERE id = ?", 0.001)
+    profile.record("SELECT * FROM images", 0.002)
+    assert profile.repeated() == {"SELECT * FROM tags WHERE id = ?": 6}
+    assert profile.slowest[0] == (0.002, "SELECT * FROM images")
+
+
+@pytest.fixture(scope="module")
+def profiled_client(tmp_path_factory: pytest.TempPathFactory) -> Generator[TestClient, None, None]:
+    "A client for a database with more than 50 of everything that a list route returns"
+    path = tmp_path_factory.mktemp("profiled").joinpath("profiled.sqlite")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        image = {"dimension_x": 1, "dimension_y": 1}
+        connection.execute(insert(Tag), [{"tag": f"tag{n}"} for n in range(60)])
+        connection.execute(
+            insert(Image), [{"name": f"{n}.png", "path": f"/{n}.png", **image} for n in range(100)]
+        )
+        connection.execute(
+            insert(image_tags),
+            [{"image_id": i, "tag_id": t} for i in range(1, 101) for t in (1, 2)],
+        )
+        entities = [
+            {"name": f"E{n % 30}", "image_id": n + 1, "cr": None if n % 7 == 0 else n % 5}
+            for n in range(100)
+        ]
+        connection.execute(insert(Entity), entities)
+        connection.execute(insert(Collection), [{"name": f"C{n}"} for n in range(60)])
+        connection.execute(
+            insert(image_collections),
+            [{"image_id": i, "collection_id": 1 + i % 60} for i in range(1, 101)],
+        )
+        connection.execute(insert(Combat), [{"title": f"B{n}"} for n in range(60)])
+        participants = [
+            {"name": f"P{n}", "combat_id": 1 + n % 60, "image_id": n + 1} for n in range(100)
+        ]
+        connection.execute(insert(Participant), participants)
+        connection.execute(insert(RollTable), [{"name": f"R{n}"} for n in range(60)])
+        rows = [
+            {"rolltable_id": 1 + n % 60, "name": "row", "display_name": "Row"} for n in range(100)
+        ]
+        connection.execute(insert(RollTableRow), rows)
+    profile_queries(engine, slow_query_ms=float("inf"))
+
+    def _create_session():
+        with Session(engine) as session:
+            yield session
+
+    app = create_app()
+    app.add_middleware(QueryProfileMiddleware)
+    app.dependency_overrides[get_session] = _create_session
+    clear_indexes()
+    yield TestClient(app)
+    clear_indexes()
+    engine.dispose()
+
+
+@pytest.mark.parametrize(
+    "path, queries",
+    [
+        ("/image/", 3),  # page, tags, entities
+        ("/collection/", 4),  # page, images, their tags and entities
+        ("/combat/", 2),  # page, participants
+        ("/rolltable/", 3),  # page, rows, their extra data
+        ("/entity/", 1),
+        ("/participant/", 1),
+        ("/tag/", 1),
+        ("/image/cursor", 3),
+        ("/combat/cursor", 2),
+        ("/entity/cursor", 1),
+    ],
+)
+def test_list_query_count(profiled_client: TestClient, path: str, queries: int) -> None:
+    "Every page takes the same number of queries, however many rows are on it (not counting them)"
+    for size in (1, 10, 50):
+        rv = profiled_client.get(path, params={"size": size, "total": "skip"})
+        assert rv.status_code == 200
+        assert len(rv.json()["items"]) == size
+        assert f'desc="{queries} queries"' in rv.headers["server-timing"], (size, rv.headers)
+
+
+@pytest.mark.parametrize("path", ["/image/", "/entity/"])
+def test_row_serialization(profiled_client: TestClient, path: str) -> None:
+    "The lists built from Core rows are just what the ORM objects and the schema would give"
+    params = {"size": 100, "sort_dir": "asc"}
+    rows = profiled_client.get(path, params=params).json()
+    orm = profiled_client.get(f"{path}cursor", params=params).json()
+    assert rows["total"] == 100 and rows["pages"] == 1
+    assert rows["items"] == orm["items"]
+
+
+def test_count_cache(profiled_client: TestClient) -> None:
+    def get(**params) -> tuple[int, int]:
+        "The total, and how many queries it took"
+        rv = profiled_client.get("/tag/", params=params)
+        assert rv.status_code == 200
+        return rv.json()["total"], int(rv.headers["server-timing"].split('desc="')[1].split()[0])
+
+    total, queries = get(size=5)
+    assert queries == 2
+    # Counted once for every page of the same filter
+    assert get(size=5, page=3) == (total, 1)
+    assert get(size=5, tag="tag1")[1] == 2
+
+    created = profiled_client.post("/tag/", json={"tag": "counted"}).json()
+    assert get(size=5, total="approximate") == (total, 1)
+    assert get(size=5) == (total + 1, 2)
+    profiled_client.delete(f"/tag/{created['tag_id']}")
+    assert get(size=5)[0] == total
+    assert get(size=5, total="skip")[0] is None
+    assert get_count_cache().stats()["stale_hits"] == 1
+
+
+def test_object_cache(profiled_client: TestClient) -> None:
+    def get(path: str) -> tuple[Any, int]:
+        "The response, and how many queries it took"
+        rv = profiled_client.get(path)
+        assert rv.status_code == 200
+        return rv.json(), int(rv.headers["server-timing"].split('desc="')[1].split()[0])
+
+    image, queries = get("/image/7")
+    assert queries > 0
+    assert get("/image/7") == (image, 0)
+
+    # Tagged with a Core insert into image_tags, then the tag renamed through the ORM
+    assert profiled_client.patch("/image/7/tag", params={"tag_id": 5}).status_code == 200
+    assert [tag["tag_id"] for tag in get("/image/7")[0]["tags"]] == [1, 2, 5]
+    assert profiled_client.patch("/tag/5", json={"tag": "renamed"}).status_code == 200
+    assert [tag["tag"] for tag in get("/image/7")[0]["tags"]] == ["tag0", "tag1", "renamed"]
+    assert get("/image/8")[1] > 0  # The rename could have been on any image
+
+    sources, _ = get("/entity/sources")
+    assert get("/entity/sources") == (sources, 0)
+    assert profiled_client.patch("/entity/3", json={"source": "MM"}).status_code == 200
+    assert "MM" in get("/entity/sources")[0]
+
+    stats = profiled_client.get("/debug/objects").json()
+    assert stats["Image"]["hits"] >= 1 and stats["Image"]["invalidations"] >= 2
+
+
+def test_object_cache_nested(profiled_client: TestClient) -> None:
+    "A write to a table the cached rows were loaded with, that doesn't refer to them directly"
+    assert 30 in [
+        image["image_id"] for image in profiled_client.get("/collection/31").json()["images"]
+    ]
+    assert profiled_client.patch("/image/30/tag", params={"tag_id": 6}).status_code == 200
+    images = profiled_client.get("/collection/31").json()["images"]
+    tags = next(image["tags"] for image in images if image["image_id"] == 30)
+    assert 6 in [tag["tag_id"] for tag in tags]
+
+
+def test_etag(profiled_client: TestClient) -> None:
+    rv = profiled_client.get("/tag/", params={"size": 5, "page": 2})
+    tag = rv.headers["etag"]
+    assert tag.startswith('W/"')
+    # The order of the parameters doesn't matter
+    assert profiled_client.get("/tag/?page=2&size=5").headers["etag"] == tag
+
+    headers = {"if-none-match": tag, "origin": "http://localhost:3000"}
+    rv = profiled_client.get("/tag/?page=2&size=5", headers=headers)
+    assert rv.status_code == 304 and rv.content == b""
+    assert 'desc="0 queries' in rv.headers["server-timing"]
+    assert rv.headers["access-control-allow-origin"] == "*"
+
+    created = profiled_client.post("/tag/", json={"tag": "tagged"}).json()
+    rv = profiled_client.get("/tag/?page=2&size=5", headers={"if-none-match": tag})
+    assert rv.status_code == 200 and rv.headers["etag"] != tag
+    profiled_client.delete(f"/tag/{created['tag_id']}")
+
+    assert "etag" in profiled_client.get("/entity/sources").headers
+    assert "etag" not in profiled_client.get("/entity/").headers
+    assert profiled_client.get("/debug/responses").json()["not_modified"] == 1
+
+
+@pytest.mark.parametrize(
+    "sort_by, sort_dir",
+    [(None, "none"), ("cr", "asc"), ("cr", "desc"), ("name", "desc"), ("initiative", "asc")],
+)
+def test_cursor_pagination(profiled_client: TestClient, sort_by: str, sort_dir: str) -> None:
+    params = {"sort_dir": sort_dir} | ({"sort_by": sort_by} if sort_by else {})
+    entities = profiled_client.get("/entity/", params={"size": 100}).json()["items"]
+    # Ties are broken by id, and NULLs come first going up
+    keys = {
+        None: lambda e: e["entity_id"],
+        "cr": lambda e: (e["cr"] is not None, e["cr"] or 0, e["entity_id"]),
+        "name": lambda e: (e["name"].lower(), e["entity_id"]),
+        "initiative": lambda e: (e["initiative_modifier"], e["entity_id"]),
+    }
+    expected = sorted(entities, key=keys[sort_by], reverse=sort_dir == "desc")
+
+    seen, cursor = [], None
+    while True:
+        rv = profiled_client.get("/entity/cursor", params=params | {"size": 7, "cursor": cursor})
+        assert rv.status_code == 200
+        seen += rv.json()["items"]
+        if (cursor := rv.json()["next_page"]) is None:
+            break
+    assert [e["entity_id"] for e in seen] == [e["entity_id"] for e in expected]
+
+    rv = profiled_client.get("/entity/cursor", params={"sort_by": "ac", "sort_dir": "asc"})
+    other = rv.json()["next_page"]
+    assert (
+        profiled_client.get("/entity/cursor", params=params | {"cursor": other}).status_code == 400
+    )
+    assert (
+        profiled_client.get("/entity/cursor", params={"cursor": "bm90IGpzb24="}).status_code == 400
+    )